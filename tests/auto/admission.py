@@ -0,0 +1,187 @@
+"""
+Name: admission.py
+Admission control in front of Job.run. A job is deferred, keeping its
+label so a later cycle picks it up again, when
+  * its estimated core-hours would go over the daily budget for its
+    repo or for all repos, or
+  * the batch queue for hpc_acc is deeper than the threshold.
+
+Options from CImachine.cfg (0 or empty turns a check off):
+  budget_repo_day  core-hours per repo per day
+  budget_day       core-hours per day for all repos
+  queue_limit      most jobs allowed in the queue for hpc_acc
+  queue_command    command listing those jobs, one per line
+                   (default squeue -h -A {hpc_acc} -t PD,R)
+  usage_command    optional command printing the core-hours used by
+                   {user} on hpc_acc between {start} and {end}
+                   (YYYY-MM-DDTHH:MM:SS), used to learn the cost of each
+                   action
+
+Charges and the recent measured cost of each action are kept in
+Admission.cfg. WE2E experiments run under rocoto after their job has
+returned, so the cost of actions in ASYNC_ACTIONS is not measured and
+their estimate stays the default. A job for all compilers is estimated
+as one job per compiler until it has a measured history.
+"""
+
+import datetime
+import logging
+import os
+import statistics
+import subprocess
+from configparser import ConfigParser as config_parser
+
+LEDGER_FILE = 'Admission.cfg'
+HISTORY_SECTION = 'history'
+HISTORY_KEEP = 10
+# Core-hour estimates used until an action has a measured history
+DEFAULT_COSTS = {'build': 1, 'WE': 100, 'rt': 20, 'RT': 1500, 'BL': 1500}
+# Actions whose batch jobs outlive Job.run
+ASYNC_ACTIONS = ['WE']
+# The compiler of ci-<machine>-all-<action> jobs
+MATRIX_COMPILER = 'all'
+DEFAULT_QUEUE_COMMAND = 'squeue -h -A {hpc_acc} -t PD,R'
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def read_ledger(file_name=LEDGER_FILE):
+    config = config_parser()
+    # actions rt and RT are different jobs
+    config.optionxform = str
+    if os.path.exists(file_name):
+        config.read(file_name)
+    return config
+
+
+def write_ledger(config, file_name=LEDGER_FILE):
+    with open(file_name, 'w') as fname:
+        config.write(fname)
+
+
+def history_key(job_obj):
+    return f'{job_obj.machine}.{job_obj.compiler}.{job_obj.preq_dict["action"]}'
+
+
+def estimate_cost(job_obj, config):
+    ''' Mean of the recent measured costs of this action, or its default '''
+    key = history_key(job_obj)
+    if config.has_option(HISTORY_SECTION, key):
+        costs = [float(c) for c in config[HISTORY_SECTION][key].split()]
+        if costs:
+            return statistics.mean(costs)
+    cost = float(DEFAULT_COSTS.get(job_obj.preq_dict['action'], 0))
+    if job_obj.compiler == MATRIX_COMPILER:
+        cost = cost * len(job_obj.machine_dict.get('compilers') or [1])
+    return cost
+
+
+def spent_today(config, day, address=None):
+    if not config.has_section(day):
+        return 0.0
+    if address:
+        return config[day].getfloat(address, fallback=0.0)
+    return sum(float(v) for k, v in config.items(day)
+               if k not in config.defaults())
+
+
+def queue_depth(job_obj):
+    ''' Number of jobs in the batch queue for hpc_acc, None if unknown '''
+    logger = logging.getLogger('ADMISSION/QUEUE_DEPTH')
+    if job_obj.harness_active():
+        return None
+    command = job_obj.machine_dict.get('queue_command') or \
+        DEFAULT_QUEUE_COMMAND
+    command = command.format(hpc_acc=job_obj.hpc_acc)
+    try:
+        out = subprocess.run(command, shell=True, stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, timeout=60,
+                             check=True).stdout.decode('utf8')
+    except Exception as e:
+        logger.info(f'Could not run `{command}`: {e}')
+        return None
+    return len([line for line in out.split('\n') if line.strip()])
+
+
+def admit(job_obj):
+    ''' Returns (admitted, reason). An admitted job is charged its
+        estimated cost against today's budgets '''
+    logger = logging.getLogger('ADMISSION/ADMIT')
+    options = job_obj.machine_dict
+    config = read_ledger()
+    day = datetime.datetime.now().strftime('%Y%m%d')
+    address = job_obj.repo['address']
+    cost = estimate_cost(job_obj, config)
+
+    budget_repo = float(options.get('budget_repo_day') or 0)
+    if budget_repo and spent_today(config, day, address) + cost > budget_repo:
+        return False, (f'{address} would go over its daily budget of '
+                       f'{budget_repo:.0f} core-hours')
+    budget_day = float(options.get('budget_day') or 0)
+    if budget_day and spent_today(config, day) + cost > budget_day:
+        return False, (f'daily budget of {budget_day:.0f} core-hours '
+                       'would be exceeded')
+    queue_limit = int(options.get('queue_limit') or 0)
+    if queue_limit:
+        depth = queue_depth(job_obj)
+        if depth is not None and depth > queue_limit:
+            return False, (f'{depth} jobs queued for {job_obj.hpc_acc}, '
+                           f'limit is {queue_limit}')
+
+    if not config.has_section(day):
+        config[day] = {}
+    config[day][address] = str(spent_today(config, day, address) + cost)
+    # keep only the last week of charges
+    cutoff = (datetime.datetime.now() -
+              datetime.timedelta(days=7)).strftime('%Y%m%d')
+    for section in config.sections():
+        if section.isdigit() and section < cutoff:
+            config.remove_section(section)
+    write_ledger(config)
+    logger.info(f'Admitted {history_key(job_obj)} for {address}, '
+                f'estimated {cost:.1f} core-hours')
+    return True, ''
+
+
+def measured_usage(job_obj, start, end):
+    ''' Core-hours reported by usage_command, None if not configured '''
+    logger = logging.getLogger('ADMISSION/MEASURED_USAGE')
+    command = job_obj.machine_dict.get('usage_command')
+    if not command or job_obj.harness_active():
+        return None
+    command = command.format(hpc_acc=job_obj.hpc_acc,
+                             user=os.environ.get('USER', ''),
+                             start=start.strftime(TIME_FORMAT),
+                             end=end.strftime(TIME_FORMAT))
+    try:
+        out = subprocess.run(command, shell=True, stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, timeout=300,
+                             check=True).stdout.decode('utf8')
+        return float(out.split()[0])
+    except Exception as e:
+        logger.info(f'Could not get usage from `{command}`: {e}')
+        return None
+
+
+def record_usage(job_obj, start, end):
+    ''' Learn the cost of this action and correct today's charge '''
+    logger = logging.getLogger('ADMISSION/RECORD_USAGE')
+    if job_obj.preq_dict['action'] in ASYNC_ACTIONS:
+        # most of the work runs after the job returns
+        return
+    used = measured_usage(job_obj, start, end)
+    if used is None:
+        return
+    config = read_ledger()
+    estimate = estimate_cost(job_obj, config)
+    key = history_key(job_obj)
+    if not config.has_section(HISTORY_SECTION):
+        config[HISTORY_SECTION] = {}
+    costs = config[HISTORY_SECTION].get(key, '').split() + [f'{used:.2f}']
+    config[HISTORY_SECTION][key] = ' '.join(costs[-HISTORY_KEEP:])
+    day = start.strftime('%Y%m%d')
+    address = job_obj.repo['address']
+    if config.has_section(day):
+        charged = spent_today(config, day, address) - estimate + used
+        config[day][address] = str(max(charged, 0.0))
+    write_ledger(config)
+    logger.info(f'{key} used {used:.1f} core-hours')
@@ -0,0 +1,246 @@
+"""
+Name: blstore.py
+Content addressed store for weather model baselines. Each file of a new
+baseline is hashed (several at once) and kept once in
+{workdir}/RT/objects/<hash[:2]>/<hash>; the BL_DATE tree
+RT/NEMSfv3gfs/gsl-develop-<BL_DATE>/<COMPILER> is made of hard links to
+those objects. Files that did not change since an earlier BL_DATE take
+no more space. Objects are read only, since every baseline that links
+to one shares it.
+
+The link count of an object is its reference count: once no baseline
+tree links to it (count 1, the store itself), prune removes it. A BL job
+may be publishing while prune runs, and an object it has just moved
+into the store, or is about to link again, is not linked yet. publish
+sets the modification time of every object it uses, which linking and
+unlinking leave alone, and objects modified in the last GRACE_SECONDS
+are kept.
+
+Usage (run from tests/auto, e.g. through start_ci_py_pro.sh):
+  python blstore.py prune <workdir>/RT [--keep N] [--dry-run]
+      remove all but the newest N gsl-develop-<date> trees (default 3)
+      and the objects no tree uses any more
+  python blstore.py adopt <workdir>/RT
+      link the trees made before the store into it
+  python blstore.py usage <workdir>/RT
+      space used by the store and what the trees would take as copies
+"""
+
+import argparse
+import glob
+import hashlib
+import logging
+import os
+import shutil
+import stat
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+OBJECTS_DIR = 'objects'
+TREE_GLOB = 'NEMSfv3gfs/gsl-develop-*'
+HASH_WORKERS = 8
+CHUNK = 4 * 1024 * 1024
+# Objects publish used more recently are never collected
+GRACE_SECONDS = 24 * 3600
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fname:
+        for chunk in iter(lambda: fname.read(CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def object_path(store_dir, hexdigest):
+    return os.path.join(store_dir, hexdigest[:2], hexdigest)
+
+
+def link_tree(src_dir, dest_dir):
+    ''' Make the directories of src_dir in dest_dir and move its
+        symbolic links there. Returns the other files, relative to
+        src_dir '''
+    files = []
+    for root, dirs, names in os.walk(src_dir):
+        rel_root = os.path.relpath(root, src_dir)
+        for name in list(dirs):
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path),
+                           os.path.join(dest_dir, rel_root, name))
+                os.remove(path)
+                dirs.remove(name)
+            else:
+                os.makedirs(os.path.join(dest_dir, rel_root, name),
+                            exist_ok=True)
+        for name in names:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path),
+                           os.path.join(dest_dir, rel_root, name))
+                os.remove(path)
+            else:
+                files.append(os.path.join(rel_root, name))
+    return files
+
+
+def store_file(src, obj):
+    ''' Move src into the store as obj, or drop it if the store has it.
+        Returns True if it was new '''
+    if os.path.exists(obj):
+        # keep collect off it until it is linked
+        os.utime(obj)
+        os.remove(src)
+        return False
+    os.makedirs(os.path.dirname(obj), exist_ok=True)
+    try:
+        os.rename(src, obj)
+    except OSError:
+        # the run directory is on another file system
+        shutil.copy2(src, obj)
+        os.remove(src)
+    # rename and copy2 keep the time the baseline file was written
+    os.utime(obj)
+    os.chmod(obj, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+    return True
+
+
+def remove_empty_dirs(top_dir):
+    ''' Remove the empty directories under top_dir, but not top_dir '''
+    for root, dirs, names in os.walk(top_dir, topdown=False):
+        if root != top_dir:
+            try:
+                os.rmdir(root)
+            except OSError:
+                pass
+
+
+def publish(src_dir, dest_dir, store_dir, workers=HASH_WORKERS):
+    ''' Move the files of src_dir to dest_dir as links into the store.
+        Returns (files, new bytes, bytes shared with the store) '''
+    logger = logging.getLogger('BLSTORE/PUBLISH')
+    files = link_tree(src_dir, dest_dir)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        hashes = list(executor.map(
+            lambda rel: file_hash(os.path.join(src_dir, rel)), files))
+    new_bytes = 0
+    shared_bytes = 0
+    for rel, hexdigest in zip(files, hashes):
+        src = os.path.join(src_dir, rel)
+        obj = object_path(store_dir, hexdigest)
+        size = os.path.getsize(src)
+        if store_file(src, obj):
+            new_bytes = new_bytes + size
+        else:
+            shared_bytes = shared_bytes + size
+        os.link(obj, os.path.join(dest_dir, rel))
+    # leave src_dir itself in place, as mv src_dir/* did
+    remove_empty_dirs(src_dir)
+    logger.info(f'{len(files)} files in {dest_dir}: {new_bytes} bytes new, '
+                f'{shared_bytes} bytes shared')
+    return len(files), new_bytes, shared_bytes
+
+
+def adopt(tree, store_dir, workers=HASH_WORKERS):
+    ''' Turn the files of a baseline tree made before the store into
+        links to store objects. Returns the bytes freed '''
+    files = [os.path.join(root, name)
+             for root, dirs, names in os.walk(tree) for name in names
+             if not os.path.islink(os.path.join(root, name))]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        hashes = list(executor.map(file_hash, files))
+    freed = 0
+    for path, hexdigest in zip(files, hashes):
+        obj = object_path(store_dir, hexdigest)
+        if os.path.exists(obj):
+            if os.path.samefile(obj, path):
+                continue
+            freed = freed + os.path.getsize(path)
+            tmp_path = f'{path}.blstore'
+            os.link(obj, tmp_path)
+            os.replace(tmp_path, path)
+        else:
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            os.link(path, obj)
+            os.chmod(obj, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+    return freed
+
+
+def collect(store_dir, dry_run=False):
+    ''' Remove objects that no baseline tree links to.
+        Returns (objects, bytes) removed '''
+    removed = 0
+    freed = 0
+    # publish touches the objects it uses; removing the trees of a
+    # prune changes their ctime but not their mtime
+    recent = time.time() - GRACE_SECONDS
+    for obj in glob.glob(os.path.join(store_dir, '??', '*')):
+        info = os.stat(obj)
+        if info.st_nlink == 1 and info.st_mtime < recent:
+            removed = removed + 1
+            freed = freed + info.st_size
+            if not dry_run:
+                os.remove(obj)
+    if not dry_run:
+        for sub_dir in glob.glob(os.path.join(store_dir, '??')):
+            try:
+                os.rmdir(sub_dir)
+            except OSError:
+                pass
+    return removed, freed
+
+
+def trees(base_dir):
+    ''' gsl-develop-<date> baseline trees, oldest first '''
+    return sorted(glob.glob(os.path.join(base_dir, TREE_GLOB)))
+
+
+def prune(base_dir, keep, dry_run=False):
+    old_trees = trees(base_dir)[:-keep] if keep > 0 else trees(base_dir)
+    for tree in old_trees:
+        print(f'{"Would remove" if dry_run else "Removing"} {tree}')
+        if not dry_run:
+            shutil.rmtree(tree)
+    removed, freed = collect(os.path.join(base_dir, OBJECTS_DIR), dry_run)
+    if dry_run:
+        print('Objects are only freed once their trees are removed')
+    print(f'Removed {removed} objects, {freed / 1e9:.1f} GB')
+
+
+def usage(base_dir):
+    store_dir = os.path.join(base_dir, OBJECTS_DIR)
+    stored = sum(os.path.getsize(obj) for obj in
+                 glob.glob(os.path.join(store_dir, '??', '*')))
+    for tree in trees(base_dir):
+        size = 0
+        for root, dirs, names in os.walk(tree):
+            size = size + sum(os.lstat(os.path.join(root, name)).st_size
+                              for name in names)
+        print(f'{os.path.basename(tree)}: {size / 1e9:.1f} GB as a copy')
+    print(f'Store: {stored / 1e9:.1f} GB')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Baseline store')
+    commands = parser.add_subparsers(dest='command', required=True)
+    prune_parser = commands.add_parser('prune')
+    prune_parser.add_argument('base_dir')
+    prune_parser.add_argument('--keep', type=int, default=3)
+    prune_parser.add_argument('--dry-run', action='store_true')
+    for command in ['adopt', 'usage']:
+        commands.add_parser(command).add_argument('base_dir')
+    args = parser.parse_args(argv)
+    if args.command == 'prune':
+        prune(args.base_dir, args.keep, args.dry_run)
+    elif args.command == 'adopt':
+        store_dir = os.path.join(args.base_dir, OBJECTS_DIR)
+        for tree in trees(args.base_dir):
+            freed = adopt(tree, store_dir)
+            print(f'{tree}: {freed / 1e9:.1f} GB freed')
+    else:
+        usage(args.base_dir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,235 @@
+"""
+Name: buildjobs.py
+Picks the parallelism of each build from the state of the login node,
+and keeps a running build from running the node out of memory.
+
+Before a build starts, the load average and MemAvailable are sampled
+and the memory that one compile of this app and compiler took in
+earlier builds is read from Buildmem.cfg. The build gets as many jobs as
+there are idle CPUs, going by the load average or by the jobs the other
+builds of this process were given if that is more, and as fit in the
+available memory less what those builds were given, through
+BUILD_JOBS, CMAKE_BUILD_PARALLEL_LEVEL and MAKEFLAGS.
+
+While it runs, the processes of the build (found by a variable in their
+environment) are sampled. If MemAvailable drops below the reserve, the
+newest compiles are stopped until memory is free again, so the build
+runs with fewer jobs rather than being killed. The peak memory of the
+build per job is recorded for the next build.
+
+Weather model builds are not governed: rt.sh compiles in batch jobs.
+
+Options from CImachine.cfg:
+  build_jobs_max     most jobs a build gets (default 16)
+  memory_reserve_gb  memory kept free on the node (default 4)
+"""
+
+import datetime
+import logging
+import os
+import signal
+import threading
+import uuid
+
+import failfast
+
+HIST_FILE = 'Buildmem.cfg'
+# Builds per app, machine and compiler the memory figures come from
+HIST_KEEP = 5
+# Memory of one compile when there is no history, MB
+DEFAULT_JOB_MB = 2000
+# A compile is assumed to take this much more than its recorded peak
+SAFETY = 1.25
+SAMPLE_SECONDS = 5
+# Stopped compiles continue once this many reserves are available, or
+# when nothing else of the build is running
+RESUME = 1.5
+MARKER = 'CI_BUILD_ID'
+PAGE_KB = os.sysconf('SC_PAGE_SIZE') // 1024
+
+# jobs and MB given to the builds running now, by build id
+_running = {}
+_lock = threading.Lock()
+
+
+def mem_available_mb():
+    with open('/proc/meminfo') as fname:
+        for line in fname:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) // 1024
+    return 0
+
+
+def history_key(job_obj):
+    app_name = job_obj.repo['app_address'].split('/')[1]
+    return f'{app_name}|{job_obj.machine}|{job_obj.compiler}'
+
+
+def read_history(file_name=HIST_FILE):
+    from configparser import ConfigParser as config_parser
+
+    config = config_parser()
+    if os.path.exists(file_name):
+        config.read(file_name)
+    return config
+
+
+def job_mb(job_obj):
+    ''' Largest recorded memory per job of the last builds '''
+    config = read_history()
+    key = history_key(job_obj)
+    if not config.has_section(key):
+        return DEFAULT_JOB_MB
+    values = [int(v) for v in config[key]['job_mb'].split()]
+    return max(values) if values else DEFAULT_JOB_MB
+
+
+def record(job_obj, peak_mb, jobs):
+    with _lock:
+        config = read_history()
+        key = history_key(job_obj)
+        if not config.has_section(key):
+            config[key] = {'job_mb': ''}
+        values = config[key]['job_mb'].split()
+        values.append(str(max(1, peak_mb // jobs)))
+        config[key]['job_mb'] = ' '.join(values[-HIST_KEEP:])
+        config[key]['date'] = datetime.datetime.now().strftime(
+            '%Y%m%d%H%M%S')
+        with open(HIST_FILE, 'w') as fname:
+            config.write(fname)
+
+
+def pick_jobs(job_obj, per_job_mb):
+    ''' Jobs for a build from idle CPUs and free memory, less what the
+        running builds were given '''
+    max_jobs = int(job_obj.machine_dict.get('build_jobs_max') or 16)
+    reserve_mb = int(float(job_obj.machine_dict.get('memory_reserve_gb')
+                           or 4) * 1024)
+    given_jobs = sum(jobs for jobs, mb in _running.values())
+    given_mb = sum(mb for jobs, mb in _running.values())
+    # the load average already counts running builds, but only after a
+    # while; the jobs handed out count them from the start. The larger
+    # of the two is used, adding them counts the builds twice
+    idle = (os.cpu_count() or 1) - max(os.getloadavg()[0], given_jobs)
+    free_mb = mem_available_mb() - reserve_mb - given_mb
+    fit = free_mb // int(per_job_mb * SAFETY)
+    return int(max(1, min(max_jobs, idle, fit)))
+
+
+def build_processes(build_id):
+    ''' {pid: (start time, RSS MB, parent pid)} of the build's processes '''
+    procs = {}
+    marker = f'{MARKER}={build_id}'.encode()
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/environ', 'rb') as fname:
+                if marker not in fname.read().split(b'\0'):
+                    continue
+            with open(f'/proc/{pid}/stat') as fname:
+                # the command name may hold spaces, fields follow ')'
+                fields = fname.read().rsplit(')', 1)[1].split()
+            with open(f'/proc/{pid}/statm') as fname:
+                rss_kb = int(fname.read().split()[1]) * PAGE_KB
+        except (OSError, IndexError, ValueError):
+            continue
+        procs[int(pid)] = (int(fields[19]), rss_kb // 1024, int(fields[1]))
+    return procs
+
+
+class Monitor(threading.Thread):
+    '''
+    Samples the memory of a running build and stops its newest compiles
+    while the node is short of memory
+    ...
+
+    Attributes
+    ----------
+    peak_mb : int
+      Largest memory the build's processes held together
+    paused : int
+      Most compiles stopped at once
+    '''
+
+    def __init__(self, build_id, reserve_mb):
+        super().__init__(daemon=True)
+        self.build_id = build_id
+        self.reserve_mb = reserve_mb
+        self.peak_mb = 0
+        self.paused = 0
+        self._stopped = []
+        self._done = threading.Event()
+
+    def run(self):
+        logger = logging.getLogger('BUILDJOBS/MONITOR')
+        while not self._done.wait(SAMPLE_SECONDS):
+            procs = build_processes(self.build_id)
+            self.peak_mb = max(self.peak_mb,
+                               sum(p[1] for p in procs.values()))
+            available = mem_available_mb()
+            self._stopped = [pid for pid in self._stopped if pid in procs]
+            parents = {p[2] for p in procs.values()}
+            running = sorted((p[0], pid) for pid, p in procs.items()
+                             if pid not in parents and
+                             pid not in self._stopped)
+            if available < self.reserve_mb and len(running) > 1:
+                # stop the newest compile, the oldest keeps running
+                pid = running[-1][1]
+                logger.info(f'{available} MB available, stopping {pid}')
+                self.signal(pid, signal.SIGSTOP)
+                self._stopped.append(pid)
+                self.paused = max(self.paused, len(self._stopped))
+            elif self._stopped and (not running or
+                                    available > RESUME * self.reserve_mb):
+                pid = self._stopped.pop(0)
+                logger.info(f'{available} MB available, continuing {pid}')
+                self.signal(pid, signal.SIGCONT)
+
+    def signal(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        for pid in self._stopped:
+            self.signal(pid, signal.SIGCONT)
+
+
+def run_logged(job_obj, logger, command, in_cwd, log_name):
+    ''' failfast.run_logged with the build's jobs picked for the node '''
+    if job_obj.harness_active():
+        return failfast.run_logged(job_obj, logger, command, in_cwd,
+                                   log_name)
+    build_id = uuid.uuid4().hex
+    per_job_mb = job_mb(job_obj)
+    with _lock:
+        jobs = pick_jobs(job_obj, per_job_mb)
+        _running[build_id] = (jobs, int(jobs * per_job_mb))
+    reserve_mb = int(float(job_obj.machine_dict.get('memory_reserve_gb')
+                           or 4) * 1024)
+    logger.info(f'Building with {jobs} jobs, about {per_job_mb} MB each')
+    saved_env = job_obj.command_env
+    job_obj.command_env = dict(saved_env or os.environ)
+    job_obj.command_env.update({MARKER: build_id, 'BUILD_JOBS': str(jobs),
+                                'CMAKE_BUILD_PARALLEL_LEVEL': str(jobs),
+                                'MAKEFLAGS': f'-j{jobs}'})
+    monitor = Monitor(build_id, reserve_mb)
+    monitor.start()
+    try:
+        return failfast.run_logged(job_obj, logger, command, in_cwd,
+                                   log_name)
+    finally:
+        monitor.stop()
+        job_obj.command_env = saved_env
+        with _lock:
+            del _running[build_id]
+        if monitor.peak_mb:
+            record(job_obj, monitor.peak_mb, jobs)
+        paused = f', up to {monitor.paused} compiles paused for memory' \
+            if monitor.paused else ''
+        job_obj.comment_append(f'Built with {jobs} jobs, peak memory '
+                               f'{monitor.peak_mb / 1024:.1f} GB{paused}')
@@ -9,16 +9,74 @@ code managers at NOAA-EMC
 
 This script should be started through start_ci_py_pro.sh so that
 env vars and Python paths are set up prior to start.
-"""
-from github import Github as gh
 
+PyGithub, configparser and the job modules are imported only when they
+are needed, so a run where pollmark finds nothing new exits quickly.
+"""
+import asyncio
 import datetime
 import subprocess
 import re
 import os
 import logging
-from configparser import ConfigParser as config_parser
+import signal
 import importlib
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+
+import digest
+import jobstate
+import pollmark
+import prefetch
+import runlock
+
+# Map each approved action to the job module that runs it.
+# Both SRWA build and WE2E tests call the same module build.py,
+# GSI regression tests call regr.py, and the Weather Model
+# calls rt or bl (UC in tag, lc in program name). rerun runs only the
+# failed tests of a PR's last run again
+JOB_MODULES = {
+    'build': 'jobs.build',
+    'WE': 'jobs.build',
+    'rt': 'jobs.regr',
+    'BL': 'jobs.bl',
+    'RT': 'jobs.rt',
+    'rerun': 'jobs.rerun',
+}
+
+# ci-<machine>-all-<action> builds and tests every compiler from one clone
+MATRIX_COMPILER = 'all'
+MATRIX_MODULES = {
+    'build': 'jobs.matrix',
+    'RT': 'jobs.matrix',
+}
+
+_loaded_job_modules = {}
+
+# seconds to read what a killed command wrote; a process that left its
+# process tree may hold the output open after the kill
+KILL_GRACE = 60
+
+# discovery=delta: GitHub search queries are at most this long, and each
+# search starts this many seconds before the previous one did
+SEARCH_QUERY_LIMIT = 256
+CURSOR_OVERLAP = 300
+
+# Phases for timeout_<phase> in CImachine.cfg, the first pattern
+# found in a command sets its phase, otherwise timeout_default is used
+PHASE_PATTERNS = [
+    ('clone', 'git clone'),
+    ('submodules', 'git submodule'),
+    ('externals', 'checkout_externals'),
+    ('we2e', 'setup_WE2E_tests.sh'),
+    ('rt', 'rt.sh'),
+    ('ctest', 'ctest'),
+    ('build', 'build.sh'),
+]
+
+# Set to a replay.Recorder or replay.Replayer to record or replay
+# GitHub responses and command results (see replay.py)
+harness = None
 
 
 class GHInterface:
@@ -35,6 +93,8 @@ class GHInterface:
     '''
 
     def __init__(self):
+        from github import Github as gh
+
         self.logger = logging.getLogger('GHINTERFACE')
 
         filename = 'accesstoken'
@@ -55,6 +115,27 @@ class GHInterface:
             raise (e)
 
 
+def validate_job_modules(actions):
+    ''' Check once that every approved action maps to a job module
+        that can be found, without importing any of them '''
+    missing = [action for action in actions if action not in JOB_MODULES]
+    if missing:
+        raise KeyError(f'No job module registered for actions {missing}')
+    for module in [JOB_MODULES[action] for action in actions] + \
+            list(MATRIX_MODULES.values()):
+        if importlib.util.find_spec(module) is None:
+            raise ModuleNotFoundError(f'Job module {module} not found')
+
+
+def get_job_module(action, compiler=None):
+    ''' Import the job module for an action the first time it is used '''
+    modules = MATRIX_MODULES if compiler == MATRIX_COMPILER else JOB_MODULES
+    if modules[action] not in _loaded_job_modules:
+        _loaded_job_modules[modules[action]] = \
+            importlib.import_module(modules[action])
+    return _loaded_job_modules[modules[action]]
+
+
 def set_action_from_label(machine, actions, label):
     ''' Match the label that initiates a job with an action in the dict
         Labels have a ci- prefix'''
@@ -70,40 +151,222 @@ def set_action_from_label(machine, actions, label):
     # check machine name matches
     if not re.match(label_machine, machine):
         return False, False
-    # Compiler must be intel or gnu
-    if not str(label_compiler) in ["intel", "gnu"]:
+    # Compiler must be intel or gnu, or all of them for a matrix action
+    if not str(label_compiler) in ["intel", "gnu", MATRIX_COMPILER]:
         return False, False
     logger.info(f'Setting action from Label {label}')
     action_match = next((action for action in actions
                          if re.match(action, label_action)), False)
+    if label_compiler == MATRIX_COMPILER and \
+       action_match not in MATRIX_MODULES:
+        logger.info(f'Action {action_match} cannot run for all compilers')
+        return False, False
 
     return label_compiler, action_match
 
 
-def get_preqs_with_actions(repos, machine_dict, ghinterface_obj, actions):
-    ''' Create list of dictionaries of a pull request
-        and its machine label and action '''
-    logger = logging.getLogger('GET_PREQS_WITH_ACTIONS')
-    logger.info('Getting Pull Requests with Actions')
-    jobs = []
+def fetch_preq_labels(repos, ghinterface_obj):
+    ''' Serial discovery: list of (repo, [(pr, labels)]) in config order '''
+    repo_preqs = []
     for repo in repos:
         gh_preqs = [ghinterface_obj.client.get_repo(repo['address'])
                                    .get_pulls(state='open', sort='created',
                                               base=repo['base'])]
 
         each_pr = [preq for gh_preq in gh_preqs for preq in gh_preq]
-        preq_labels = [{'preq': pr, 'label': label} for pr in each_pr
-                       for label in pr.get_labels()]
+        repo_preqs.append((repo, [(pr, list(pr.get_labels()))
+                                  for pr in each_pr]))
+    return repo_preqs
+
+
+async def _fetch_repo_preqs(loop, executor, client, repo):
+    ''' Fetch the open PRs of one repo, all pages at once. The labels
+        come with each PR in the listing '''
+    gh_repo = await loop.run_in_executor(executor, client.get_repo,
+                                         repo['address'])
+    pulls = gh_repo.get_pulls(state='open', sort='created',
+                              base=repo['base'])
+    if hasattr(pulls, 'get_page'):
+        # a paginated list: one request for the count, then every page
+        total = await loop.run_in_executor(executor,
+                                           lambda: pulls.totalCount)
+        num_pages = -(-total // client.per_page)
+        pages = await asyncio.gather(*[
+            loop.run_in_executor(executor, pulls.get_page, page)
+            for page in range(num_pages)])
+        each_pr = [pr for page in pages for pr in page]
+    else:
+        each_pr = list(pulls)
+    return repo, [(pr, list(pr.labels)) for pr in each_pr]
+
+
+def fetch_preq_labels_async(repos, ghinterface_obj, workers):
+    ''' Concurrent discovery with at most workers requests in flight.
+        Returns the same list as fetch_preq_labels '''
+    loop = asyncio.new_event_loop()
+    executor = ThreadPoolExecutor(max_workers=workers)
+
+    async def fetch_all():
+        return await asyncio.gather(*[
+            _fetch_repo_preqs(loop, executor, ghinterface_obj.client, repo)
+            for repo in repos])
+
+    try:
+        return loop.run_until_complete(fetch_all())
+    finally:
+        executor.shutdown(wait=True)
+        loop.close()
+
+
+def ci_labels(machine_dict, actions):
+    ''' Every label that can start a job on this machine '''
+    labels = [f'ci-{machine_dict["machine"]}-{compiler}-{action}'
+              for compiler in machine_dict['compilers']
+              for action in actions]
+    labels += [f'ci-{machine_dict["machine"]}-{MATRIX_COMPILER}-{action}'
+               for action in actions if action in MATRIX_MODULES]
+    return labels
+
+
+def label_queries(address, labels, since):
+    ''' Search queries for the open PRs of a repo that carry any of the
+        labels and were updated since. Labels are split over queries
+        to stay within GitHub's 256 character limit '''
+    base = f'repo:{address} is:pr is:open'
+    if since:
+        base = f'{base} updated:>={since}'
+    queries = []
+    chunk = []
+    for label in labels:
+        query = f'{base} label:{",".join(chunk + [label])}'
+        if chunk and len(query) > SEARCH_QUERY_LIMIT:
+            queries.append(f'{base} label:{",".join(chunk)}')
+            chunk = []
+        chunk.append(label)
+    if chunk:
+        queries.append(f'{base} label:{",".join(chunk)}')
+    return queries
+
+
+def fetch_preq_labels_delta(repos, ghinterface_obj, labels, since):
+    ''' Discovery through the search API: only PRs with one of labels
+        that were updated since the cursor. Returns the same list as
+        fetch_preq_labels '''
+    logger = logging.getLogger('FETCH_PREQ_LABELS_DELTA')
+    repo_preqs = []
+    for address in dict.fromkeys(repo['address'] for repo in repos):
+        preqs = {}
+        for query in label_queries(address, labels, since):
+            logger.info(f'Searching: {query}')
+            for issue in ghinterface_obj.client.search_issues(query):
+                if issue.number not in preqs:
+                    preqs[issue.number] = (issue.as_pull_request(),
+                                           list(issue.labels))
+        logger.info(f'{address}: {len(preqs)} labeled PRs since {since}')
+        # one entry per CIrepos.cfg section, on its base branch
+        for repo in repos:
+            if repo['address'] == address:
+                repo_preqs.append((repo, [
+                    (pr, pr_labels) for pr, pr_labels in preqs.values()
+                    if pr.base.ref == repo['base']]))
+    return repo_preqs
+
+
+def get_preqs_with_actions(repos, machine_dict, ghinterface_obj, actions):
+    ''' Create a list of JobSpec, one for each pull request label
+        that starts an action on this machine '''
+    logger = logging.getLogger('GET_PREQS_WITH_ACTIONS')
+    logger.info('Getting Pull Requests with Actions')
+    workers = int(machine_dict.get('discovery_workers', 1))
+    if machine_dict.get('discovery') == 'delta':
+        repo_preqs = fetch_preq_labels_delta(repos, ghinterface_obj,
+                                             machine_dict['ci_labels'],
+                                             machine_dict.get('cursor'))
+    elif workers > 1:
+        repo_preqs = fetch_preq_labels_async(repos, ghinterface_obj, workers)
+    else:
+        repo_preqs = fetch_preq_labels(repos, ghinterface_obj)
+    if prefetch.enabled(machine_dict) and harness is None:
+        prefetch.write_candidates(machine_dict, repo_preqs)
+
+    specs = []
+    for repo, preqs in repo_preqs:
+        preq_labels = [{'preq': pr, 'label': label} for pr, labels in preqs
+                       for label in labels]
 
         for pr_label in preq_labels:
             compiler, match = set_action_from_label(machine_dict['machine'],
                                                     actions, pr_label['label'])
             if match:
-                pr_label['action'] = match
-                jobs.append(Job(pr_label.copy(), ghinterface_obj,
-                                machine_dict, compiler, repo))
+                specs.append(JobSpec(pr_label['preq'], pr_label['label'].name,
+                                     machine_dict, compiler, match, repo))
 
-    return jobs
+    return specs
+
+
+class JobSpec:
+    '''
+    Small description of one job, enough to rebuild it anywhere.
+    It can be pickled, for example to run the job in another process
+    with run_job_spec. No PyGithub object is kept: the pull request is
+    fetched again when the job is made, so queued specs stay small.
+    ...
+
+    Attributes
+    ----------
+    address : str
+      The repo the pull request is on
+    number : int
+      The pull request number
+    head_repo, head_ref, head_sha : str
+      The head of the pull request when it was found
+    label : str
+      Name of the label that starts the job
+    machine, compiler, action : str
+      What to run, from the label
+    machine_dict, repo : dict
+      The CImachine.cfg settings and the CIrepos.cfg section, shared
+      by all the jobs of a run
+    '''
+
+    __slots__ = ('address', 'number', 'head_repo', 'head_ref', 'head_sha',
+                 'label', 'machine', 'compiler', 'action', 'machine_dict',
+                 'repo')
+
+    def __init__(self, preq, label, machine_dict, compiler, action, repo):
+        self.address = repo['address']
+        self.number = preq.number
+        self.head_repo = preq.head.repo.full_name if preq.head.repo else None
+        self.head_ref = preq.head.ref
+        self.head_sha = preq.head.sha
+        self.label = label
+        self.machine = machine_dict['machine']
+        self.compiler = compiler
+        self.action = action
+        self.machine_dict = machine_dict
+        self.repo = repo
+
+    def __repr__(self):
+        return f'JobSpec({self.address}#{self.number} {self.label})'
+
+    def pull_request(self, ghinterface_obj):
+        ''' The PyGithub pull request, fetched from GitHub '''
+        return ghinterface_obj.client.get_repo(self.address) \
+                                     .get_pull(self.number)
+
+    def to_job(self, ghinterface_obj):
+        preq_dict = {'preq': self.pull_request(ghinterface_obj),
+                     'label': self.label, 'action': self.action}
+        return Job(preq_dict, ghinterface_obj, self.machine_dict,
+                   self.compiler, self.repo)
+
+
+def run_job_spec(spec):
+    ''' Run a job from its JobSpec in a worker process, with its own
+        GitHub connection. Returns True if the job was deferred '''
+    job = spec.to_job(GHInterface())
+    job.run()
+    return job.deferred
 
 
 class Job:
@@ -127,30 +390,45 @@ class Job:
                  repo):
         self.logger = logging.getLogger('JOB')
         self.preq_dict = preq_dict
-        # both SRWA build and WE2E tests call same module build.py
-        # GSI regression tests call regr.py
-
-        # Weather Model can call rt or bl (UC in tag, lc in program name)
-        if self.preq_dict["action"] == "rt":
-            self.job_mod = importlib.import_module('jobs.regr')
-        elif self.preq_dict["action"] == "BL":
-            self.job_mod = importlib.import_module('jobs.bl')
-        elif self.preq_dict["action"] == "RT":
-            self.job_mod = importlib.import_module('jobs.rt')
-        else:
-            self.job_mod = importlib.import_module('jobs.build')
         self.ghinterface_obj = ghinterface_obj
         self.machine = machine_dict['machine']
         self.compiler = compiler
         self.repo = repo
         self.hpc_acc = machine_dict['hpc_acc']
         self.workdir = machine_dict['workdir']
+        # optional settings from CImachine.cfg used by the job modules
+        self.machine_dict = machine_dict
         self.comment_text = ''
         self.failed_tests = []
+        self.deferred = False
+        # environment for commands, see modenv.py
+        self.command_env = None
+        # phase results once checkpointed, see jobstate.py
+        self.resumed = None
+        # log lines found by the job modules, see digest.py
+        self.digest = digest.Digest()
+        # the job's clone directory, set by the job modules
+        self.run_dir = None
+        # the PR commit in that clone, see tested_sha
+        self.head_sha = None
+        # node-local directory of a staged clone and build, see stage.py
+        self.stage_root = None
+
+    @property
+    def job_mod(self):
+        ''' Job module for this action, see JOB_MODULES '''
+        return get_job_module(self.preq_dict["action"], self.compiler)
 
     def comment_append(self, newtext):
         self.comment_text += f'{newtext}\n'
 
+    def finding(self, category, line):
+        ''' A log line for the findings digest rather than the comment '''
+        if self.digest.path is None:
+            self.digest.path = os.path.join(self.run_dir or self.workdir,
+                                            digest.DIGEST_FILE)
+        self.digest.add(f'{self.compiler} {category}', line)
+
     def remove_pr_label(self):
         ''' Removes the PR label that initiated the job run from PR '''
         self.logger.info(f'Removing Label: {self.preq_dict["label"]}')
@@ -172,58 +450,161 @@ class Job:
         for command, in_cwd in commands_with_cwd:
             logger.info(f'Running `{command}`')
             logger.info(f'in location "{in_cwd}"')
-            try:
-                output = subprocess.Popen(command, shell=True, cwd=in_cwd,
-                                          stdout=subprocess.PIPE,
-                                          stderr=subprocess.STDOUT)
-            except Exception as e:
-                self.job_failed(logger, 'subprocess.Popen', exception=e)
+            if harness is not None:
+                harness.run_command(self, logger, command, in_cwd)
             else:
+                self.run_subprocess(logger, command, in_cwd)
+
+    def harness_active(self):
+        ''' True when commands are recorded or replayed, see replay.py '''
+        return harness is not None
+
+    def clone_sha(self, pr_repo_loc):
+        ''' The commit of the PR's own repo in the clone at pr_repo_loc:
+            the app clone itself, or the section of Externals.cfg that
+            points at the PR head for a workflow PR. None if unknown '''
+        from configparser import ConfigParser as config_parser
+
+        preq = self.preq_dict['preq']
+        if self.harness_active():
+            return preq.head.sha
+        if preq.head.repo.name != self.repo['app_address'].split('/')[1]:
+            config = config_parser()
+            config.read(os.path.join(pr_repo_loc, 'Externals.cfg'))
+            return config.get(preq.head.repo.name, 'hash', fallback=None)
+        output = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                                cwd=pr_repo_loc, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL)
+        return output.stdout.decode('utf8').strip() or None
+
+    def tested_sha(self):
+        ''' The commit the job tested. A push after the PR was read is
+            in a branch clone, so the clone is asked, not the PR '''
+        if self.head_sha is None:
+            app_name = self.repo['app_address'].split('/')[1]
+            if self.run_dir and os.path.isdir(f'{self.run_dir}/{app_name}'):
+                self.head_sha = self.clone_sha(f'{self.run_dir}/{app_name}')
+            self.head_sha = self.head_sha or self.preq_dict['preq'].head.sha
+        return self.head_sha
+
+    def command_timeout(self, command):
+        ''' Timeout in seconds for the phase a command belongs to '''
+        timeouts = self.machine_dict.get('timeouts', {})
+        phase = next((phase for phase, pattern in PHASE_PATTERNS
+                      if pattern in command), 'default')
+        return timeouts.get(phase, timeouts.get('default'))
+
+    def kill_process_tree(self, logger, process):
+        ''' Stop a command and everything it started '''
+        for sig, wait in [(signal.SIGTERM, 30), (signal.SIGKILL, 30)]:
+            try:
+                os.killpg(process.pid, sig)
+            except ProcessLookupError:
+                return
+            try:
+                process.wait(timeout=wait)
+                return
+            except subprocess.TimeoutExpired:
+                logger.info(f'Process group {process.pid} ignored {sig}')
+
+    def run_subprocess(self, logger, command, in_cwd):
+        ''' Run one shell command, returns its returncode and output lines '''
+        out, err = [], None
+        timeout = self.command_timeout(command)
+        try:
+            # own session so a timeout can kill the whole process tree
+            output = subprocess.Popen(command, shell=True, cwd=in_cwd,
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.STDOUT,
+                                      env=self.command_env,
+                                      start_new_session=True)
+        except Exception as e:
+            self.job_failed(logger, 'subprocess.Popen', exception=e)
+            return None, out
+        try:
+            try:
+                out, err = output.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                self.kill_process_tree(logger, output)
                 try:
-                    out, err = output.communicate()
-                    out = [] if not out else out.decode('utf8').split('\n')
-                    logger.info(out)
-                    if output.returncode != 0:
-                        err_msg = "Nonzero returncode: " + str(output.returncode)
-                        raise Exception(err_msg)
-                except Exception as e:
-                    err = [] if not err else err.decode('utf8').split('\n')
-                    self.job_failed(logger, f'Command {command}', exception=e,
-                                    STDOUT=True, out=out, err=err)
-                else:
-                    logger.info(f'Finished running: {command}')
+                    out, err = output.communicate(timeout=KILL_GRACE)
+                except subprocess.TimeoutExpired:
+                    logger.info('Output still open after the kill')
+                    output.stdout.close()
+                self.comment_append(f'Timed out after {timeout}s: {command}')
+                raise Exception(f'Timed out after {timeout}s')
+            finally:
+                out = [] if not out else out.decode('utf8').split('\n')
+            logger.info(out)
+            if output.returncode != 0:
+                err_msg = "Nonzero returncode: " + str(output.returncode)
+                raise Exception(err_msg)
+        except Exception as e:
+            err = [] if not err else err.decode('utf8').split('\n')
+            self.job_failed(logger, f'Command {command}', exception=e,
+                            STDOUT=True, out=out, err=err)
+        else:
+            logger.info(f'Finished running: {command}')
+        return output.returncode, out
 
     def run(self):
+        import admission
+
         logger = logging.getLogger('JOB/RUN')
         logger.info(f'Starting Job: {self.preq_dict["label"]}')
-        self.comment_append(newtext=f'Machine: {self.machine}')
-        self.comment_append(f'Compiler: {self.compiler}')
-        self.comment_append(f'Job: {self.preq_dict["action"]}')
-        if self.check_label_before_job_start():
-            try:
-                logger.info('Calling remove_pr_label')
-                self.remove_pr_label()
-                logger.info('Calling Job to Run')
-                self.job_mod.run(self)
-            except Exception:
-                self.job_failed(logger, 'run()')
-                logger.info('Sending comment text')
-                issue_id = self.send_comment_text()
-                logger.debug(f'Issue comment id is {issue_id}')
+        logger.info(f'Pull request: {self.repo["address"]}'
+                    f'#{self.preq_dict["preq"].number}')
+        if self.resumed is not None:
+            # the label was removed when the interrupted run started
+            logger.info('Resuming interrupted job')
+            self.run_job(logger, admission, remove_label=False)
+        elif self.check_label_before_job_start():
+            self.comment_append(newtext=f'Machine: {self.machine}')
+            self.comment_append(f'Compiler: {self.compiler}')
+            self.comment_append(f'Job: {self.preq_dict["action"]}')
+            admitted, reason = admission.admit(self)
+            if not admitted:
+                # label stays on the PR so a later cycle retries the job
+                logger.info(f'Deferring job: {reason}')
+                self.deferred = True
+                return
+            jobstate.start(self)
+            self.run_job(logger, admission)
         else:
             logger.info(f'Cannot find label {self.preq_dict["label"]}')
 
+    def run_job(self, logger, admission, remove_label=True):
+        start = datetime.datetime.now()
+        try:
+            if remove_label:
+                logger.info('Calling remove_pr_label')
+                self.remove_pr_label()
+            logger.info('Calling Job to Run')
+            self.job_mod.run(self)
+        except Exception:
+            self.job_failed(logger, 'run()')
+            logger.info('Sending comment text')
+            issue_id = self.send_comment_text()
+            logger.debug(f'Issue comment id is {issue_id}')
+        jobstate.finish(self)
+        admission.record_usage(self, start, datetime.datetime.now())
+
     def send_comment_text(self):
         logger = logging.getLogger('JOB/SEND_COMMENT_TEXT')
         logger.info(f'Comment Text: {self.comment_text}')
+        budget = int(self.machine_dict.get('comment_bytes') or
+                     digest.COMMENT_BYTES)
+        # room for the lines below
+        self.comment_text += self.digest.render(
+            budget - len(self.comment_text.encode('utf8')) - 200)
         self.comment_append('If test failed, please make changes and add '
                             'the following label back:')
         self.comment_append(f'ci-{self.machine}'
                             f'-{self.compiler}'
                             f'-{self.preq_dict["action"]}')
 
-        issue_id = \
-            self.preq_dict['preq'].create_issue_comment(self.comment_text)
+        issue_id = self.preq_dict['preq'].create_issue_comment(
+            digest.fit(self.comment_text, budget))
         return (issue_id)
 
     def job_failed(self, logger, job_name, exception=Exception, STDOUT=False,
@@ -236,6 +617,8 @@ class Job:
 
 
 def setup_env():
+    from configparser import ConfigParser as config_parser
+
     logger = logging.getLogger('SETUP')
 
     config = config_parser()
@@ -254,6 +637,27 @@ def setup_env():
         machine_dict['machine'] = config['DEFAULT']['machine']
         machine_dict['hpc_acc'] = config['DEFAULT']['hpc_acc']
         machine_dict['workdir'] = config['DEFAULT']['workdir']
+        # Optional settings
+        machine_dict['submodule_jobs'] = \
+            config['DEFAULT'].get('submodule_jobs', '8')
+        machine_dict['submodule_fetch'] = \
+            config['DEFAULT'].get('submodule_fetch', 'blobless')
+        machine_dict['discovery_workers'] = \
+            config['DEFAULT'].get('discovery_workers', '8')
+        for option in ['budget_repo_day', 'budget_day', 'queue_limit',
+                       'queue_command', 'usage_command', 'ctest_jobs',
+                       'rt_shards', 'prefetch_gb', 'prefetch_days',
+                       'comment_bytes', 'discovery', 'fail_fast',
+                       'fatal_patterns', 'ccache', 'ccache_dir', 'ccache_gb',
+                       'stage_dir', 'stage_workers', 'build_jobs_max',
+                       'memory_reserve_gb', 'warm_workers']:
+            machine_dict[option] = config['DEFAULT'].get(option, '')
+        machine_dict['compilers'] = \
+            config['DEFAULT'].get('compilers', 'intel gnu').split()
+        machine_dict['timeouts'] = {
+            option[len('timeout_'):]: int(value)
+            for option, value in config['DEFAULT'].items()
+            if option.startswith('timeout_') and int(value) > 0}
 
     if not os.path.exists(machine_dict['workdir']):
         raise KeyError(f'Work directory from config file '
@@ -283,13 +687,58 @@ def setup_env():
 
     # Approved Actions
 
-    action_list = ['build', 'WE', 'rt', 'BL', 'RT']
+    action_list = ['build', 'WE', 'rt', 'BL', 'RT', 'rerun']
+    validate_job_modules(action_list)
+    machine_dict['ci_labels'] = ci_labels(machine_dict, action_list)
 
     return machine_dict, repo_dict, action_list
 
 
-def main():
+def record(ghinterface_obj, machine_dict, repos, actions):
+    ''' CI_RECORD=<file> saves this run as a scenario for replay.py '''
+    global harness
+
+    record_file = os.environ.get('CI_RECORD')
+    if record_file:
+        import replay
+        harness = replay.Recorder(machine_dict, repos, actions)
+        ghinterface_obj.client = harness.wrap_client(ghinterface_obj.client)
+    return record_file
+
+
+def run_jobs(ghinterface_obj, repos, machine_dict, actions):
+    ''' Resume interrupted jobs, then run the new ones. Returns True
+        if a job was deferred '''
+    logger = logging.getLogger('MAIN/RUN_JOBS')
+    # get all pull requests from the GitHub object
+    # and turn them into Job objects
+    logger.info('Getting all pull requests, '
+                'labels and actions applicable to this machine.')
+    resumed = jobstate.resume_jobs(repos, machine_dict, ghinterface_obj, Job)
+    specs = get_preqs_with_actions(repos, machine_dict,
+                                   ghinterface_obj, actions)
+    deferred = False
+    for job in resumed:
+        job.run()
+    # one Job, with its GitHub objects, exists at a time
+    for spec in specs:
+        job = spec.to_job(ghinterface_obj)
+        job.run()
+        deferred = deferred or job.deferred
+    return deferred
+
+
+def save_marks(machine_dict, etags, cursor, deferred):
+    ''' Only a completed poll may mark these repos as seen,
+        deferred jobs need a full poll next cycle '''
+    if deferred:
+        etags = {}
+    elif machine_dict.get('discovery') == 'delta':
+        pollmark.write_cursor(cursor)
+    pollmark.write_marks(etags)
+
 
+def main():
     # handle logging
     log_filename = f'ci_auto_'\
                    f'{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}.log'
@@ -298,23 +747,52 @@ def main():
     logger = logging.getLogger('MAIN')
     logger.info('Starting Script')
 
+    # quit before the heavy imports if no watched repo has changed
+    # and no interrupted job is waiting to be resumed
+    changed, etags = pollmark.poll()
+    if not changed and not os.path.exists(jobstate.STATE_FILE):
+        logger.info('Nothing changed since last poll')
+        logger.info('Script Finished')
+        return
+
     # setup environment
     logger.info('Getting the environment setup')
     machine_dict, repos, actions = setup_env()
-
-    # setup interface with GitHub
-    logger.info('Setting up GitHub interface.')
-    ghinterface_obj = GHInterface()
-
-    # get all pull requests from the GitHub object
-    # and turn them into Job objects
-    logger.info('Getting all pull requests, '
-                'labels and actions applicable to this machine.')
-    jobs = get_preqs_with_actions(repos, machine_dict,
-                                  ghinterface_obj, actions)
-    [job.run() for job in jobs]
-
-    logger.info('Script Finished')
+    if not etags:
+        etags = pollmark.current_etags([repo['address'] for repo in repos])
+
+    # only one ci_auto.py at a time may work on this workdir
+    run_lock = runlock.RunLock(machine_dict['workdir'])
+    if not run_lock.acquire():
+        logger.info(f'{run_lock.path} is held by another run. Exiting.')
+        logger.info('Script Finished')
+        return
+    try:
+        # setup interface with GitHub
+        logger.info('Setting up GitHub interface.')
+        ghinterface_obj = GHInterface()
+        record_file = record(ghinterface_obj, machine_dict, repos, actions)
+
+        # delta discovery looks from the last complete search, with some
+        # overlap for PRs updated while that search ran
+        machine_dict['cursor'] = pollmark.read_cursor()
+        cursor = (datetime.datetime.now(datetime.timezone.utc) -
+                  datetime.timedelta(seconds=CURSOR_OVERLAP)) \
+            .strftime('%Y-%m-%dT%H:%M:%SZ')
+        deferred = run_jobs(ghinterface_obj, repos, machine_dict, actions)
+
+        # warm checkouts of other open PRs for later jobs
+        if prefetch.enabled(machine_dict) and harness is None:
+            prefetch.spawn(machine_dict)
+
+        if record_file:
+            harness.save(record_file)
+            logger.info(f'Recorded scenario in {record_file}')
+
+        save_marks(machine_dict, etags, cursor, deferred)
+        logger.info('Script Finished')
+    finally:
+        run_lock.release()
 
 
 if __name__ == '__main__':
@@ -6,14 +6,16 @@ returns status information.
 
 This script should be started through start_ci_py_pro.sh so that
 env vars and Python paths are set up prior to start.
-"""
 
-from github import Github as gh
+PyGithub and configparser are only imported once Longjob.cfg is found,
+so a run with no experiments being tracked exits quickly.
+"""
 
 import datetime
 import os
 import logging
-from configparser import ConfigParser as config_parser
+
+import flaky
 
 
 class GHInterface:
@@ -30,6 +32,8 @@ class GHInterface:
     '''
 
     def __init__(self):
+        from github import Github as gh
+
         self.logger = logging.getLogger('GHINTERFACE')
 
         filename = 'accesstoken'
@@ -60,19 +64,21 @@ def main():
     logger = logging.getLogger('MAIN')
     logger.info('Starting Script')
 
-    # setup interface with GitHub
-    logger.info('Setting up GitHub interface.')
-    ghinterface_obj = GHInterface()
-
-    config = config_parser()
-
     # Read file that has info on uncompleted tests
 
     file_name = 'Longjob.cfg'
     if not os.path.exists(file_name):
         logger.info(f'Could not find {file_name}. Exiting.')
+        logger.info('Script Finished')
         quit()
 
+    from configparser import ConfigParser as config_parser
+
+    # setup interface with GitHub
+    logger.info('Setting up GitHub interface.')
+    ghinterface_obj = GHInterface()
+
+    config = config_parser()
     config.read(file_name)
     num_sections = len(config.sections())
     logger.info(f'Experiments running: {num_sections}')
@@ -84,11 +90,13 @@ def main():
 
     pr_comment = ''
     for ci_log in config.sections():
-        logger.info(f'{ci_log}: {config[ci_log]["pr_repo"]}')
+        logger.info(f'{ci_log}: {config[ci_log]["pr_repo"]}'
+                    f'#{config[ci_log]["pr_num"]}')
         if os.path.exists(ci_log):
             expt_done = False
             expt = config[ci_log]["expt"]
             machine = config[ci_log]["machine"]
+            compiler = config[ci_log].get("compiler", "")
             pr_num = int(config[ci_log]["pr_num"])
             issue_id = int(config[ci_log]["issue_id"])
             repo = ghinterface_obj.client.get_repo(config[ci_log]["pr_repo"])
@@ -106,12 +114,22 @@ def main():
                         newtext = f'Experiment {expt_string} '
                         pr_comment += f'{newtext}'
                         newtext = f'on {machine}: {expt}'
+                        if expt_string == "Failed" and flaky.is_flaky(
+                                flaky.read_history(), 'we2e', expt,
+                                machine, compiler):
+                            newtext += ' (known flaky)'
                         pr_comment += f'{newtext}\n'
                         if expt_string == "Failed":
                             newtext = f'{line.rstrip()}'
                             pr_comment += f'{newtext}\n'
                         logger.info(f'Experiment {expt_string}: {expt}')
+                        expt_passed = expt_string == "Succeeded"
             if expt_done:
+                # sections written before the sha was kept fall back to
+                # the PR head
+                sha = config[ci_log].get("sha") or pr.head.sha
+                flaky.record_results('we2e', {expt: expt_passed}, machine,
+                                     compiler, sha)
                 expt_done_count = expt_done_count + 1
                 config.remove_section(ci_log)
     logger.info(f'Experiments Completed: {str(expt_done_count)}')
@@ -128,6 +146,8 @@ def main():
                 config.write(fname)
         issue_comm.edit(issue_text + pr_comment)
 
+    logger.info('Script Finished')
+
 
 if __name__ == '__main__':
     main()
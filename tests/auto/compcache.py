@@ -0,0 +1,106 @@
+"""
+Name: compcache.py
+Shared compiler cache for the PR builds on a machine. Every PR builds in
+a fresh pr/<id>/<timestamp> tree, so without a cache the unchanged
+sources are compiled again for each PR.
+
+With ccache set in CImachine.cfg, the build commands of a job get
+CMAKE_C_COMPILER_LAUNCHER and CMAKE_CXX_COMPILER_LAUNCHER, which CMake
+3.17 and later take from the environment, so every CMake build the
+scripts start compiles through ccache. ccache keys its results on the
+preprocessed source, the flags and the compiler itself, for the Intel
+and GNU compilers alike. The paths of the PR tree are made relative to
+the workdir, or the staging directory (CCACHE_BASEDIR), so one PR's
+results are hits for the next. ccache does not cache Fortran; those
+compiles run as before and are counted as not cacheable.
+
+Each compiler of a job writes its own stats log in the run directory,
+which gives the hit rate for the comment even though the cache is
+shared with other jobs.
+
+Options from CImachine.cfg:
+  ccache       the ccache executable, empty for no cache (default)
+  ccache_dir   the cache, default {workdir}/ccache
+  ccache_gb    size limit of the cache (default 20)
+"""
+
+import logging
+import os
+
+STATS_LOG = 'ccache_{compiler}.log'
+LANGUAGES = ['C', 'CXX']
+
+
+def enabled(job_obj):
+    return bool(job_obj.machine_dict.get('ccache'))
+
+
+def stats_log(job_obj):
+    return os.path.join(job_obj.run_dir or job_obj.workdir,
+                        STATS_LOG.format(compiler=job_obj.compiler))
+
+
+def use(job_obj):
+    ''' Add the cache settings to job_obj.command_env. Called after the
+        module environment is set, since that replaces command_env '''
+    if not enabled(job_obj):
+        return
+    logger = logging.getLogger('COMPCACHE/USE')
+    launcher = job_obj.machine_dict['ccache']
+    cache_dir = job_obj.machine_dict.get('ccache_dir') or \
+        os.path.join(job_obj.workdir, 'ccache')
+    size = job_obj.machine_dict.get('ccache_gb') or '20'
+    env = dict(job_obj.command_env or os.environ)
+    env.update({
+        'CCACHE_DIR': cache_dir,
+        'CCACHE_MAXSIZE': f'{size}G',
+        'CCACHE_BASEDIR': job_obj.stage_root or job_obj.workdir,
+        'CCACHE_NOHASHDIR': '1',
+        'CCACHE_COMPILERCHECK': 'content',
+        'CCACHE_STATSLOG': stats_log(job_obj),
+    })
+    for language in LANGUAGES:
+        env[f'CMAKE_{language}_COMPILER_LAUNCHER'] = launcher
+    job_obj.command_env = env
+    logger.info(f'Compiling through {launcher} with cache {cache_dir}')
+
+
+def read_stats(path):
+    ''' (hits, misses, not cacheable) compiles in a ccache stats log.
+        Each compile is a "# <source>" line then its counters '''
+    hits = 0
+    misses = 0
+    other = 0
+    counters = None
+    with open(path, errors='replace') as fname:
+        lines = fname.read().splitlines() + ['#']
+    for line in lines:
+        if line.startswith('#'):
+            if counters is not None:
+                if any('cache_hit' in c or 'cache hit' in c
+                       for c in counters):
+                    hits = hits + 1
+                elif any('cache_miss' in c or 'cache miss' in c
+                         for c in counters):
+                    misses = misses + 1
+                else:
+                    other = other + 1
+            counters = []
+        elif counters is not None and line.strip():
+            counters.append(line.strip())
+    return hits, misses, other
+
+
+def report(job_obj):
+    ''' Add the job's cache hit rate to the comment '''
+    path = stats_log(job_obj)
+    if not enabled(job_obj) or not os.path.exists(path):
+        return
+    hits, misses, other = read_stats(path)
+    if hits + misses == 0:
+        job_obj.comment_append(f'Compiler cache: no cacheable compiles, '
+                               f'{other} others')
+        return
+    job_obj.comment_append(f'Compiler cache: {hits} hits, {misses} misses '
+                           f'({100 * hits / (hits + misses):.0f}% hit rate), '
+                           f'{other} not cacheable')
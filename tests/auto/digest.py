@@ -0,0 +1,150 @@
+"""
+Name: digest.py
+Bounded summary of the error lines that job modules find in build, setup
+and test logs, for the PR comment.
+
+A failed build can match thousands of lines, which would make a comment
+larger than GitHub accepts. Lines are grouped by category and by a
+signature (the line with numbers and addresses replaced), so repeats
+are counted rather than kept. Only the first and last MAX_KEEP distinct
+signatures of a category are kept, and the comment part is rendered
+within a byte budget. At most MAX_DROPPED signatures that were not kept
+are remembered; past that the summary gives a lower bound. Every line
+as found is written to the findings file in the job's run directory.
+"""
+
+import collections
+import re
+import threading
+
+DIGEST_FILE = 'ci_findings.txt'
+MAX_KEEP = 10
+MAX_LINE = 300
+MAX_DROPPED = 10000
+# GitHub rejects comments over 65536 characters
+COMMENT_BYTES = 60000
+
+hex_re = re.compile(r'0x[0-9a-fA-F]+')
+num_re = re.compile(r'\d+')
+space_re = re.compile(r'\s+')
+
+
+def signature(line):
+    ''' Lines that differ only in numbers or addresses are repeats '''
+    line = hex_re.sub('0x#', line.strip())
+    return space_re.sub(' ', num_re.sub('#', line))
+
+
+class Category:
+    ''' Distinct lines of one category, first and last MAX_KEEP kept '''
+
+    def __init__(self):
+        self.lines = 0
+        self.first = collections.OrderedDict()
+        self.last = collections.OrderedDict()
+        self._dropped = set()
+        self.capped = False
+
+    @property
+    def dropped(self):
+        ''' Distinct signatures not kept, a lower bound if capped '''
+        return len(self._dropped)
+
+    def add(self, sig, line):
+        self.lines = self.lines + 1
+        for kept in (self.first, self.last):
+            if sig in kept:
+                kept[sig][0] = kept[sig][0] + 1
+                return
+        if len(self.first) < MAX_KEEP:
+            self.first[sig] = [1, line]
+            return
+        # a signature seen again after it was dropped is kept again
+        self._dropped.discard(sig)
+        self.last[sig] = [1, line]
+        if len(self.last) > MAX_KEEP:
+            sig = self.last.popitem(last=False)[0]
+            if len(self._dropped) < MAX_DROPPED:
+                self._dropped.add(sig)
+            elif sig not in self._dropped:
+                self.capped = True
+
+
+class Digest:
+    '''
+    Findings of a job
+    ...
+
+    Attributes
+    ----------
+    path : str
+      The findings file with every line, set before the first add
+    categories : dict
+      Category objects by name, in the order they were first seen
+    '''
+
+    def __init__(self):
+        self.path = None
+        self.categories = {}
+        self._file = None
+        self._lock = threading.Lock()
+
+    def add(self, category, line):
+        line = line.rstrip()[:MAX_LINE]
+        with self._lock:
+            if self._file is None and self.path:
+                self._file = open(self.path, 'a')
+            if self._file:
+                self._file.write(f'{category}: {line}\n')
+            self.categories.setdefault(category, Category()) \
+                           .add(signature(line), line)
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def render(self, budget):
+        ''' Summary of at most budget bytes, '' if nothing was found.
+            The findings are cleared so a later comment does not repeat
+            them '''
+        if not self.categories:
+            return ''
+        self.close()
+        out = []
+        size = 0
+        lines = [f'Findings, all lines in {self.path}:']
+        for name, category in self.categories.items():
+            distinct = len(category.first) + len(category.last) + \
+                category.dropped
+            bound = 'at least ' if category.capped else ''
+            lines.append(f'{name}: {category.lines} lines, '
+                         f'{bound}{distinct} distinct')
+            entries = list(category.first.values())
+            if category.dropped:
+                entries.append([0, f'... {bound}{category.dropped} '
+                                   f'more distinct'])
+            entries.extend(category.last.values())
+            for count, line in entries:
+                lines.append(f'  {count}x {line}' if count > 1
+                             else f'  {line}')
+        for line in lines:
+            size = size + len(line.encode('utf8')) + 1
+            if size > budget:
+                out.append('... (cut to fit the comment)')
+                break
+            out.append(line)
+        self.categories = {}
+        return '\n'.join(out) + '\n'
+
+
+def fit(text, budget):
+    ''' Keep the start and end of text within budget bytes '''
+    data = text.encode('utf8')
+    if len(data) <= budget:
+        return text
+    note = b'\n... (comment shortened) ...\n'
+    half = max(0, (budget - len(note)) // 2)
+    return (data[:half] + note + data[len(data) - half:]).decode(
+        'utf8', 'ignore')
@@ -0,0 +1,141 @@
+"""
+Name: failfast.py
+Runs a build command with its output going to a log file, as
+`command >& log` would. With fail_fast set in CImachine.cfg the output
+is read as it is written, and the first line that matches a fatal
+pattern stops the whole build process tree, so a compile error in the
+first component does not leave the rest of the build running. Once the
+build is stopped its output is read for at most KILL_GRACE seconds more.
+
+Options from CImachine.cfg:
+  fail_fast       1 to stop builds on a fatal line (default 0)
+  fatal_patterns  regular expressions, one per line, replacing
+                  FATAL_PATTERNS
+"""
+
+import collections
+import os
+import re
+import select
+import subprocess
+import threading
+import time
+
+FATAL_PATTERNS = [
+    r'\berror #\d+:',                   # Intel compilers
+    r'compilation aborted',             # Intel Fortran
+    r'^\S+:\d+:(\d+:)? (fatal )?error:',   # gcc, clang
+    r'^(Fatal )?Error: ',               # gfortran, after the location
+    r'\*\*\* \[.*\] Error \d+',         # make
+    r'^CMake Error',
+]
+# lines before the fatal one that are reported with it
+CONTEXT_LINES = 5
+# seconds to read what a killed build wrote; a process that left the
+# build's process tree may hold the output open after the kill
+KILL_GRACE = 60
+POLL_SECONDS = 1
+CHUNK = 64 * 1024
+
+
+def enabled(job_obj):
+    return str(job_obj.machine_dict.get('fail_fast') or '0') == '1'
+
+
+def fatal_re(job_obj):
+    patterns = (job_obj.machine_dict.get('fatal_patterns') or '').split('\n')
+    patterns = [p.strip() for p in patterns if p.strip()] or FATAL_PATTERNS
+    return re.compile('|'.join(f'(?:{p})' for p in patterns))
+
+
+def read_output(process, killed):
+    ''' Lines process writes until its output is closed, or for
+        KILL_GRACE seconds once killed is set '''
+    fd = process.stdout.fileno()
+    pending = b''
+    deadline = None
+    while deadline is None or time.monotonic() < deadline:
+        if deadline is None and killed.is_set():
+            deadline = time.monotonic() + KILL_GRACE
+        ready, _, _ = select.select([fd], [], [], POLL_SECONDS)
+        if not ready:
+            continue
+        chunk = os.read(fd, CHUNK)
+        if not chunk:
+            break
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if pending:
+        yield pending
+    process.stdout.close()
+
+
+def watch_output(job_obj, logger, process, fatal, log_path, killed):
+    ''' Write the output of process to log_path, stopping the process
+        at the first fatal line. Returns that line and the ones before
+        it, or [] '''
+    recent = collections.deque(maxlen=CONTEXT_LINES)
+    matched = []
+    with open(log_path, 'w') as log:
+        for raw in read_output(process, killed):
+            line = raw.decode('utf8', errors='replace')
+            log.write(line)
+            if matched or killed.is_set():
+                # the rest of what was written before the kill
+                continue
+            if fatal.search(line):
+                matched = list(recent) + [line]
+                log.flush()
+                logger.info(f'Fatal build line: {line.rstrip()}')
+                job_obj.kill_process_tree(logger, process)
+                killed.set()
+            recent.append(line)
+    return matched
+
+
+def run_logged(job_obj, logger, command, in_cwd, log_name):
+    ''' Run command in in_cwd with its output in in_cwd/log_name.
+        Returns the fatal lines if the build was stopped early '''
+    if not enabled(job_obj) or job_obj.harness_active():
+        job_obj.run_commands(logger, [[f'{command} >& {log_name}', in_cwd]])
+        return []
+    logger.info(f'Running `{command}` with fail fast')
+    logger.info(f'in location "{in_cwd}"')
+    process = subprocess.Popen(command, shell=True, cwd=in_cwd,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT,
+                               env=job_obj.command_env,
+                               start_new_session=True)
+    timeout = job_obj.command_timeout(command)
+    timer = None
+    timed_out = threading.Event()
+    killed = threading.Event()
+
+    def kill_on_timeout():
+        timed_out.set()
+        job_obj.kill_process_tree(logger, process)
+        killed.set()
+
+    if timeout:
+        timer = threading.Timer(timeout, kill_on_timeout)
+        timer.start()
+    matched = watch_output(job_obj, logger, process, fatal_re(job_obj),
+                           f'{in_cwd}/{log_name}', killed)
+    process.wait()
+    if timer:
+        timer.cancel()
+    if matched:
+        job_obj.comment_append('Build stopped at the first fatal error:')
+        for line in matched:
+            job_obj.comment_append(f'    {line.rstrip()[:300]}')
+    elif timed_out.is_set():
+        job_obj.comment_append(f'Timed out after {timeout}s: {command}')
+        job_obj.job_failed(logger, f'Command {command}',
+                           exception=Exception(f'Timed out after {timeout}s'))
+    elif process.returncode != 0:
+        job_obj.job_failed(logger, f'Command {command}',
+                           exception=Exception('Nonzero returncode: '
+                                               f'{process.returncode}'))
+    return matched
@@ -0,0 +1,148 @@
+"""
+Name: flaky.py
+Pass/fail history of every regression test (rt.sh), GSI ctest case and
+WE2E experiment, used to tell flaky tests from broken ones.
+
+History is kept in Testhist.cfg, one section per
+kind|test|machine|compiler with the newest HIST_KEEP results as
+<commit>:P or <commit>:F. A test that both failed and passed on the
+same commit, as when a rerun of a failure passes, is known to be flaky.
+Jobs retry the failures of known flaky tests once on their own and
+mark them as flaky in the comment.
+"""
+
+import os
+import re
+import threading
+
+HIST_FILE = 'Testhist.cfg'
+# Results kept per test, machine and compiler
+HIST_KEEP = 20
+# Commits on which a test both failed and passed before it is flaky
+FLAKY_COMMITS = 1
+
+# Test 001 control PASS / Test 001 control FAIL (current rt.sh)
+result_re = re.compile(r'^\s*Test\s+\d+\s+(\S+)\s+(PASS|FAIL)')
+# Test control_intel failed in run_test failed (older rt.sh)
+failed_re = re.compile(r'^\s*Test\s+(?:\d+\s+)?(\S+)\s+failed')
+SUMMARY_STRINGS = ['REGRESSION TEST WAS SUCCESSFUL',
+                   'REGRESSION TEST FAILED']
+
+# matrix jobs record from several threads
+_lock = threading.Lock()
+
+
+def read_history(file_name=HIST_FILE):
+    from configparser import ConfigParser as config_parser
+
+    config = config_parser(interpolation=None)
+    # ctest case names are case sensitive
+    config.optionxform = str
+    if os.path.exists(file_name):
+        config.read(file_name)
+    return config
+
+
+def write_history(config, file_name=HIST_FILE):
+    tmp_file = f'{file_name}.{os.getpid()}'
+    with open(tmp_file, 'w') as fname:
+        config.write(fname)
+    os.replace(tmp_file, file_name)
+
+
+def record_results(kind, results, machine, compiler, commit):
+    ''' Add {test name: passed} of one run to the history '''
+    if not results:
+        return
+    with _lock:
+        config = read_history()
+        for name, passed in results.items():
+            section = f'{kind}|{name}|{machine}|{compiler}'
+            if not config.has_section(section):
+                config[section] = {'runs': ''}
+            runs = config[section]['runs'].split()
+            runs.append(f'{commit[:12]}:{"P" if passed else "F"}')
+            config[section]['runs'] = ' '.join(runs[-HIST_KEEP:])
+        write_history(config)
+
+
+def is_flaky(config, kind, name, machine, compiler):
+    section = f'{kind}|{name}|{machine}|{compiler}'
+    if not config.has_section(section):
+        return False
+    outcomes = {}
+    for run in config[section]['runs'].split():
+        commit, _, outcome = run.partition(':')
+        outcomes.setdefault(commit, set()).add(outcome)
+    return len([o for o in outcomes.values() if len(o) == 2]) >= \
+        FLAKY_COMMITS
+
+
+def record(job_obj, kind, results):
+    record_results(kind, results, job_obj.machine, job_obj.compiler,
+                   job_obj.tested_sha())
+
+
+def known(job_obj, kind, names):
+    ''' The tests of names that are known to be flaky '''
+    config = read_history()
+    return [name for name in names
+            if is_flaky(config, kind, name, job_obj.machine,
+                        job_obj.compiler)]
+
+
+def rt_name(name, compiler):
+    ''' Older rt.sh logs add _<compiler> to the rt.conf test name '''
+    suffix = f'_{compiler}'
+    return name[:-len(suffix)] if name.endswith(suffix) else name
+
+
+def rt_results(logfile, compiler):
+    ''' {test name: passed} of a RegressionTests log '''
+    results = {}
+    if not os.path.exists(logfile):
+        return results
+    with open(logfile) as fname:
+        for line in fname:
+            match = result_re.search(line)
+            if match:
+                name = rt_name(match.group(1), compiler)
+                results[name] = results.get(name, True) and \
+                    match.group(2) == 'PASS'
+                continue
+            match = failed_re.search(line)
+            if match:
+                results[rt_name(match.group(1), compiler)] = False
+    return results
+
+
+def merge_rt_logs(first_log, retry_log, retried, compiler, merged_log):
+    ''' One log with the results of first_log, those of the retried
+        tests replaced by retry_log's. It is only successful if no test
+        failed in it '''
+    def kept(lines, drop):
+        out = []
+        for line in lines:
+            if any(x in line for x in SUMMARY_STRINGS):
+                continue
+            match = result_re.search(line) or failed_re.search(line)
+            if match and rt_name(match.group(1), compiler) in drop:
+                continue
+            out.append(line)
+        return out
+
+    # retry_log may be the path merged_log is written to
+    retry_ran = os.path.exists(retry_log)
+    merged = []
+    for log, drop in [(first_log, set(retried)), (retry_log, set())]:
+        if os.path.exists(log):
+            with open(log) as fname:
+                merged.extend(kept(fname.readlines(), drop))
+    with open(merged_log, 'w') as fname:
+        fname.writelines(merged)
+    successful = retry_ran and \
+        all(rt_results(merged_log, compiler).values())
+    summary = SUMMARY_STRINGS[0] if successful else SUMMARY_STRINGS[1]
+    with open(merged_log, 'a') as fname:
+        fname.write(f'{summary}\n')
+    return successful
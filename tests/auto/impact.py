@@ -0,0 +1,135 @@
+"""
+Name: impact.py
+Test impact analysis: pick the WE2E experiments, weather model
+regression tests or GSI ctest cases that a PR's changed files can affect.
+
+The mapping is kept in Testmap.cfg (or the file named by test_map in
+CImachine.cfg). There is one section per repo name, and each option maps
+a path glob to the space separated tests it affects:
+
+  [ufs-weather-model]
+  core = CMakeLists.txt cmake/* tests/rt.sh
+  CMEPS-interface/* = cpld_control_p8 cpld_restart_p8
+
+When several globs match a file, only the most specific ones (the most
+characters that are not wildcards) count, so a directory can be mapped
+more narrowly than its parent. A changed file that matches `core`,
+maps to ALL, or matches no glob at all means the full suite is run. So
+does a repo with no section.
+"""
+
+import fnmatch
+import logging
+import os
+from configparser import ConfigParser as config_parser
+
+MAP_FILE = 'Testmap.cfg'
+CORE = 'core'
+ALL = 'ALL'
+
+
+def read_map(job_obj):
+    config = config_parser()
+    # path globs are case sensitive
+    config.optionxform = str
+    file_name = job_obj.machine_dict.get('test_map') or MAP_FILE
+    if os.path.exists(file_name):
+        config.read(file_name)
+    return config
+
+
+def specificity(glob):
+    return len(glob) - sum(glob.count(c) for c in '*?[]')
+
+
+def most_specific(mapping, path):
+    ''' The tests of the most specific globs of mapping matching path '''
+    globs = [glob for glob in mapping if fnmatch.fnmatch(path, glob)]
+    if not globs:
+        return []
+    best = max(specificity(glob) for glob in globs)
+    return [mapping[glob] for glob in globs if specificity(glob) == best]
+
+
+def changed_files(job_obj):
+    ''' Files changed by the PR against its base, None if unknown '''
+    logger = logging.getLogger('IMPACT/CHANGED_FILES')
+    try:
+        return [f.filename for f in job_obj.preq_dict['preq'].get_files()]
+    except Exception as e:
+        logger.info(f'Could not get changed files: {e}')
+        return None
+
+
+def select_tests(job_obj):
+    ''' Returns the sorted list of tests to run, or None for all of them '''
+    logger = logging.getLogger('IMPACT/SELECT_TESTS')
+    section = job_obj.repo['address'].split('/')[1]
+    config = read_map(job_obj)
+    files = changed_files(job_obj)
+    if not config.has_section(section) or not files:
+        job_obj.comment_append('Impact analysis: running the full suite')
+        return None
+    core = config[section].get(CORE, '').split()
+    mapping = {glob: tests.split() for glob, tests in config[section].items()
+               if glob != CORE and glob not in config.defaults()}
+    selected = set()
+    for path in files:
+        if any(fnmatch.fnmatch(path, glob) for glob in core):
+            reason = f'{path} is a core file'
+            break
+        matched = most_specific(mapping, path)
+        if not matched:
+            reason = f'{path} is not in the test map'
+            break
+        if any(ALL in tests for tests in matched):
+            reason = f'{path} affects all tests'
+            break
+        selected.update(test for tests in matched for test in tests)
+    else:
+        logger.info(f'Selected tests: {sorted(selected)}')
+        if not selected:
+            job_obj.comment_append('Impact analysis: no tests affected')
+            return []
+        job_obj.comment_append(f'Impact analysis: running {len(selected)} '
+                               f'tests: {" ".join(sorted(selected))}')
+        return sorted(selected)
+    logger.info(f'Running the full suite, {reason}')
+    job_obj.comment_append(f'Impact analysis: full suite, {reason}')
+    return None
+
+
+def filter_rt_conf(conf_in, conf_out, tests):
+    ''' Write a copy of an rt.conf with only the RUN lines for tests and
+        the tests they depend on, and the COMPILE lines they need '''
+    with open(conf_in) as fname:
+        lines = fname.readlines()
+    # restart style tests depend on the test in their last column
+    depends = {}
+    for line in lines:
+        fields = [f.strip() for f in line.split('|')]
+        if fields[0] == 'RUN' and len(fields) > 4 and fields[4]:
+            depends[fields[1]] = fields[4]
+    # a dependency may itself depend on another test
+    keep = set()
+    todo = list(tests)
+    while todo:
+        test = todo.pop()
+        if test not in keep:
+            keep.add(test)
+            if test in depends:
+                todo.append(depends[test])
+    out = []
+    compile_line = None
+    for line in lines:
+        fields = [f.strip() for f in line.split('|')]
+        if fields[0] == 'COMPILE':
+            compile_line = line
+        elif fields[0] == 'RUN' and fields[1] in keep:
+            if compile_line:
+                out.append(compile_line)
+                compile_line = None
+            out.append(line)
+    with open(conf_out, 'w') as fname:
+        fname.writelines(out)
+    return len([line for line in out if line.startswith('RUN')])
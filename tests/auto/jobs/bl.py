@@ -9,6 +9,14 @@ import datetime
 import logging
 import os
 
+import blstore
+import compcache
+import jobstate
+import modenv
+import prefetch
+import rtperf
+import submods
+
 
 def run(job_obj):
     """
@@ -16,20 +24,24 @@ def run(job_obj):
     """
     logger = logging.getLogger('BL/RUN')
     logger.info('Started running baseline test')
-    blstore = f'{job_obj.workdir}/RT'
-    logger.info(f'blstore is: {blstore}')
+    bl_root = f'{job_obj.workdir}/RT'
+    logger.info(f'bl_root is: {bl_root}')
     user_name = os.environ['USER']
     rtbldir = f'{job_obj.workdir}/stmp4/{user_name}/FV3_RT/REGRESSION_TEST_{job_obj.compiler.upper()}'
     logger.info(f'rtbldir is: {rtbldir}')
-    pr_repo_loc, repo_dir_str = clone_pr_repo(job_obj, job_obj.workdir)
+    pr_repo_loc, repo_dir_str = jobstate.phase(job_obj, 'cloned',
+                                               clone_pr_repo, job_obj,
+                                               job_obj.workdir)
+    job_obj.run_dir = repo_dir_str
     logger.info(f'pr_repo_loc is: {pr_repo_loc}')
     logger.info(f'repo_dir_str is: {repo_dir_str}')
     bldate = get_bl_date(job_obj, pr_repo_loc)
-    bldir = f'{blstore}/NEMSfv3gfs/gsl-develop-{bldate}/{job_obj.compiler.upper()}'
+    bldir = f'{bl_root}/NEMSfv3gfs/gsl-develop-{bldate}/{job_obj.compiler.upper()}'
     logger.info(f'bldir is: {bldir}')
     bldirbool = check_for_bl_dir(bldir, job_obj)
     if not bldirbool:
-        run_regression_test(job_obj, pr_repo_loc)
+        jobstate.phase(job_obj, 'tests-submitted', run_regression_test,
+                       job_obj, pr_repo_loc)
         post_process(job_obj, pr_repo_loc, repo_dir_str, rtbldir, bldir)
     logger.info('Finished running baseline test')
 
@@ -61,13 +73,15 @@ def create_bl_dir(bldir, job_obj):
 def run_regression_test(job_obj, pr_repo_loc):
     logger = logging.getLogger('BL/RUN_REGRESSION_TEST')
     logger.info('Started run_regression_test')
+    shell = modenv.script_shell(job_obj, pr_repo_loc)
+    compcache.use(job_obj)
     if job_obj.compiler == 'gnu':
         rt_command = [[f'export RT_COMPILER="{job_obj.compiler}" && cd tests '
-                       '&& /bin/bash --login ./rt.sh -r -c -k -l rt_gnu.conf >& gnu_out',
+                       f'&& {shell} ./rt.sh -r -c -k -l rt_gnu.conf >& gnu_out',
                        pr_repo_loc]]
     elif job_obj.compiler == 'intel':
         rt_command = [[f'export RT_COMPILER="{job_obj.compiler}" && cd tests '
-                       '&& /bin/bash --login ./rt.sh -r -c -k >& intel_out', pr_repo_loc]]
+                       f'&& {shell} ./rt.sh -r -c -k >& intel_out', pr_repo_loc]]
     job_obj.run_commands(logger, rt_command)
     logger.info('Finished run_regression_test')
 
@@ -97,11 +111,10 @@ def clone_pr_repo(job_obj, workdir):
                    f'{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}'
     pr_repo_loc = f'{repo_dir_str}/{app_name}'
     job_obj.comment_append(f'Repo location: {pr_repo_loc}')
-    create_repo_commands = [
-        [f'mkdir -p "{repo_dir_str}"', os.getcwd()],
-        [f'git clone -b {branch} {git_url} {app_name}', repo_dir_str],
-        ['git submodule update --init --recursive',
-         f'{repo_dir_str}/{app_name}'],
+    create_repo_commands = prefetch.clone_commands(job_obj, repo_dir_str,
+                                                   app_name, branch, git_url)
+    create_repo_commands += submods.hydrate_commands(job_obj, pr_repo_loc)
+    create_repo_commands += [
         ['git config user.email "venita.hagerty@noaa.gov"',
          f'{repo_dir_str}/{app_name}'],
         ['git config user.name "venitahagerty"',
@@ -121,11 +134,26 @@ def post_process(job_obj, pr_repo_loc, repo_dir_str, rtbldir, bldir):
              f'.{job_obj.compiler}.log'
     filepath = f'{pr_repo_loc}/{rt_log}'
     rt_dir, logfile_pass = process_logfile(job_obj, filepath)
+    compcache.report(job_obj)
     if logfile_pass:
+        # only passing baseline runs become develop reference figures
+        rtperf.check_logfile(job_obj, filepath, kind='develop')
         create_bl_dir(bldir, job_obj)
-        move_bl_command = [[f'mv {rtbldir}/* {bldir}/', pr_repo_loc]]
-        job_obj.run_commands(logger, move_bl_command)
-        job_obj.comment_append('Baseline creation and move successful')
+        # files unchanged since an earlier BL_DATE are stored once
+        store_dir = os.path.join(job_obj.workdir, 'RT', blstore.OBJECTS_DIR)
+        start = datetime.datetime.now()
+        files, new_bytes, shared_bytes = blstore.publish(rtbldir, bldir,
+                                                         store_dir)
+        seconds = (datetime.datetime.now() - start).total_seconds()
+        job_obj.comment_append(f'Baseline: {files} files, '
+                               f'{new_bytes / 1e9:.1f} GB new, '
+                               f'{shared_bytes / 1e9:.1f} GB unchanged from '
+                               f'earlier baselines, stored in {seconds:.0f}s')
+        if files:
+            job_obj.comment_append('Baseline creation and move successful')
+        else:
+            job_obj.comment_append(f'Baseline creation FAILED, no files in '
+                                   f'{rtbldir}')
         # remove_pr_data(job_obj, pr_repo_loc, repo_dir_str, rt_dir)
     else:
         job_obj.comment_append('Baseline creation FAILED')
@@ -174,7 +202,7 @@ def process_logfile(job_obj, logfile):
             for line in f:
                 if all(x in line for x in fail_string_list):
                     # if 'FAIL' in line and 'Test' in line:
-                    job_obj.comment_append(f'{line.rstrip(chr(10))}')
+                    job_obj.finding('regression tests', line)
                 elif 'working dir' in line and not rt_dir:
                     logger.info(f'Found "working dir" in line: {line}')
                     rt_dir = os.path.split(line.split()[-1])[0]
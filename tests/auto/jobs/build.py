@@ -11,23 +11,27 @@ import time
 import os
 from configparser import ConfigParser as config_parser
 
+import buildjobs
+import compcache
+import flaky
+import impact
+import jobstate
+import prefetch
+import stage
+
 
 def run(job_obj):
     """
     Runs a CI test for a PR
     """
     logger = logging.getLogger('BUILD/RUN')
-    pr_repo_loc, repo_dir_str = clone_pr_repo(job_obj, job_obj.workdir)
-    # Setting this for the tests/build.sh script
-    os.environ['SR_WX_APP_TOP_DIR'] = pr_repo_loc
+    pr_repo_loc, repo_dir_str = stage.staged(job_obj, clone_and_build,
+                                             job_obj)
+    job_obj.run_dir = repo_dir_str
+    # The tree may have been built elsewhere, point the WE2E setup here
+    set_top_dir(job_obj, pr_repo_loc)
     build_script_loc = pr_repo_loc + '/tests'
     log_name = 'build.out'
-    # passing in machine for build
-    create_build_commands = [[f'./build.sh {job_obj.machine} {job_obj.compiler}'
-                              f' >& {log_name}',
-                             build_script_loc]]
-    logger.info('Running test build script')
-    job_obj.run_commands(logger, create_build_commands)
     # Read the build log to see whether it succeeded
     build_success = post_process(job_obj, build_script_loc, log_name)
     logger.info('After build post-processing')
@@ -37,54 +41,8 @@ def run(job_obj):
     if build_success:
         job_obj.comment_append('Build was Successful')
         if job_obj.preq_dict["action"] == 'WE':
-            # See if a previous job on same PR is still running
-            cfg_file = 'Longjob.cfg'
-            # See if there are any tests already running for this PR
-            if os.path.exists(cfg_file):
-                config = config_parser()
-                config.read(cfg_file)
-                num_sections = len(config.sections())
-                num_tests = 0
-                # Remove any older tests with the same PR ID
-                for ci_log in config.sections():
-                    if str(job_obj.preq_dict["preq"].id) in ci_log:
-                        num_tests = num_tests + 1
-                        config.remove_section(ci_log)
-                # If those were the only tests, delete the file
-                if num_sections == num_tests:
-                    os.remove(cfg_file)
-                    # Still need to remove cron jobs and maybe output dirs
-                    # Maybe write a message to PR (older issue id)
-            # Start the workflow process
-            expt_script_loc = pr_repo_loc + '/tests/WE2E'
-            expts_base_dir = os.path.join(repo_dir_str, 'expt_dirs')
-            log_name = 'expt.out'
-            we2e_script = expt_script_loc + '/setup_WE2E_tests.sh'
-            if os.path.exists(we2e_script):
-                logger.info('Running end to end test')
-                create_expt_commands = \
-                    [[f'./setup_WE2E_tests.sh {job_obj.machine} '
-                      f'{job_obj.hpc_acc} {job_obj.compiler} >& '
-                      f'{log_name}', expt_script_loc]]
-                job_obj.run_commands(logger, create_expt_commands)
-                logger.info('After end_to_end script')
-                # no experiment dir or no test dirs in it suggests error
-                if os.path.exists(expts_base_dir) and \
-                   len(os.listdir(expts_base_dir)):
-                    job_obj.comment_append('Rocoto jobs started')
-                    # If workflow running, comments will be written
-                    issue_id = process_expt(job_obj, expts_base_dir)
-                else:
-                    setup_log = os.path.join(expt_script_loc, log_name)
-                    if os.path.exists(setup_log):
-                        process_setup(job_obj, setup_log)
-                    gen_log_loc = pr_repo_loc + '/ush'
-                    gen_log_name = 'log.generate_FV3LAM_wflow'
-                    process_gen(job_obj, gen_log_loc, gen_log_name)
-            else:
-                job_obj.comment_append(f'Script {we2e_script} '
-                                       'does not exist in repo')
-                job_obj.comment_append('Cannot run WE2E tests')
+            remove_longjobs(job_obj)
+            issue_id = run_we2e(job_obj, pr_repo_loc, repo_dir_str)
     else:
         job_obj.comment_append('Build Failed')
 
@@ -94,40 +52,137 @@ def run(job_obj):
         logger.debug(f'Issue comment id is {issue_id}')
 
 
+def remove_longjobs(job_obj):
+    ''' Drop the Longjob.cfg entries of earlier jobs on the same PR '''
+    # See if a previous job on same PR is still running
+    cfg_file = 'Longjob.cfg'
+    # See if there are any tests already running for this PR
+    if os.path.exists(cfg_file):
+        config = config_parser()
+        config.read(cfg_file)
+        num_sections = len(config.sections())
+        num_tests = 0
+        # Remove any older tests with the same PR ID
+        for ci_log in config.sections():
+            if str(job_obj.preq_dict["preq"].id) in ci_log:
+                num_tests = num_tests + 1
+                config.remove_section(ci_log)
+        # If those were the only tests, delete the file
+        if num_sections == num_tests:
+            os.remove(cfg_file)
+            # Still need to remove cron jobs and maybe output dirs
+            # Maybe write a message to PR (older issue id)
+
+
+def run_we2e(job_obj, pr_repo_loc, repo_dir_str):
+    ''' Start the workflow process. Returns the issue id of the comment
+        if one was written, else 0 '''
+    logger = logging.getLogger('BUILD/RUN_WE2E')
+    issue_id = 0
+    expt_script_loc = pr_repo_loc + '/tests/WE2E'
+    expts_base_dir = os.path.join(repo_dir_str, 'expt_dirs')
+    log_name = 'expt.out'
+    we2e_script = expt_script_loc + '/setup_WE2E_tests.sh'
+    # Only the experiments this PR can affect, if known
+    tests = None
+    if os.path.exists(we2e_script):
+        tests = impact.select_tests(job_obj)
+    if tests == []:
+        job_obj.comment_append('No WE2E experiments are affected '
+                               'by this PR')
+    elif os.path.exists(we2e_script):
+        logger.info('Running end to end test')
+        jobstate.phase(job_obj, 'tests-submitted', setup_we2e,
+                       job_obj, expt_script_loc, tests, log_name)
+        logger.info('After end_to_end script')
+        # no experiment dir or no test dirs in it suggests error
+        if os.path.exists(expts_base_dir) and \
+           len(os.listdir(expts_base_dir)):
+            job_obj.comment_append('Rocoto jobs started')
+            # If workflow running, comments will be written
+            issue_id = process_expt(job_obj, expts_base_dir)
+        else:
+            setup_log = os.path.join(expt_script_loc, log_name)
+            if os.path.exists(setup_log):
+                process_setup(job_obj, setup_log)
+            gen_log_loc = pr_repo_loc + '/ush'
+            gen_log_name = 'log.generate_FV3LAM_wflow'
+            process_gen(job_obj, gen_log_loc, gen_log_name)
+    else:
+        job_obj.comment_append(f'Script {we2e_script} '
+                               'does not exist in repo')
+        job_obj.comment_append('Cannot run WE2E tests')
+    return issue_id
+
+
+def setup_we2e(job_obj, expt_script_loc, tests, log_name):
+    ''' Start the WE2E experiments tests, or all if None '''
+    logger = logging.getLogger('BUILD/SETUP_WE2E')
+    test_arg = ''
+    if tests:
+        test_file = 'we2e_ci_tests.txt'
+        with open(os.path.join(expt_script_loc, test_file), 'w') as fname:
+            fname.write('\n'.join(tests) + '\n')
+        test_arg = f' {test_file}'
+    create_expt_commands = \
+        [[f'./setup_WE2E_tests.sh {job_obj.machine} '
+          f'{job_obj.hpc_acc} {job_obj.compiler}{test_arg} >& '
+          f'{log_name}', expt_script_loc]]
+    job_obj.run_commands(logger, create_expt_commands)
+
+
+def set_top_dir(job_obj, pr_repo_loc):
+    ''' Point the app scripts at pr_repo_loc, also in a command_env
+        taken before the tree was moved there '''
+    os.environ['SR_WX_APP_TOP_DIR'] = pr_repo_loc
+    if job_obj.command_env:
+        job_obj.command_env['SR_WX_APP_TOP_DIR'] = pr_repo_loc
+
+
+def clone_and_build(workdir, job_obj):
+    ''' clone the PR under workdir and run the test build script '''
+    logger = logging.getLogger('BUILD/CLONE_AND_BUILD')
+    pr_repo_loc, repo_dir_str = clone_pr_repo(job_obj, workdir)
+    job_obj.run_dir = repo_dir_str
+    # Setting this for the tests/build.sh script
+    set_top_dir(job_obj, pr_repo_loc)
+    build_script_loc = pr_repo_loc + '/tests'
+    # passing in machine for build
+    build_command = f'./build.sh {job_obj.machine} {job_obj.compiler}'
+    compcache.use(job_obj)
+    logger.info('Running test build script')
+    jobstate.phase(job_obj, 'built', buildjobs.run_logged, job_obj, logger,
+                   build_command, build_script_loc, 'build.out')
+    return pr_repo_loc, repo_dir_str
+
+
 def clone_pr_repo(job_obj, workdir):
-    ''' clone the GitHub pull request repo, via command line '''
-    logger = logging.getLogger('BUILD/CLONE_PR_REPO')
+    ''' clone the GitHub pull request repo and check out its externals '''
+    pr_repo_loc, repo_dir_str = jobstate.phase(job_obj, 'cloned',
+                                               clone_app_repo, job_obj,
+                                               workdir)
+    jobstate.phase(job_obj, 'externals', checkout_externals, job_obj,
+                   pr_repo_loc)
+    return pr_repo_loc, repo_dir_str
+
+
+def clone_app_repo(job_obj, workdir):
+    ''' clone the app repo for the PR, via command line, and point its
+        Externals.cfg at the PR head '''
+    logger = logging.getLogger('BUILD/CLONE_APP_REPO')
 
     # These are for the new/head repo in the PR
     new_name = job_obj.preq_dict['preq'].head.repo.name
-    new_repo = job_obj.preq_dict['preq'].head.repo.full_name
-    new_branch = job_obj.preq_dict['preq'].head.ref
     # These are for the default app repo that goes with the workflow
     try:
         auth_repo = job_obj.repo["app_address"]
         auth_branch = job_obj.repo["app_branch"]
     except Exception as e:
         logger.info('Error getting app address and branch from config dict')
-        job_obj.job_failed(logger, 'clone_pr_repo', exception=e)
+        job_obj.job_failed(logger, 'clone_app_repo', exception=e)
     app_name = auth_repo.split("/")[1]
-    # The new repo is the default repo
-    git_url = f'https://${{ghapitoken}}@github.com/{new_repo}'
-
-    # If the new repo is the regional workflow (not the app)
-    if new_name != app_name:
-        # look for a matching app repo/branch
-        app_repo = os.path.join(job_obj.preq_dict['preq'].head.user.login,
-                                app_name)
-        branch_list = list(job_obj.ghinterface_obj.client.get_repo(app_repo)
-                           .get_branches())
-        if new_branch in [branch.name for branch in branch_list]:
-            git_url = f'https://${{ghapitoken}}@github.com/{app_repo}'
-            app_branch = new_branch
-        else:
-            git_url = f'https://${{ghapitoken}}@github.com/{auth_repo}'
-            app_branch = auth_branch
-    else:
-        app_branch = new_branch
+    git_url, app_branch = app_source(job_obj, app_name, auth_repo,
+                                     auth_branch)
 
     logger.info(f'GIT URL: {git_url}')
     logger.info(f'app branch: {app_branch}')
@@ -138,60 +193,95 @@ def clone_pr_repo(job_obj, workdir):
     pr_repo_loc = f'{repo_dir_str}/{app_name}'
     job_obj.comment_append(f'Repo location: {pr_repo_loc}')
 
-    create_repo_commands = [
-        [f'mkdir -p "{repo_dir_str}"', os.getcwd()],
-        [f'git clone -b {app_branch} {git_url}', repo_dir_str]]
+    if new_name == app_name:
+        # the PR head is the app itself, it may have been prefetched
+        create_repo_commands = prefetch.clone_commands(job_obj, repo_dir_str,
+                                                       app_name, app_branch,
+                                                       git_url)
+    else:
+        create_repo_commands = [
+            [f'mkdir -p "{repo_dir_str}"', os.getcwd()],
+            [f'git clone -b {app_branch} {git_url}', repo_dir_str]]
     job_obj.run_commands(logger, create_repo_commands)
 
-    # Set up configparser to read and update Externals.cfg ini/config file
-    # to change one repo to match the head of the code in the PR
-    config = config_parser()
-    file_name = 'Externals.cfg'
-    file_path = os.path.join(pr_repo_loc, file_name)
-
+    file_path = os.path.join(pr_repo_loc, 'Externals.cfg')
     if not os.path.exists(file_path):
         logger.info(f'Could not find {file_path}')
         raise FileNotFoundError
 
     # Only update Externals.cfg for a PR on a regional workflow
     if new_name != app_name:
-        config.read(file_path)
-        updated_section = new_name
-        logger.info(f'updated section: {updated_section}')
-        new_repo = "https://github.com/" + \
-            job_obj.preq_dict['preq'].head.repo.full_name
-        logger.info(f'new repo: {new_repo}')
-
-        if config.has_section(updated_section):
-
-            config.set(updated_section, 'hash',
-                       job_obj.preq_dict['preq'].head.sha)
-            config.set(updated_section, 'repo_url', new_repo)
-            # Can only have one of hash, branch, tag
-            if config.has_option(updated_section, 'branch'):
-                config.remove_option(updated_section, 'branch')
-            if config.has_option(updated_section, 'tag'):
-                config.remove_option(updated_section, 'tag')
-            # open existing Externals.cfg to update it
-            with open(file_path, 'w') as fname:
-                config.write(fname)
-        else:
-            logger.info('No section {updated_section} in Externals.cfg')
+        point_externals(job_obj, file_path)
+
+    logger.info('Finished repo clone')
+    return pr_repo_loc, repo_dir_str
+
 
-    # call manage externals to get other repos
+def app_source(job_obj, app_name, auth_repo, auth_branch):
+    ''' The (git url, branch) of the app to clone: the PR head for an
+        app PR. For a workflow PR, the app branch of the same name in the
+        PR author's fork if there is one, else the configured app '''
+    new_name = job_obj.preq_dict['preq'].head.repo.name
+    new_repo = job_obj.preq_dict['preq'].head.repo.full_name
+    new_branch = job_obj.preq_dict['preq'].head.ref
+    # The new repo is the default repo
+    if new_name == app_name:
+        return f'https://${{ghapitoken}}@github.com/{new_repo}', new_branch
+    # look for a matching app repo/branch
+    app_repo = os.path.join(job_obj.preq_dict['preq'].head.user.login,
+                            app_name)
+    branch_list = list(job_obj.ghinterface_obj.client.get_repo(app_repo)
+                       .get_branches())
+    if new_branch in [branch.name for branch in branch_list]:
+        return f'https://${{ghapitoken}}@github.com/{app_repo}', new_branch
+    return f'https://${{ghapitoken}}@github.com/{auth_repo}', auth_branch
+
+
+def point_externals(job_obj, file_path):
+    ''' Set the PR repo's section of Externals.cfg to the PR head '''
+    logger = logging.getLogger('BUILD/POINT_EXTERNALS')
+    # Set up configparser to read and update Externals.cfg ini/config file
+    # to change one repo to match the head of the code in the PR
+    config = config_parser()
+    config.read(file_path)
+    updated_section = job_obj.preq_dict['preq'].head.repo.name
+    logger.info(f'updated section: {updated_section}')
+    new_repo = "https://github.com/" + \
+        job_obj.preq_dict['preq'].head.repo.full_name
+    logger.info(f'new repo: {new_repo}')
+
+    if config.has_section(updated_section):
+
+        config.set(updated_section, 'hash',
+                   job_obj.preq_dict['preq'].head.sha)
+        config.set(updated_section, 'repo_url', new_repo)
+        # Can only have one of hash, branch, tag
+        if config.has_option(updated_section, 'branch'):
+            config.remove_option(updated_section, 'branch')
+        if config.has_option(updated_section, 'tag'):
+            config.remove_option(updated_section, 'tag')
+        # open existing Externals.cfg to update it
+        with open(file_path, 'w') as fname:
+            config.write(fname)
+    else:
+        logger.info('No section {updated_section} in Externals.cfg')
+
+
+def checkout_externals(job_obj, pr_repo_loc):
+    ''' call manage externals to get other repos '''
+    logger = logging.getLogger('BUILD/CHECKOUT_EXTERNALS')
     logger.info('Starting manage externals')
     create_repo_commands = [['./manage_externals/checkout_externals',
                              pr_repo_loc]]
 
     job_obj.run_commands(logger, create_repo_commands)
-
-    logger.info('Finished repo clone')
-    return pr_repo_loc, repo_dir_str
+    logger.info('Finished manage externals')
 
 
 def post_process(job_obj, build_script_loc, log_name):
     logger = logging.getLogger('BUILD/POST_PROCESS')
     ci_log = f'{build_script_loc}/{log_name}'
+    compcache.report(job_obj)
     logfile_pass = process_logfile(job_obj, ci_log)
     logger.info('Build log file was processed')
 
@@ -211,7 +301,7 @@ def process_logfile(job_obj, ci_log):
         with open(ci_log) as fname:
             for line in fname:
                 if fail_string in line:
-                    job_obj.comment_append(f'{line.rstrip()}')
+                    job_obj.finding('build', line)
                 elif success_string in line:
                     build_succeeded = True
         if build_succeeded:
@@ -239,12 +329,12 @@ def process_setup(job_obj, setup_log):
     setup_failed = False
     with open(setup_log) as fname:
         for line in fname:
-            if error_string in line:
+            if error_string in line and not setup_failed:
                 job_obj.comment_append('Setup for Workflow Failed')
                 setup_failed = True
                 logger.info('Setup for workflow failed')
             if setup_failed:
-                job_obj.comment_append(f'{line.rstrip()}')
+                job_obj.finding('workflow setup', line)
     if setup_failed:
         raise Exception('Setup for workflow could not complete ')
 
@@ -262,19 +352,21 @@ def process_gen(job_obj, gen_log_loc, gen_log_name):
     if os.path.exists(gen_log):
         with open(gen_log) as fname:
             for line in fname:
-                if error_string in line or error_msg in line:
+                if (error_string in line or error_msg in line) and \
+                   not gen_failed:
                     job_obj.comment_append('Generating Workflow Failed')
                     gen_failed = True
                     logger.info('Generating workflow failed')
                 if gen_failed:
-                    job_obj.comment_append(f'{line.rstrip()}')
+                    job_obj.finding('workflow generation', line)
 
 
-def process_expt(job_obj, expts_base_dir):
+def process_expt(job_obj, expts_base_dir, expts=None):
     """
     Runs after a rocoto workflow has been started to run one or more expts
     Assumes that more expt directories can appear after this job has started
-    Checks for success or failure for each expt
+    Checks for success or failure for each expt, only those of expts if
+    given
     """
     logger = logging.getLogger('BUILD/PROCESS_EXPT')
     expt_done = 0
@@ -283,7 +375,9 @@ def process_expt(job_obj, expts_base_dir):
     sleep_time = 6
     repeat_count = time_mult
     complete_expts = []
-    expt_list = os.listdir(expts_base_dir)
+    results = {}
+    expt_list = [expt for expt in os.listdir(expts_base_dir)
+                 if expts is None or expt in expts]
     complete_string = "This cycle is complete"
     failed_string = "DEAD"
 
@@ -293,7 +387,8 @@ def process_expt(job_obj, expts_base_dir):
     while (expt_done < len(expt_list)) and repeat_count > 0:
         time.sleep(sleep_time)
         repeat_count = repeat_count - 1
-        expt_list = os.listdir(expts_base_dir)
+        expt_list = [expt for expt in os.listdir(expts_base_dir)
+                     if expts is None or expt in expts]
         logger.info('Experiment dir after return of end_to_end')
         logger.info(expt_list)
         for expt in expt_list:
@@ -308,13 +403,18 @@ def process_expt(job_obj, expts_base_dir):
                             job_obj.comment_append(f'{line.rstrip()}')
                             logger.info(f'Experiment done: {expt}')
                             complete_expts.append(expt)
+                            results[expt] = True
                         elif failed_string in line:
                             expt_done = expt_done + 1
+                            known = ' (known flaky)' if flaky.known(
+                                job_obj, 'we2e', [expt]) else ''
                             job_obj.comment_append('Experiment failed: '
-                                                   f'{expt}')
+                                                   f'{expt}{known}')
                             job_obj.comment_append(f'{line.rstrip()}')
                             logger.info(f'Experiment failed: {expt}')
                             complete_expts.append(expt)
+                            results[expt] = False
+    flaky.record(job_obj, 'we2e', results)
     logger.info(f'Wait Cycles completed: {time_mult - repeat_count}')
     logger.info(f'Done: {len(complete_expts)} of {len(expt_list)}')
 
@@ -341,9 +441,12 @@ def process_expt(job_obj, expts_base_dir):
             config[expt_log] = {}
             config[expt_log]['expt'] = expt
             config[expt_log]['machine'] = job_obj.machine
+            config[expt_log]['compiler'] = job_obj.compiler
             config[expt_log]['pr_repo'] = pr_repo
             config[expt_log]['pr_num'] = str(pr_num)
             config[expt_log]['issue_id'] = str(issue_id.id)
+            # the commit tested, the PR head may move while it runs
+            config[expt_log]['sha'] = job_obj.tested_sha()
         with open(file_name, 'w') as fname:
             config.write(fname)
 
@@ -0,0 +1,141 @@
+"""
+Name: matrix.py
+Python to clone a repo once and build (SRW build) or regression test
+(weather model RT) it with every compiler at the same time.
+Started by labels such as ci-hera-all-build. Each compiler's phases run
+in their own thread with their own build directory, and the results are
+posted as one comment.
+"""
+
+# Imports
+import copy
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import buildjobs
+import compcache
+import impact
+import jobstate
+import stage
+from jobs import build
+from jobs import rt
+
+
+def run(job_obj):
+    """
+    Runs a CI test for a PR with all compilers
+    """
+    logger = logging.getLogger('MATRIX/RUN')
+    logger.info(f'Started {job_obj.preq_dict["action"]} for '
+                f'{job_obj.machine_dict["compilers"]}')
+    if job_obj.preq_dict['action'] == 'RT':
+        run_rt(job_obj)
+    else:
+        run_build(job_obj)
+    issue_id = job_obj.send_comment_text()
+    logger.debug(f'Issue comment id is {issue_id}')
+    logger.info('Finished matrix job')
+
+
+def compiler_jobs(job_obj):
+    ''' One copy of the job per compiler, each with its own comment text '''
+    sub_jobs = []
+    for compiler in job_obj.machine_dict['compilers']:
+        sub_job = copy.copy(job_obj)
+        sub_job.compiler = compiler
+        sub_job.comment_text = ''
+        sub_jobs.append(sub_job)
+    return sub_jobs
+
+
+def run_parallel(job_obj, sub_jobs, phase):
+    ''' Run phase(sub_job) for every compiler at once, then add each
+        compiler's comments to the job comment '''
+    logger = logging.getLogger('MATRIX/RUN_PARALLEL')
+    with ThreadPoolExecutor(max_workers=len(sub_jobs)) as executor:
+        futures = [executor.submit(phase, sub_job) for sub_job in sub_jobs]
+    for sub_job, future in zip(sub_jobs, futures):
+        job_obj.comment_append(f'--- {sub_job.compiler} ---')
+        if future.exception():
+            logger.critical(f'{sub_job.compiler} failed: '
+                            f'{future.exception()}')
+            sub_job.comment_append(f'{sub_job.compiler} job failed')
+        job_obj.comment_text += sub_job.comment_text
+
+
+def run_build(job_obj):
+    ''' SRW: every compiler builds into its own build_<compiler> dir '''
+    sub_jobs = compiler_jobs(job_obj)
+    pr_repo_loc, repo_dir_str = stage.staged(job_obj, build_all, job_obj,
+                                             sub_jobs)
+    job_obj.run_dir = repo_dir_str
+    build.set_top_dir(job_obj, pr_repo_loc)
+    build_script_loc = pr_repo_loc + '/tests'
+
+    def check_one(sub_job):
+        sub_job.run_dir = repo_dir_str
+        build.set_top_dir(sub_job, pr_repo_loc)
+        # process_logfile raises if the build failed
+        if build.post_process(sub_job, build_script_loc,
+                              f'build_{sub_job.compiler}.out'):
+            sub_job.comment_append('Build was Successful')
+
+    run_parallel(job_obj, sub_jobs, check_one)
+
+
+def build_all(workdir, job_obj, sub_jobs):
+    ''' Clone under workdir and build every compiler at once '''
+    logger = logging.getLogger('MATRIX/BUILD_ALL')
+    pr_repo_loc, repo_dir_str = build.clone_pr_repo(job_obj, workdir)
+    job_obj.run_dir = repo_dir_str
+    # Setting this for the tests/build.sh script
+    build.set_top_dir(job_obj, pr_repo_loc)
+    build_script_loc = pr_repo_loc + '/tests'
+
+    def build_one(sub_job):
+        sub_job.run_dir = repo_dir_str
+        sub_job.stage_root = job_obj.stage_root
+        logger.info(f'Running test build script for {sub_job.compiler}')
+        compcache.use(sub_job)
+        buildjobs.run_logged(sub_job, logger,
+                             f'./build.sh {sub_job.machine} {sub_job.compiler}',
+                             build_script_loc,
+                             f'build_{sub_job.compiler}.out')
+
+    with ThreadPoolExecutor(max_workers=len(sub_jobs)) as executor:
+        futures = [executor.submit(build_one, sub_job)
+                   for sub_job in sub_jobs]
+    # a failed build is reported when its log is read
+    for sub_job, future in zip(sub_jobs, futures):
+        if future.exception():
+            logger.critical(f'{sub_job.compiler} build failed: '
+                            f'{future.exception()}')
+    return pr_repo_loc, repo_dir_str
+
+
+def run_rt(job_obj):
+    ''' Weather model: rt.sh locks its tests dir, so every compiler after
+        the first runs in a local copy of the checked out clone '''
+    logger = logging.getLogger('MATRIX/RUN_RT')
+    pr_repo_loc, repo_dir_str = jobstate.phase(job_obj, 'cloned',
+                                               rt.clone_pr_repo, job_obj,
+                                               job_obj.workdir)
+    job_obj.run_dir = repo_dir_str
+    tests = impact.select_tests(job_obj)
+    if tests == []:
+        job_obj.comment_append('No regression tests are affected by this PR')
+        return
+    sub_jobs = compiler_jobs(job_obj)
+    repo_locs = {sub_jobs[0].compiler: pr_repo_loc}
+    for sub_job in sub_jobs[1:]:
+        repo_locs[sub_job.compiler] = f'{pr_repo_loc}_{sub_job.compiler}'
+    copy_commands = [[f'cp -a {pr_repo_loc} {repo_locs[sub_job.compiler]}',
+                      repo_dir_str] for sub_job in sub_jobs[1:]]
+    job_obj.run_commands(logger, copy_commands)
+
+    def rt_one(sub_job):
+        repo_loc = repo_locs[sub_job.compiler]
+        rt.run_regression_test(sub_job, repo_loc, tests)
+        rt.check_results(sub_job, repo_loc)
+
+    run_parallel(job_obj, sub_jobs, rt_one)
@@ -10,6 +10,23 @@ import logging
 import time
 import os
 from configparser import ConfigParser as config_parser
+from xml.etree import ElementTree
+
+import compcache
+import buildjobs
+import flaky
+import impact
+import jobstate
+import modenv
+import prefetch
+
+# Lines of the ctest output that describe a GSI regression result
+ERROR_STRINGS = ['Test #', 'Test  #', 'ed the', 'Thus', 'resulting',
+                 'job has']
+# Of those, the ones that say why a case failed
+REASON_STRINGS = ['ed the', 'Thus', 'resulting', 'job has']
+# ctest output and JUnit results are CTEST_NAME.out and CTEST_NAME.xml
+CTEST_NAME = 'gsi_ctest'
 
 
 def run(job_obj):
@@ -17,20 +34,24 @@ def run(job_obj):
     Runs a regression test for a GSI PR
     """
     logger = logging.getLogger('REGR/RUN')
-    pr_repo_loc, repo_dir_str = clone_pr_repo(job_obj, job_obj.workdir)
+    pr_repo_loc, repo_dir_str = jobstate.phase(job_obj, 'cloned',
+                                               clone_pr_repo, job_obj,
+                                               job_obj.workdir)
+    job_obj.run_dir = repo_dir_str
     # Setting this for local testing
     os.environ['config_path'] = job_obj.workdir
     build_script_loc = pr_repo_loc + '/ush'
     log_name = 'build.out'
-    # passing in machine for build
-    create_build_commands = [['module purge', pr_repo_loc],
-                             [f'module use modulefiles;module load gsi_{job_obj.machine}.{job_obj.compiler}',
-                              pr_repo_loc],
-                             [f'./build.sh ../ '
-                              f' >& {log_name}',
-                             build_script_loc]]
+    module_commands = load_modules(job_obj, pr_repo_loc)
+    build_command = './build.sh ../'
+    if not job_obj.command_env:
+        # no snapshot, load the modules in the same shell as the build
+        build_command = f'/bin/bash --login -c ' \
+                        f'"{module_commands} && {build_command}"'
+    compcache.use(job_obj)
     logger.info('Running test build script')
-    job_obj.run_commands(logger, create_build_commands)
+    jobstate.phase(job_obj, 'built', buildjobs.run_logged, job_obj, logger,
+                   build_command, build_script_loc, log_name)
     # Read the build log to see whether it succeeded
     build_success = post_process(job_obj, build_script_loc, log_name,
                                  pr_repo_loc)
@@ -41,22 +62,14 @@ def run(job_obj):
     if build_success:
         job_obj.comment_append('Build was Successful')
         if job_obj.preq_dict["action"] == 'rt':
-            logger.info('Running GSI regression test')
-            log_name = 'gsi_ctest.out'
-            ctest_loc = pr_repo_loc + '/build/regression'
-            create_regr_commands = \
-                [[f'ctest --verbose >& '
-                  f'{log_name}', ctest_loc]]
-            job_obj.run_commands(logger, create_regr_commands)
-            logger.info('After GSI regression test')
-            ci_log = f'{ctest_loc}/{log_name}'
-            error_strings = ['Test #', 'Test  #', 'ed the', 'Thus',
-                             'resulting', 'job has']
-            if os.path.exists(ci_log):
-                with open(ci_log) as fname:
-                    for line in fname:
-                        if any(x in line for x in error_strings):
-                            job_obj.comment_append(f'{line.rstrip().replace("#", "")}')
+            # Only the cases this PR can affect, if known
+            tests = impact.select_tests(job_obj)
+            if tests == []:
+                job_obj.comment_append('No regression tests are affected '
+                                       'by this PR')
+            else:
+                jobstate.phase(job_obj, 'tests-submitted', run_ctest,
+                               job_obj, pr_repo_loc, tests)
     else:
         job_obj.comment_append('Build Failed')
 
@@ -66,6 +79,151 @@ def run(job_obj):
         logger.debug(f'Issue comment id is {issue_id}')
 
 
+def load_modules(job_obj, pr_repo_loc):
+    ''' Load the GSI modules once, later commands get this environment.
+        Returns the module commands '''
+    module_commands = f'module purge && ' \
+                      f'module use {pr_repo_loc}/modulefiles && ' \
+                      f'module load gsi_{job_obj.machine}.{job_obj.compiler}'
+    job_obj.command_env = modenv.snapshot(job_obj, pr_repo_loc,
+                                          module_commands,
+                                          f'{pr_repo_loc}/modulefiles')
+    return module_commands
+
+
+def ctest_jobs(job_obj, num_tests):
+    ''' Number of cases to run at once. Each case mostly waits on its
+        batch job, so this is bounded by ctest_jobs and the login node '''
+    max_jobs = int(job_obj.machine_dict.get('ctest_jobs') or 8)
+    return max(1, min(max_jobs, os.cpu_count() or 1, num_tests or max_jobs))
+
+
+def run_ctest(job_obj, pr_repo_loc, tests=None):
+    ''' Run the GSI regression tests, or only tests if given '''
+    logger = logging.getLogger('REGR/RUN_CTEST')
+    logger.info('Running GSI regression test')
+    ctest_loc = pr_repo_loc + '/build/regression'
+    ctest(job_obj, ctest_loc, tests, CTEST_NAME)
+    logger.info('After GSI regression test')
+    check_ctest(job_obj, ctest_loc)
+
+
+def ctest(job_obj, ctest_loc, tests, name):
+    ''' Run tests, or all cases if None, with the output in name.out
+        and the JUnit results in name.xml '''
+    logger = logging.getLogger('REGR/CTEST')
+    test_arg = ''
+    if tests:
+        test_arg = f"-R '^({'|'.join(tests)})$' "
+    num_jobs = ctest_jobs(job_obj, len(tests or []))
+    create_regr_commands = \
+        [[f'ctest --verbose -j {num_jobs} --output-junit {name}.xml '
+          f'{test_arg}>& {name}.out', ctest_loc]]
+    job_obj.run_commands(logger, create_regr_commands)
+
+
+def check_ctest(job_obj, ctest_loc):
+    ''' Retry the failures of known flaky cases, then add the results
+        to the comment '''
+    junit_log = f'{ctest_loc}/{CTEST_NAME}.xml'
+    if os.path.exists(junit_log):
+        results = read_junit(job_obj, junit_log)
+        if results is None:
+            return
+        flaky.record(job_obj, 'ctest', ctest_outcomes(results))
+        failed = [r[0] for r in results if r[1] == 'FAILED']
+        retry = flaky.known(job_obj, 'ctest', failed)
+        if retry:
+            job_obj.comment_append(f'Retrying known flaky cases: '
+                                   f'{" ".join(retry)}')
+            results = rerun_cases(job_obj, ctest_loc, results, retry)
+        process_junit(job_obj, results)
+        return
+    # ctest older than 3.21 has no JUnit output
+    ci_log = f'{ctest_loc}/{CTEST_NAME}.out'
+    if os.path.exists(ci_log):
+        with open(ci_log) as fname:
+            for line in fname:
+                if any(x in line for x in ERROR_STRINGS):
+                    job_obj.finding('ctest', line.replace('#', ''))
+
+
+def rerun_cases(job_obj, ctest_loc, results, cases):
+    ''' Run cases again in the same build. Returns results with
+        theirs replaced by the rerun ones '''
+    ctest(job_obj, ctest_loc, cases, f'{CTEST_NAME}_rerun')
+    rerun = read_junit(job_obj, f'{ctest_loc}/{CTEST_NAME}_rerun.xml') or []
+    flaky.record(job_obj, 'ctest', ctest_outcomes(rerun))
+    rerun = {result[0]: result for result in rerun}
+    merged = []
+    for result in results:
+        name = result[0]
+        if name in rerun:
+            status = rerun[name][1]
+            if status == 'passed':
+                status = 'passed on rerun (flaky)'
+            result = (name, status) + rerun[name][2:]
+        merged.append(result)
+    return merged
+
+
+def failure_reason(testcase):
+    ''' First line of a failed case's output that explains the failure '''
+    failure = testcase.find('failure')
+    output = testcase.findtext('system-out') or ''
+    for line in output.split('\n'):
+        if any(x in line for x in REASON_STRINGS):
+            return line.strip()[:200]
+    if failure is not None and failure.get('message'):
+        return failure.get('message').strip()[:200]
+    return ''
+
+
+def read_junit(job_obj, junit_log):
+    ''' (name, status, seconds, reason) of each case of a ctest JUnit
+        file, None if it cannot be read '''
+    logger = logging.getLogger('REGR/READ_JUNIT')
+    try:
+        root = ElementTree.parse(junit_log).getroot()
+    except (ElementTree.ParseError, OSError) as e:
+        logger.critical(f'Cannot parse {junit_log}: {e}')
+        job_obj.comment_append('Could not read regression test results')
+        return None
+    results = []
+    for testcase in root.iter('testcase'):
+        status = testcase.get('status', 'run')
+        if testcase.find('failure') is not None or status == 'fail':
+            status = 'FAILED'
+        elif testcase.find('skipped') is not None or status == 'notrun':
+            status = 'not run'
+        else:
+            status = 'passed'
+        reason = failure_reason(testcase) if status == 'FAILED' else ''
+        results.append((testcase.get('name'), status,
+                        float(testcase.get('time') or 0), reason))
+    return results
+
+
+def ctest_outcomes(results):
+    ''' {case: passed} of the cases that ran '''
+    return {r[0]: r[1] == 'passed' for r in results if r[1] != 'not run'}
+
+
+def process_junit(job_obj, results):
+    ''' Add a table of the ctest JUnit results to the comment '''
+    logger = logging.getLogger('REGR/PROCESS_JUNIT')
+    num_failed = len([r for r in results if r[1] == 'FAILED'])
+    num_passed = len([r for r in results if r[1].startswith('passed')])
+    logger.info(f'{num_failed} of {len(results)} regression tests failed')
+    job_obj.comment_append(f'Regression tests: {num_passed} '
+                           f'of {len(results)} passed')
+    job_obj.comment_append('| Test | Status | Time (s) | Reason |')
+    job_obj.comment_append('| --- | --- | ---: | --- |')
+    for name, status, seconds, reason in results:
+        job_obj.comment_append(f'| {name} | {status} | {seconds:.0f} | '
+                               f'{reason.replace("|", "/")} |')
+
+
 def clone_pr_repo(job_obj, workdir):
     ''' clone the GitHub pull request repo, via command line '''
     logger = logging.getLogger('REGR/CLONE_PR_REPO')
@@ -94,9 +252,9 @@ def clone_pr_repo(job_obj, workdir):
     pr_repo_loc = f'{repo_dir_str}/{app_name}'
     job_obj.comment_append(f'Repo location: {pr_repo_loc}')
 
-    create_repo_commands = [
-        [f'mkdir -p "{repo_dir_str}"', os.getcwd()],
-        [f'git clone -b {app_branch} {git_url}', repo_dir_str]]
+    create_repo_commands = prefetch.clone_commands(job_obj, repo_dir_str,
+                                                   app_name, app_branch,
+                                                   git_url)
     job_obj.run_commands(logger, create_repo_commands)
 
     # copy any extra or revised files needed
@@ -115,6 +273,7 @@ def post_process(job_obj, build_script_loc, log_name, pr_repo_loc):
     gsi_exe = pr_repo_loc + '/install/bin/gsi.x'
     enkf_exe = pr_repo_loc + '/install/bin/enkf.x'
     build_succeeded = False
+    compcache.report(job_obj)
 
     if os.path.exists(ci_log):
         # were the executables created?
@@ -148,12 +307,13 @@ def process_gen(job_obj, gen_log_loc, gen_log_name):
     if os.path.exists(gen_log):
         with open(gen_log) as fname:
             for line in fname:
-                if error_string in line or error_msg in line:
+                if (error_string in line or error_msg in line) and \
+                   not gen_failed:
                     job_obj.comment_append('Generating Workflow Failed')
                     gen_failed = True
                     logger.info('Generating workflow failed')
                 if gen_failed:
-                    job_obj.comment_append(f'{line.rstrip()}')
+                    job_obj.finding('workflow generation', line)
 
 
 def process_expt(job_obj, expts_base_dir):
@@ -0,0 +1,143 @@
+"""
+Name: rerun.py
+Python to run again only the tests that failed in the last run of a PR,
+in that run's clone and build: weather model regression tests from its
+RegressionTests log, GSI ctest cases from its JUnit results and WE2E
+experiments whose workflow died. Started by labels such as
+ci-hera-intel-rerun. Results are recorded in the test history, so a
+failure that passes on rerun marks the test as flaky.
+"""
+
+# Imports
+import datetime
+import glob
+import logging
+import os
+
+import flaky
+from jobs import build
+from jobs import regr
+from jobs import rt
+
+FAILED_STRING = 'DEAD'
+
+
+def run(job_obj):
+    """
+    Reruns the failed tests of the last run of a PR
+    """
+    logger = logging.getLogger('RERUN/RUN')
+    pr_repo_loc, repo_dir_str = last_run(job_obj)
+    issue_id = 0
+    if pr_repo_loc is None:
+        job_obj.comment_append('No earlier run of this PR to rerun')
+    elif not same_head(job_obj, pr_repo_loc):
+        job_obj.comment_append('The PR has new commits since its last run, '
+                               'please label the full test again')
+    else:
+        job_obj.run_dir = repo_dir_str
+        job_obj.comment_append(f'Rerunning failed tests in {pr_repo_loc}')
+        rt_log = rt.rt_logfile(job_obj, pr_repo_loc)
+        ctest_loc = pr_repo_loc + '/build/regression'
+        expts_base_dir = os.path.join(repo_dir_str, 'expt_dirs')
+        if os.path.exists(rt_log):
+            rerun_rt(job_obj, pr_repo_loc, rt_log)
+        elif os.path.exists(f'{ctest_loc}/{regr.CTEST_NAME}.xml'):
+            rerun_ctest(job_obj, pr_repo_loc, ctest_loc)
+        elif os.path.isdir(expts_base_dir):
+            issue_id = rerun_we2e(job_obj, pr_repo_loc, repo_dir_str,
+                                  expts_base_dir)
+        else:
+            job_obj.comment_append('No test results found in the last run')
+    # Only write out comments if not already written after workflow running
+    if issue_id == 0:
+        issue_id = job_obj.send_comment_text()
+        logger.debug(f'Issue comment id is {issue_id}')
+
+
+def last_run(job_obj):
+    ''' (pr_repo_loc, repo_dir_str) of the newest clone of this PR for
+        this compiler, (None, None) if there is none '''
+    app_name = job_obj.repo['app_address'].split('/')[1]
+    pr_id = str(job_obj.preq_dict['preq'].id)
+    # build jobs clone to <workdir>/<id>, the others to <workdir>/pr/<id>
+    run_dirs = glob.glob(os.path.join(job_obj.workdir, pr_id, '*')) + \
+        glob.glob(os.path.join(job_obj.workdir, 'pr', pr_id, '*'))
+    for repo_dir_str in sorted(run_dirs, key=os.path.basename,
+                               reverse=True):
+        pr_repo_loc = f'{repo_dir_str}/{app_name}'
+        # the copy a matrix RT job made for this compiler
+        if os.path.isdir(f'{pr_repo_loc}_{job_obj.compiler}'):
+            return f'{pr_repo_loc}_{job_obj.compiler}', repo_dir_str
+        if os.path.isdir(pr_repo_loc):
+            return pr_repo_loc, repo_dir_str
+    return None, None
+
+
+def same_head(job_obj, pr_repo_loc):
+    ''' False if the PR's own repo in the clone is not at its head '''
+    return job_obj.clone_sha(pr_repo_loc) == \
+        job_obj.preq_dict['preq'].head.sha
+
+
+def rerun_rt(job_obj, pr_repo_loc, rt_log):
+    ''' Rerun the failed tests of the RegressionTests log '''
+    results = flaky.rt_results(rt_log, job_obj.compiler)
+    failed = [name for name, passed in results.items() if not passed]
+    if not failed:
+        job_obj.comment_append('No failed tests in the last '
+                               'RegressionTests log')
+        return
+    job_obj.comment_append(f'Rerunning {len(failed)} failed tests')
+    rt.rerun_tests(job_obj, pr_repo_loc, failed)
+    rt.report_results(job_obj, pr_repo_loc)
+
+
+def rerun_ctest(job_obj, pr_repo_loc, ctest_loc):
+    ''' Rerun the failed cases of the last ctest run '''
+    results = regr.read_junit(job_obj, f'{ctest_loc}/{regr.CTEST_NAME}.xml')
+    failed = [r[0] for r in results or [] if r[1] == 'FAILED']
+    if not failed:
+        job_obj.comment_append('No failed cases in the last ctest run')
+        return
+    job_obj.comment_append(f'Rerunning {len(failed)} failed cases')
+    regr.load_modules(job_obj, pr_repo_loc)
+    regr.process_junit(job_obj, regr.rerun_cases(job_obj, ctest_loc,
+                                                 results, failed))
+
+
+def rerun_we2e(job_obj, pr_repo_loc, repo_dir_str, expts_base_dir):
+    ''' Set the failed experiments aside and start them again.
+        Returns the issue id if the comment was written '''
+    logger = logging.getLogger('RERUN/RERUN_WE2E')
+    failed = []
+    for expt in sorted(os.listdir(expts_base_dir)):
+        expt_log = os.path.join(expts_base_dir, expt, 'log/FV3LAM_wflow.log')
+        if os.path.exists(expt_log):
+            with open(expt_log) as fname:
+                if any(FAILED_STRING in line for line in fname):
+                    failed.append(expt)
+    if not failed:
+        job_obj.comment_append('No failed experiments in the last run')
+        return 0
+    failed_dir = os.path.join(
+        repo_dir_str,
+        f'expt_dirs_failed_{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}')
+    os.makedirs(failed_dir)
+    for expt in failed:
+        os.rename(os.path.join(expts_base_dir, expt),
+                  os.path.join(failed_dir, expt))
+    job_obj.comment_append(f'Rerunning {len(failed)} failed experiments, '
+                           f'earlier ones moved to {failed_dir}')
+    build.set_top_dir(job_obj, pr_repo_loc)
+    expt_script_loc = pr_repo_loc + '/tests/WE2E'
+    build.setup_we2e(job_obj, expt_script_loc, failed, 'expt.out')
+    logger.info('After end_to_end script')
+    # the experiments that passed before are still in expts_base_dir
+    started = [expt for expt in failed
+               if os.path.isdir(os.path.join(expts_base_dir, expt))]
+    if started:
+        job_obj.comment_append('Rocoto jobs started')
+        return build.process_expt(job_obj, expts_base_dir, started)
+    build.process_setup(job_obj, os.path.join(expt_script_loc, 'expt.out'))
+    return 0
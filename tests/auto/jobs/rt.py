@@ -9,6 +9,17 @@ import datetime
 import logging
 import os
 
+import compcache
+import flaky
+import impact
+import jobstate
+import modenv
+import prefetch
+import rtperf
+import rtshard
+import submods
+import warm
+
 
 def run(job_obj):
     """
@@ -16,25 +27,52 @@ def run(job_obj):
     """
     logger = logging.getLogger('RT/RUN')
     logger.info('Started running regression test')
-    pr_repo_loc, repo_dir_str = clone_pr_repo(job_obj, job_obj.workdir)
+    pr_repo_loc, repo_dir_str = jobstate.phase(job_obj, 'cloned',
+                                               clone_pr_repo, job_obj,
+                                               job_obj.workdir)
+    job_obj.run_dir = repo_dir_str
     logger.info(f'pr_repo_loc is: {pr_repo_loc}')
     logger.info(f'repo_dir_str is: {repo_dir_str}')
-    run_regression_test(job_obj, pr_repo_loc)
+    tests = impact.select_tests(job_obj)
+    if tests == []:
+        job_obj.comment_append('No regression tests are affected by this PR')
+        issue_id = job_obj.send_comment_text()
+        logger.debug(f'Issue comment id is {issue_id}')
+        return
+    jobstate.phase(job_obj, 'tests-submitted', run_regression_test, job_obj,
+                   pr_repo_loc, tests)
     post_process(job_obj, pr_repo_loc, repo_dir_str)
     logger.info('Finished running regression test')
 
 
-def run_regression_test(job_obj, pr_repo_loc):
+def run_regression_test(job_obj, pr_repo_loc, tests=None):
+    ''' Run rt.sh on the full rt.conf, or only on tests if given '''
     logger = logging.getLogger('RT/RUN_REGRESSION_TEST')
     logger.info('Started run_regression_test')
     if job_obj.compiler == 'gnu':
-        rt_command = [[f'export RT_COMPILER="{job_obj.compiler}" && cd tests '
-                       '&& /bin/bash --login ./rt.sh -r -k -l rt_gnu.conf >& gnu_out',
-                       pr_repo_loc]]
+        conf = 'rt_gnu.conf'
     elif job_obj.compiler == 'intel':
-        rt_command = [[f'export RT_COMPILER="{job_obj.compiler}" && cd tests '
-                       '&& /bin/bash --login ./rt.sh -r -k >& intel_out', pr_repo_loc]]
-    job_obj.run_commands(logger, rt_command)
+        conf = 'rt.conf'
+    if tests:
+        ci_conf = 'rt_ci.conf'
+        num_tests = impact.filter_rt_conf(f'{pr_repo_loc}/tests/{conf}',
+                                          f'{pr_repo_loc}/tests/{ci_conf}',
+                                          tests)
+        logger.info(f'{num_tests} tests from {conf} in {ci_conf}')
+        conf = ci_conf
+    shell = modenv.script_shell(job_obj, pr_repo_loc)
+    compcache.use(job_obj)
+    warmer = warm.start(job_obj, pr_repo_loc, tests)
+    try:
+        if int(job_obj.machine_dict.get('rt_shards') or 1) > 1:
+            rtshard.run_sharded(job_obj, pr_repo_loc, conf, '-r -k', shell)
+        else:
+            rt_command = [[f'export RT_COMPILER="{job_obj.compiler}" '
+                           f'&& cd tests && {shell} ./rt.sh -r -k -l {conf} '
+                           f'>& {job_obj.compiler}_out', pr_repo_loc]]
+            job_obj.run_commands(logger, rt_command)
+    finally:
+        warm.finish(job_obj, warmer)
     logger.info('Finished run_regression_test')
 
 
@@ -63,11 +101,10 @@ def clone_pr_repo(job_obj, workdir):
                    f'{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}'
     pr_repo_loc = f'{repo_dir_str}/{app_name}'
     job_obj.comment_append(f'Repo location: {pr_repo_loc}')
-    create_repo_commands = [
-        [f'mkdir -p "{repo_dir_str}"', os.getcwd()],
-        [f'git clone -b {branch} {git_url} {app_name}', repo_dir_str],
-        ['git submodule update --init --recursive',
-         f'{repo_dir_str}/{app_name}'],
+    create_repo_commands = prefetch.clone_commands(job_obj, repo_dir_str,
+                                                   app_name, branch, git_url)
+    create_repo_commands += submods.hydrate_commands(job_obj, pr_repo_loc)
+    create_repo_commands += [
         ['git config user.email "venita.hagerty@noaa.gov"',
          f'{repo_dir_str}/{app_name}'],
         ['git config user.name "venitahagerty"',
@@ -84,18 +121,73 @@ def post_process(job_obj, pr_repo_loc, repo_dir_str):
     ''' This is the callback function associated with the "RT" command '''
     logger = logging.getLogger('RT/POST_PROCESS')
     logger.info('Started post_process')
-    rt_log = f'tests/RegressionTests_{job_obj.machine}'\
-             f'.{job_obj.compiler}.log'
-    filepath = f'{pr_repo_loc}/{rt_log}'
+    check_results(job_obj, pr_repo_loc)
+    # remove_pr_data(job_obj, pr_repo_loc, repo_dir_str, rt_dir)
+    issue_id = job_obj.send_comment_text()
+    logger.debug(f'Issue comment id is {issue_id}')
+    logger.info('Finished post_process')
+
+
+def rt_logfile(job_obj, pr_repo_loc):
+    return f'{pr_repo_loc}/tests/RegressionTests_{job_obj.machine}' \
+           f'.{job_obj.compiler}.log'
+
+
+def check_results(job_obj, pr_repo_loc):
+    ''' Retry the failures of known flaky tests, then add the
+        RegressionTests log results to the comment '''
+    retry_flaky(job_obj, pr_repo_loc)
+    return report_results(job_obj, pr_repo_loc)
+
+
+def retry_flaky(job_obj, pr_repo_loc):
+    ''' Record the results of the run and rerun its failed tests that
+        are known to be flaky '''
+    results = flaky.rt_results(rt_logfile(job_obj, pr_repo_loc),
+                               job_obj.compiler)
+    flaky.record(job_obj, 'rt', results)
+    retry = flaky.known(job_obj, 'rt', [name for name, passed
+                                        in results.items() if not passed])
+    if retry:
+        job_obj.comment_append(f'Retrying known flaky tests: '
+                               f'{" ".join(retry)}')
+        rerun_tests(job_obj, pr_repo_loc, retry)
+
+
+def rerun_tests(job_obj, pr_repo_loc, tests):
+    ''' Run tests again in the same clone. Their results replace the
+        earlier ones in the RegressionTests log '''
+    logger = logging.getLogger('RT/RERUN_TESTS')
+    filepath = rt_logfile(job_obj, pr_repo_loc)
+    first_log = f'{filepath}.first'
+    if os.path.exists(filepath):
+        os.replace(filepath, first_log)
+    logger.info(f'Rerunning {tests}, earlier log in {first_log}')
+    run_regression_test(job_obj, pr_repo_loc, tests)
+    results = flaky.rt_results(filepath, job_obj.compiler)
+    flaky.record(job_obj, 'rt', results)
+    # tests they depend on ran again too
+    flaky.merge_rt_logs(first_log, filepath, set(tests) | set(results),
+                        job_obj.compiler, filepath)
+    for name in tests:
+        if results.get(name):
+            job_obj.comment_append(f'{name}: failed, then passed on rerun '
+                                   f'(flaky)')
+        else:
+            job_obj.comment_append(f'{name}: failed again on rerun')
+
+
+def report_results(job_obj, pr_repo_loc):
+    ''' Add the RegressionTests log results to the comment '''
+    filepath = rt_logfile(job_obj, pr_repo_loc)
     rt_dir, logfile_pass = process_logfile(job_obj, filepath)
+    rtperf.check_logfile(job_obj, filepath, kind='pr')
+    compcache.report(job_obj)
     if logfile_pass:
         job_obj.comment_append('Regression test successful')
-        # remove_pr_data(job_obj, pr_repo_loc, repo_dir_str, rt_dir)
     else:
         job_obj.comment_append('Regression test FAILED')
-    issue_id = job_obj.send_comment_text()
-    logger.debug(f'Issue comment id is {issue_id}')
-    logger.info('Finished post_process')
+    return logfile_pass
 
 
 def process_logfile(job_obj, logfile):
@@ -108,7 +200,7 @@ def process_logfile(job_obj, logfile):
             for line in f:
                 if all(x in line for x in fail_string_list):
                     # if 'FAIL' in line and 'Test' in line:
-                    job_obj.comment_append(f'{line.rstrip(chr(10))}')
+                    job_obj.finding('regression tests', line)
                 elif 'working dir' in line and not rt_dir:
                     rt_dir = os.path.split(line.split()[-1])[0]
                     job_obj.comment_append(f'Please manually delete: '
@@ -0,0 +1,159 @@
+"""
+Name: jobstate.py
+Checkpoints for the phases of a job, so a job interrupted by a reboot or
+a killed cron run is resumed by the next ci_auto.py run instead of lost.
+
+The label that started a job is removed before the job runs, so without
+a record nothing would retry it. Each running job has a section in
+Jobstate.cfg (in the current directory, like Longjob.cfg) with its pull
+request, action, the last completed phase and what each phase returned:
+
+  queued -> cloned -> externals -> built -> tests-submitted -> reported
+
+Jobs built in a staging directory also have synced, see stage.py.
+
+The job modules run their long phases through phase(). When a job is
+resumed, phases that finished before the interruption are not run
+again; their recorded results (clone locations and so on) are returned
+and the comment text is restored to what it was at the last checkpoint.
+A job is removed from the file once it is reported.
+"""
+
+import datetime
+import json
+import logging
+import os
+
+STATE_FILE = 'Jobstate.cfg'
+PHASES = ['queued', 'cloned', 'externals', 'built', 'synced',
+          'tests-submitted', 'reported']
+# A job that was interrupted this many times is given up on
+MAX_RESUMES = 2
+
+
+def read_states():
+    from configparser import ConfigParser as config_parser
+
+    config = config_parser(interpolation=None)
+    # labels and paths are case sensitive
+    config.optionxform = str
+    if os.path.exists(STATE_FILE):
+        config.read(STATE_FILE)
+    return config
+
+
+def write_states(config):
+    if not config.sections():
+        if os.path.exists(STATE_FILE):
+            os.remove(STATE_FILE)
+        return
+    tmp_file = f'{STATE_FILE}.{os.getpid()}'
+    with open(tmp_file, 'w') as fname:
+        config.write(fname)
+    os.replace(tmp_file, STATE_FILE)
+
+
+def label_name(label):
+    ''' Discovered jobs have a PyGithub Label, resumed jobs its name '''
+    return getattr(label, 'name', label)
+
+
+def job_key(job_obj):
+    return f'{job_obj.repo["address"]}#{job_obj.preq_dict["preq"].number}' \
+           f'|{label_name(job_obj.preq_dict["label"])}'
+
+
+def save(job_obj, state, results):
+    config = read_states()
+    key = job_key(job_obj)
+    if not config.has_section(key):
+        config[key] = {}
+    config[key]['address'] = job_obj.repo['address']
+    config[key]['pr_num'] = str(job_obj.preq_dict['preq'].number)
+    config[key]['label'] = label_name(job_obj.preq_dict['label'])
+    config[key]['compiler'] = job_obj.compiler
+    config[key]['action'] = job_obj.preq_dict['action']
+    config[key]['state'] = state
+    config[key]['results'] = json.dumps(results)
+    config[key]['comment_text'] = json.dumps(job_obj.comment_text)
+    config[key]['resumes'] = str(getattr(job_obj, 'resumes', 0))
+    config[key]['updated'] = datetime.datetime.now().isoformat(
+        timespec='seconds')
+    write_states(config)
+
+
+def start(job_obj):
+    ''' Record a job as queued before its label is removed '''
+    if job_obj.resumed is None:
+        job_obj.resumed = {}
+        save(job_obj, PHASES[0], {})
+
+
+def phase(job_obj, name, func, *args):
+    ''' Run func(*args) as phase name of the job and checkpoint its
+        result, or return the recorded result if a run of this job
+        that was interrupted already finished the phase '''
+    logger = logging.getLogger('JOBSTATE/PHASE')
+    results = job_obj.resumed if job_obj.resumed is not None else {}
+    if name in results:
+        logger.info(f'Skipping phase {name}, finished before resume')
+        result = results[name]
+        return tuple(result) if isinstance(result, list) else result
+    result = func(*args)
+    results[name] = result
+    job_obj.resumed = results
+    save(job_obj, name, results)
+    logger.info(f'Checkpoint: {job_key(job_obj)} {name}')
+    return result
+
+
+def finish(job_obj):
+    ''' The job is reported, it no longer needs resuming '''
+    logger = logging.getLogger('JOBSTATE/FINISH')
+    config = read_states()
+    key = job_key(job_obj)
+    if config.remove_section(key):
+        write_states(config)
+        logger.info(f'{key} reported')
+
+
+def resume_jobs(repos, machine_dict, ghinterface_obj, job_class):
+    ''' Build job_class objects for the interrupted jobs '''
+    logger = logging.getLogger('JOBSTATE/RESUME_JOBS')
+    jobs = []
+    config = read_states()
+    for key in config.sections():
+        state = config[key]
+        repo = next((repo for repo in repos
+                     if repo['address'] == state['address']), None)
+        resumes = int(state.get('resumes', '0')) + 1
+        try:
+            if repo is None:
+                raise KeyError(f'{state["address"]} not in CIrepos.cfg')
+            preq = ghinterface_obj.client.get_repo(state['address']) \
+                                         .get_pull(int(state['pr_num']))
+        except Exception as e:
+            logger.info(f'Cannot resume {key}: {e}')
+            config.remove_section(key)
+            continue
+        preq_dict = {'preq': preq, 'label': state['label'],
+                     'action': state['action']}
+        job = job_class(preq_dict, ghinterface_obj, machine_dict,
+                        state['compiler'], repo)
+        job.comment_text = json.loads(state['comment_text'])
+        job.resumes = resumes
+        if resumes > MAX_RESUMES:
+            logger.info(f'Giving up on {key} after {resumes} interruptions')
+            job.comment_append(f'Job was interrupted {resumes} times '
+                               f'after phase {state["state"]}, giving up')
+            job.send_comment_text()
+            config.remove_section(key)
+            continue
+        state['resumes'] = str(resumes)
+        job.resumed = json.loads(state['results'])
+        job.comment_append(f'Resumed after an interruption, last '
+                           f'completed phase: {state["state"]}')
+        logger.info(f'Resuming {key} after phase {state["state"]}')
+        jobs.append(job)
+    write_states(config)
+    return jobs
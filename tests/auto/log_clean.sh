@@ -1,6 +1,13 @@
 #!/bin/bash
 set -eu
 
-find /scratch2/BMC/zrtrr/rrfs_ci/autoci/tests/auto -type f -name "*.log" -size -400c -delete
-find /scratch2/BMC/zrtrr/rrfs_ci/autoci/tests/auto -type f -name "*.log" -mtime +7 -delete
+# Roll finished ci_auto/ci_long logs into the compressed archive in
+# logarchive/ and drop archive segments older than 90 days.
+# Usage: log_clean.sh [machine]   (machine defaults to hera)
+machine=${1:-hera}
+
+cd /scratch2/BMC/zrtrr/rrfs_ci/autoci/tests/auto
+./start_ci_py_pro.sh "${machine}" "logarchive.py roll --keep-days 90"
 
+# Anything the archive could not take is still removed after a week
+find /scratch2/BMC/zrtrr/rrfs_ci/autoci/tests/auto -type f -name "*.log" -mtime +7 -delete
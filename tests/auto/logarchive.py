@@ -0,0 +1,216 @@
+"""
+Name: logarchive.py
+Rolls finished ci_auto_<timestamp>.log, ci_long_<timestamp>.log and
+prefetch_<timestamp>.log files into compressed daily segments and keeps
+a small index so runs can be found without decompressing everything.
+
+Each log becomes one gzip member appended to
+logarchive/<prog>_<YYYYMMDD>.seg.gz, and one line in logarchive/index.txt
+records where the member starts, its length, and the pull requests,
+labels, job phases (logger names) and severities that appear in it.
+
+Usage (run from tests/auto, e.g. through start_ci_py_pro.sh):
+  python logarchive.py                 roll finished logs (same as roll)
+  python logarchive.py roll [--keep-days N]
+  python logarchive.py find [--pr 512] [--label ci-hera-intel-RT]
+                            [--phase BUILD] [--severity CRITICAL]
+                            [--since YYYYMMDD] [--until YYYYMMDD] [--show]
+"""
+
+import argparse
+import datetime
+import glob
+import gzip
+import logging
+import os
+import re
+import sys
+
+ARCHIVE_DIR = 'logarchive'
+INDEX_FILE = 'index.txt'
+LOG_PATTERNS = ['ci_auto_*.log', 'ci_long_*.log', 'prefetch_*.log']
+# A log without 'Script Finished' is treated as a crashed run after this
+STALE_HOURS = 48
+
+name_re = re.compile(r'^(ci_auto|ci_long|prefetch)_(\d{14})\.log$')
+# Default logging format is LEVEL:logger name:message
+record_re = re.compile(r'^(DEBUG|INFO|WARNING|ERROR|CRITICAL):([^:]+):')
+pr_re = re.compile(r'([\w.-]+/[\w.-]+)#(\d+)')
+label_re = re.compile(r'\bci-\w+-\w+-\w+')
+INDEX_FIELDS = ['name', 'segment', 'offset', 'length', 'stamp',
+                'prs', 'labels', 'phases', 'severities']
+
+
+def is_finished(log_file, now=None):
+    ''' A log is finished when its run logged Script Finished,
+        or when it has not been written for STALE_HOURS '''
+    now = now or datetime.datetime.now().timestamp()
+    if now - os.path.getmtime(log_file) > STALE_HOURS * 3600:
+        return True
+    with open(log_file, 'rb') as fname:
+        fname.seek(max(0, os.path.getsize(log_file) - 200))
+        return b'Script Finished' in fname.read()
+
+
+def scan_log(text):
+    ''' Return the sets of PRs, labels, phases and severities in a log '''
+    prs, labels, phases, severities = set(), set(), set(), set()
+    for line in text.splitlines():
+        match = record_re.match(line)
+        if match:
+            severities.add(match.group(1))
+            phases.add(match.group(2))
+        prs.update(f'{repo}#{num}' for repo, num in pr_re.findall(line))
+        labels.update(label_re.findall(line))
+    return prs, labels, phases, severities
+
+
+def read_index(archive_dir=ARCHIVE_DIR):
+    ''' Return the index as a list of dicts '''
+    entries = []
+    index_file = os.path.join(archive_dir, INDEX_FILE)
+    if not os.path.exists(index_file):
+        return entries
+    with open(index_file) as fname:
+        for line in fname:
+            values = line.rstrip('\n').split('\t')
+            if len(values) != len(INDEX_FIELDS):
+                continue
+            entry = dict(zip(INDEX_FIELDS, values))
+            entry['offset'] = int(entry['offset'])
+            entry['length'] = int(entry['length'])
+            for key in ['prs', 'labels', 'phases', 'severities']:
+                entry[key] = set(filter(None, entry[key].split(',')))
+            entries.append(entry)
+    return entries
+
+
+def write_index_line(fname, entry):
+    values = []
+    for key in INDEX_FIELDS:
+        value = entry[key]
+        if isinstance(value, set):
+            value = ','.join(sorted(value))
+        values.append(str(value))
+    fname.write('\t'.join(values) + '\n')
+
+
+def roll(log_dir='.', archive_dir=ARCHIVE_DIR):
+    ''' Move every finished log into its daily segment '''
+    logger = logging.getLogger('LOGARCHIVE/ROLL')
+    os.makedirs(archive_dir, exist_ok=True)
+    log_files = sorted(log_file for pattern in LOG_PATTERNS
+                       for log_file in glob.glob(os.path.join(log_dir,
+                                                              pattern)))
+    rolled = 0
+    with open(os.path.join(archive_dir, INDEX_FILE), 'a') as index:
+        for log_file in log_files:
+            match = name_re.match(os.path.basename(log_file))
+            if not match or not is_finished(log_file):
+                continue
+            prog, stamp = match.groups()
+            segment = f'{prog}_{stamp[:8]}.seg.gz'
+            with open(log_file, 'rb') as fname:
+                data = fname.read()
+            prs, labels, phases, severities = \
+                scan_log(data.decode('utf8', errors='replace'))
+            member = gzip.compress(data)
+            with open(os.path.join(archive_dir, segment), 'ab') as seg:
+                offset = seg.tell()
+                seg.write(member)
+            write_index_line(index, {
+                'name': os.path.basename(log_file), 'segment': segment,
+                'offset': offset, 'length': len(member), 'stamp': stamp,
+                'prs': prs, 'labels': labels, 'phases': phases,
+                'severities': severities})
+            index.flush()
+            os.remove(log_file)
+            rolled = rolled + 1
+    logger.info(f'Rolled {rolled} logs into {archive_dir}')
+    return rolled
+
+
+def prune(keep_days, archive_dir=ARCHIVE_DIR):
+    ''' Remove segments older than keep_days and their index lines '''
+    logger = logging.getLogger('LOGARCHIVE/PRUNE')
+    cutoff = (datetime.datetime.now() -
+              datetime.timedelta(days=keep_days)).strftime('%Y%m%d')
+    entries = read_index(archive_dir)
+    old = {entry['segment'] for entry in entries
+           if entry['stamp'][:8] < cutoff}
+    index_file = os.path.join(archive_dir, INDEX_FILE)
+    with open(index_file + '.tmp', 'w') as fname:
+        for entry in entries:
+            if entry['segment'] not in old:
+                write_index_line(fname, entry)
+    os.replace(index_file + '.tmp', index_file)
+    for segment in old:
+        seg_file = os.path.join(archive_dir, segment)
+        if os.path.exists(seg_file):
+            os.remove(seg_file)
+    logger.info(f'Removed {len(old)} segments older than {cutoff}')
+
+
+def find(pr=None, label=None, phase=None, severity=None, since=None,
+         until=None, archive_dir=ARCHIVE_DIR):
+    ''' Return index entries matching all of the given filters.
+        pr may be a number or repo#number, phase matches the start of
+        a logger name, since/until are YYYYMMDD and inclusive '''
+    found = []
+    for entry in read_index(archive_dir):
+        day = entry['stamp'][:8]
+        if since and day < since or until and day > until:
+            continue
+        if pr and not any(p == str(pr) or p.endswith(f'#{pr}')
+                          for p in entry['prs']):
+            continue
+        if label and label not in entry['labels']:
+            continue
+        if phase and not any(p.startswith(phase) for p in entry['phases']):
+            continue
+        if severity and severity not in entry['severities']:
+            continue
+        found.append(entry)
+    return found
+
+
+def read_log(entry, archive_dir=ARCHIVE_DIR):
+    ''' Decompress a single archived log '''
+    with open(os.path.join(archive_dir, entry['segment']), 'rb') as seg:
+        seg.seek(entry['offset'])
+        return gzip.decompress(seg.read(entry['length'])).decode('utf8')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Archive of CI run logs')
+    sub = parser.add_subparsers(dest='command')
+    roll_parser = sub.add_parser('roll', help='archive finished logs')
+    roll_parser.add_argument('--keep-days', type=int, default=0,
+                             help='also remove segments older than this')
+    find_parser = sub.add_parser('find', help='look up archived logs')
+    find_parser.add_argument('--pr')
+    find_parser.add_argument('--label')
+    find_parser.add_argument('--phase')
+    find_parser.add_argument('--severity')
+    find_parser.add_argument('--since', help='YYYYMMDD')
+    find_parser.add_argument('--until', help='YYYYMMDD')
+    find_parser.add_argument('--show', action='store_true',
+                             help='print the matching logs')
+    args = parser.parse_args(argv)
+
+    if args.command == 'find':
+        for entry in find(args.pr, args.label, args.phase, args.severity,
+                          args.since, args.until):
+            print(f'{entry["name"]} {",".join(sorted(entry["labels"]))} '
+                  f'{",".join(sorted(entry["prs"]))}')
+            if args.show:
+                print(read_log(entry))
+    else:
+        logging.basicConfig(level=logging.INFO)
+        roll()
+        if args.command == 'roll' and args.keep_days:
+            prune(args.keep_days)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""
+Name: modenv.py
+Cached environment snapshots for the build and test commands of a job.
+
+The module loads for a (machine, compiler, module commands,
+modulefiles hash) are run once in a login shell, and the resulting
+environment is saved under {workdir}/envcache. Jobs set
+job_obj.command_env to the snapshot, and Job.run_subprocess passes it
+as env to every later command, so each command starts with the modules
+loaded without starting Lmod again.
+
+Secrets such as the GitHub token are never written to the cache; they
+and the variables the job modules set for their scripts are copied from
+this process when a snapshot is used.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import subprocess
+
+CACHE_DIR = 'envcache'
+# Per shell variables that must not be carried into other commands
+SKIP_VARS = ['PWD', 'OLDPWD', 'SHLVL', '_', 'ghapitoken']
+# Variables taken from this process rather than from the snapshot
+CARRY_VARS = ['ghapitoken', 'USER', 'HOME', 'config_path',
+              'SR_WX_APP_TOP_DIR']
+
+
+def modulefiles_hash(modulefiles_dir):
+    ''' Hash of every file under a modulefiles directory '''
+    digest = hashlib.sha256()
+    for root, dirs, names in sorted(os.walk(modulefiles_dir)):
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, modulefiles_dir).encode())
+            with open(path, 'rb') as fname:
+                digest.update(fname.read())
+    return digest.hexdigest()[:16]
+
+
+def commands_hash(module_commands, repo_loc):
+    ''' Hash of the module commands, with the clone path left out since
+        every PR clone has its own '''
+    commands = module_commands.replace(repo_loc, '{repo}')
+    return hashlib.sha256(commands.encode()).hexdigest()[:8]
+
+
+def capture_env(module_commands, in_cwd):
+    ''' Run module commands in a login shell and return its environment '''
+    command = f'{module_commands} >/dev/null 2>&1 && env -0'
+    output = subprocess.run(['/bin/bash', '--login', '-c', command],
+                            cwd=in_cwd, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, check=True)
+    env = {}
+    for item in output.stdout.decode('utf8').split('\0'):
+        key, sep, value = item.partition('=')
+        if sep and key not in SKIP_VARS:
+            env[key] = value
+    return env
+
+
+def snapshot(job_obj, repo_loc, module_commands, modulefiles_dir):
+    ''' Return the environment after module_commands, from the cache if
+        the same commands loaded the same modulefiles before on this
+        machine and compiler. Returns None if the snapshot cannot be made '''
+    logger = logging.getLogger('MODENV/SNAPSHOT')
+    if job_obj.harness_active():
+        # a replay runs no module commands
+        return None
+    cache_dir = os.path.join(job_obj.workdir, CACHE_DIR)
+    try:
+        key = f'{job_obj.machine}.{job_obj.compiler}.' \
+              f'{commands_hash(module_commands, repo_loc)}.' \
+              f'{modulefiles_hash(modulefiles_dir)}'
+    except OSError as e:
+        logger.info(f'Cannot hash {modulefiles_dir}: {e}')
+        return None
+    cache_file = os.path.join(cache_dir, f'{key}.json')
+    if os.path.exists(cache_file):
+        logger.info(f'Using environment snapshot {cache_file}')
+        with open(cache_file) as fname:
+            cached = json.load(fname)
+        # the snapshot may have been made in an earlier clone
+        env = {k: v.replace(cached['repo'], repo_loc)
+               for k, v in cached['env'].items()}
+    else:
+        logger.info(f'Creating environment snapshot {cache_file}')
+        try:
+            env = capture_env(module_commands, repo_loc)
+        except Exception as e:
+            logger.info(f'Module loads failed, no snapshot: {e}')
+            return None
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = f'{cache_file}.{os.getpid()}'
+        fd = os.open(tmp_file, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as fname:
+            json.dump({'repo': repo_loc, 'env': env}, fname)
+        os.replace(tmp_file, cache_file)
+    for var in CARRY_VARS:
+        if var in os.environ:
+            env[var] = os.environ[var]
+    return env
+
+
+def script_shell(job_obj, repo_loc):
+    ''' For scripts such as rt.sh that load their own modules: set
+        job_obj.command_env to a login shell snapshot and return the bash
+        command to start them with '''
+    job_obj.command_env = snapshot(job_obj, repo_loc, 'module purge',
+                                   f'{repo_loc}/modulefiles')
+    return '/bin/bash' if job_obj.command_env else '/bin/bash --login'
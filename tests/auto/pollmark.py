@@ -0,0 +1,130 @@
+"""
+Name: pollmark.py
+Cheap "has anything changed?" check that runs before ci_auto.py imports
+PyGithub. It keeps the ETag of the most recently updated open issue/PR
+for each watched repo and asks GitHub with a conditional request.
+A 304 answer does not count against the API rate limit, and if every
+repo answers 304 there is nothing new to look at.
+
+Only the standard library is used here so that an idle cron run stays fast.
+"""
+
+import logging
+import os
+import urllib.error
+import urllib.request
+
+MARK_FILE = 'Pollmark.txt'
+# Time of the last complete label search, for discovery=delta
+CURSOR_FILE = 'Pollcursor.txt'
+REPO_FILE = 'CIrepos.cfg'
+MACHINE_FILE = 'CImachine.cfg'
+TOKEN_FILE = 'accesstoken'
+API_URL = 'https://api.github.com/repos/{address}/issues'\
+          '?state=open&sort=updated&direction=desc&per_page=1'
+
+
+def read_token():
+    ''' Read the GitHub token without going through GHInterface '''
+    if not os.path.exists(TOKEN_FILE):
+        return None
+    with open(TOKEN_FILE) as f:
+        return f.readline().strip('\n')
+
+
+def read_marks(file_name=MARK_FILE):
+    ''' Return {repo address: etag} from the last full poll, or None
+        if there is no usable marker '''
+    if not os.path.exists(file_name):
+        return None
+    # A changed repo list always needs a full poll
+    if os.path.exists(REPO_FILE) and \
+       os.path.getmtime(REPO_FILE) > os.path.getmtime(file_name):
+        return None
+    marks = {}
+    with open(file_name) as fname:
+        for line in fname:
+            parts = line.split(None, 1)
+            if len(parts) == 2:
+                marks[parts[0]] = parts[1].strip()
+    return marks or None
+
+
+def write_marks(etags, file_name=MARK_FILE):
+    ''' Save the etags seen at the start of a full poll.
+        An incomplete set would hide repos, so remove the marker instead '''
+    logger = logging.getLogger('POLLMARK/WRITE_MARKS')
+    if not etags or not all(etags.values()):
+        logger.info('Incomplete etags, next run will do a full poll')
+        if os.path.exists(file_name):
+            os.remove(file_name)
+        return
+    with open(file_name, 'w') as fname:
+        for address, etag in sorted(etags.items()):
+            fname.write(f'{address} {etag}\n')
+
+
+def read_cursor(file_name=CURSOR_FILE):
+    ''' ISO time of the last complete label search, None for a full one '''
+    if not os.path.exists(file_name):
+        return None
+    # A changed repo list or label set always needs a full search
+    for config_file in [REPO_FILE, MACHINE_FILE]:
+        if os.path.exists(config_file) and \
+           os.path.getmtime(config_file) > os.path.getmtime(file_name):
+            return None
+    with open(file_name) as fname:
+        return fname.readline().strip() or None
+
+
+def write_cursor(stamp, file_name=CURSOR_FILE):
+    with open(file_name, 'w') as fname:
+        fname.write(f'{stamp}\n')
+
+
+def get_etag(address, token, etag=None, timeout=20):
+    ''' Return the current etag for a repo's open issue list.
+        Returns the etag passed in if GitHub answers 304 Not Modified,
+        or None if the request could not be made '''
+    logger = logging.getLogger('POLLMARK/GET_ETAG')
+    request = urllib.request.Request(API_URL.format(address=address))
+    request.add_header('Accept', 'application/vnd.github+json')
+    if token:
+        request.add_header('Authorization', f'token {token}')
+    if etag:
+        request.add_header('If-None-Match', etag)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.headers.get('ETag')
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return etag
+        logger.info(f'{address}: HTTP error {e.code}')
+    except Exception as e:
+        logger.info(f'{address}: {e}')
+    return None
+
+
+def current_etags(addresses, token=None):
+    ''' Unconditional etags for a list of repo addresses '''
+    if token is None:
+        token = read_token()
+    return {address: get_etag(address, token) for address in set(addresses)}
+
+
+def poll(file_name=MARK_FILE):
+    ''' Returns (changed, etags). changed is False only if every repo
+        in the marker answered 304. etags is empty when there is no
+        marker and the caller has to build it after reading CIrepos.cfg '''
+    logger = logging.getLogger('POLLMARK/POLL')
+    marks = read_marks(file_name)
+    if not marks:
+        logger.info('No poll marker, doing a full poll')
+        return True, {}
+    token = read_token()
+    etags = {address: get_etag(address, token, etag)
+             for address, etag in marks.items()}
+    changed = [address for address in etags
+               if etags[address] is None or etags[address] != marks[address]]
+    logger.info(f'Repos changed since last poll: {changed}')
+    return bool(changed), etags
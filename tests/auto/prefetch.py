@@ -0,0 +1,278 @@
+"""
+Name: prefetch.py
+Keeps ready checkouts of recently updated open pull requests, so a job
+started by a ci- label begins from a local clone rather than a full
+clone over the network.
+
+ci_auto.py already lists every open PR. It writes those whose head is
+the repo that a job clones (the app repo of CIrepos.cfg) and that were
+updated in the last prefetch_days to {workdir}/prefetch/candidates.json,
+then starts this script in the background at the lowest priority.
+For each candidate, newest first, a clone of the PR head with its
+submodules (or manage_externals repos) is made or brought up to date in
+{workdir}/prefetch/<PR id>. Checkouts are evicted least recently used
+first to stay within prefetch_gb, and ones for PRs no longer listed are
+removed first.
+
+When a job clones a PR that has a checkout here, clone_commands() moves
+it into the job directory and only fetches what changed since.
+
+Options from CImachine.cfg:
+  prefetch_gb    disk budget in GB for the checkouts (default 0, off)
+  prefetch_days  only PRs updated in this many days (default 3)
+
+Usage (normally started by ci_auto.py):
+  python prefetch.py <workdir>
+"""
+
+import datetime
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+
+import runlock
+import submods
+
+PREFETCH_DIR = 'prefetch'
+CANDIDATES_FILE = 'candidates.json'
+HEAD_FILE = 'head.json'
+LOCK_NAME = '.prefetch.lock'
+
+
+def prefetch_dir(workdir):
+    return os.path.join(workdir, PREFETCH_DIR)
+
+
+def enabled(machine_dict):
+    return float(machine_dict.get('prefetch_gb') or 0) > 0
+
+
+def write_candidates(machine_dict, repo_preqs):
+    ''' Save the recently updated open PRs that a job would clone as
+        they are. repo_preqs is the list made by PR discovery '''
+    logger = logging.getLogger('PREFETCH/WRITE_CANDIDATES')
+    days = float(machine_dict.get('prefetch_days') or 3)
+    since = datetime.datetime.now(datetime.timezone.utc) - \
+        datetime.timedelta(days=days)
+    candidates = []
+    for repo, preqs in repo_preqs:
+        app_name = repo['app_address'].split('/')[1]
+        for pr, labels in preqs:
+            updated = getattr(pr, 'updated_at', None)
+            if updated is None or pr.head.repo is None or \
+               pr.head.repo.name != app_name:
+                continue
+            if updated.tzinfo is None:
+                # PyGithub returns naive UTC times before 2.0
+                updated = updated.replace(tzinfo=datetime.timezone.utc)
+            if updated < since:
+                continue
+            candidates.append({'id': pr.id, 'repo': pr.head.repo.full_name,
+                               'ref': pr.head.ref, 'sha': pr.head.sha,
+                               'app_name': app_name,
+                               'updated': updated.isoformat()})
+    candidates.sort(key=lambda c: c['updated'], reverse=True)
+    settings = {key: machine_dict.get(key) for key in
+                ['prefetch_gb', 'submodule_jobs', 'submodule_fetch']}
+    os.makedirs(prefetch_dir(machine_dict['workdir']), exist_ok=True)
+    file_name = os.path.join(prefetch_dir(machine_dict['workdir']),
+                             CANDIDATES_FILE)
+    tmp_file = f'{file_name}.{os.getpid()}'
+    with open(tmp_file, 'w') as fname:
+        json.dump({'settings': settings, 'candidates': candidates}, fname,
+                  indent=1)
+    os.replace(tmp_file, file_name)
+    logger.info(f'{len(candidates)} PRs to prefetch')
+
+
+def spawn(machine_dict):
+    ''' Start this script in the background, it outlives ci_auto.py '''
+    logger = logging.getLogger('PREFETCH/SPAWN')
+    script = os.path.abspath(__file__)
+    subprocess.Popen([sys.executable, script, machine_dict['workdir']],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, start_new_session=True)
+    logger.info('Started background prefetch')
+
+
+def read_head(entry_dir):
+    try:
+        with open(os.path.join(entry_dir, HEAD_FILE)) as fname:
+            return json.load(fname)
+    except (OSError, ValueError):
+        return None
+
+
+def write_head(entry_dir, head):
+    with open(os.path.join(entry_dir, HEAD_FILE), 'w') as fname:
+        json.dump(head, fname)
+
+
+def clone_commands(job_obj, repo_dir_str, app_name, branch, git_url):
+    ''' Commands that put the PR head at {repo_dir_str}/{app_name}:
+        a prefetched checkout moved there and updated if there is one
+        for this PR, a fresh clone otherwise '''
+    logger = logging.getLogger('PREFETCH/CLONE_COMMANDS')
+    preq = job_obj.preq_dict['preq']
+    pr_repo_loc = f'{repo_dir_str}/{app_name}'
+    entry_dir = os.path.join(prefetch_dir(job_obj.workdir), str(preq.id))
+    head = read_head(entry_dir)
+    if head and head['repo'] == preq.head.repo.full_name and \
+       head['ref'] == branch and head['app_name'] == app_name:
+        os.makedirs(repo_dir_str, exist_ok=True)
+        try:
+            # a rename on the same file system, it cannot half happen
+            os.rename(os.path.join(entry_dir, app_name), pr_repo_loc)
+        except OSError as e:
+            logger.info(f'Could not take prefetched checkout: {e}')
+        else:
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            logger.info(f'Using prefetched checkout of {head["sha"]}')
+            job_obj.comment_append(f'Started from prefetched checkout '
+                                   f'of {head["sha"][:8]}')
+            return [[f'git fetch {git_url} {branch} && '
+                     f'git reset --hard FETCH_HEAD', pr_repo_loc]]
+    return [[f'mkdir -p "{repo_dir_str}"', os.getcwd()],
+            [f'git clone -b {branch} {git_url} {app_name}', repo_dir_str]]
+
+
+def hydrate_command(repo_loc, settings):
+    ''' Submodules or manage_externals repos of a checkout '''
+    if os.path.exists(os.path.join(repo_loc, '.gitmodules')):
+        return submods.update_command(settings.get('submodule_jobs') or 8,
+                                      settings.get('submodule_fetch') or
+                                      'blobless')
+    if os.path.exists(os.path.join(repo_loc, 'manage_externals')):
+        return './manage_externals/checkout_externals'
+    return None
+
+
+def disk_usage(path):
+    total = 0
+    for root, dirs, names in os.walk(path):
+        for name in names:
+            try:
+                total = total + os.lstat(os.path.join(root, name)).st_blocks
+            except OSError:
+                pass
+    return total * 512
+
+
+def run(logger, command, in_cwd):
+    logger.info(f'Running `{command}` in {in_cwd}')
+    output = subprocess.run(command, shell=True, cwd=in_cwd,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if output.returncode != 0:
+        logger.info(output.stdout.decode('utf8', errors='replace'))
+        raise Exception(f'Nonzero returncode: {output.returncode}')
+
+
+def refresh(logger, base_dir, candidate, settings):
+    ''' Make or update the checkout for one candidate, in a scratch dir
+        that is renamed into place when it is complete '''
+    entry_dir = os.path.join(base_dir, str(candidate['id']))
+    head = read_head(entry_dir)
+    if head and head['sha'] == candidate['sha']:
+        os.utime(os.path.join(entry_dir, HEAD_FILE))
+        return
+    work_dir = f'{entry_dir}.tmp{os.getpid()}'
+    shutil.rmtree(work_dir, ignore_errors=True)
+    repo_loc = os.path.join(work_dir, candidate['app_name'])
+    git_url = f'https://${{ghapitoken}}@github.com/{candidate["repo"]}'
+    if head and head['repo'] == candidate['repo']:
+        os.rename(entry_dir, work_dir)
+        run(logger, f'git fetch {git_url} {candidate["ref"]} && '
+                    f'git reset --hard FETCH_HEAD', repo_loc)
+    else:
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.makedirs(work_dir)
+        run(logger, f'git clone -b {candidate["ref"]} {git_url} '
+                    f'{candidate["app_name"]}', work_dir)
+    command = hydrate_command(repo_loc, settings)
+    if command:
+        run(logger, command, repo_loc)
+    head = dict(candidate, bytes=disk_usage(work_dir))
+    write_head(work_dir, head)
+    os.rename(work_dir, entry_dir)
+    logger.info(f'Prefetched {candidate["repo"]} {candidate["ref"]} '
+                f'{candidate["sha"]}, {head["bytes"] / 1e9:.1f} GB')
+
+
+def evict(logger, base_dir, budget, keep_ids):
+    ''' Remove checkouts of PRs not in keep_ids, then the least recently
+        used ones, until the rest fit in budget bytes '''
+    entries = []
+    for name in os.listdir(base_dir):
+        entry_dir = os.path.join(base_dir, name)
+        if '.tmp' in name and os.path.isdir(entry_dir):
+            # left by a prefetch that was killed
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            continue
+        head = read_head(entry_dir)
+        if head is None:
+            continue
+        used = os.path.getmtime(os.path.join(entry_dir, HEAD_FILE))
+        entries.append((name not in keep_ids, used, entry_dir, head))
+    # not wanted first, then oldest first
+    entries.sort(key=lambda e: (not e[0], e[1]))
+    total = sum(head.get('bytes', 0) for _, _, _, head in entries)
+    for unwanted, used, entry_dir, head in entries:
+        if not unwanted and total <= budget:
+            break
+        logger.info(f'Evicting {entry_dir}')
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total = total - head.get('bytes', 0)
+    return total
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    log_filename = f'prefetch_'\
+                   f'{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}.log'
+    logging.basicConfig(filename=log_filename, filemode='w',
+                        level=logging.INFO)
+    logger = logging.getLogger('PREFETCH/MAIN')
+    logger.info('Starting Script')
+    base_dir = prefetch_dir(argv[0])
+    # only use what the jobs leave over
+    os.nice(19)
+    lock = runlock.RunLock(base_dir, name=LOCK_NAME)
+    if not lock.acquire():
+        logger.info('Another prefetch is running')
+        logger.info('Script Finished')
+        return
+    try:
+        with open(os.path.join(base_dir, CANDIDATES_FILE)) as fname:
+            listing = json.load(fname)
+        settings = listing['settings']
+        budget = float(settings.get('prefetch_gb') or 0) * 1e9
+        candidates = listing['candidates']
+        keep_ids = {str(candidate['id']) for candidate in candidates}
+        total = evict(logger, base_dir, budget, keep_ids)
+        for candidate in candidates:
+            # a new checkout is assumed to be as large as the largest one
+            sizes = [head['bytes'] for head in
+                     [read_head(os.path.join(base_dir, name))
+                      for name in os.listdir(base_dir)]
+                     if head and head['repo'] == candidate['repo']]
+            if total + max(sizes, default=0) > budget and \
+               not read_head(os.path.join(base_dir, str(candidate['id']))):
+                logger.info('Disk budget reached')
+                break
+            try:
+                refresh(logger, base_dir, candidate, settings)
+            except Exception as e:
+                logger.info(f'Prefetch of {candidate["repo"]} '
+                            f'{candidate["ref"]} failed: {e}')
+            total = evict(logger, base_dir, budget, keep_ids)
+        logger.info(f'Prefetched checkouts use {total / 1e9:.1f} GB')
+    finally:
+        lock.release()
+    logger.info('Script Finished')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,449 @@
+"""
+Name: replay.py
+Record and replay of ci_auto.py cycles, so the orchestration layer
+(get_preqs_with_actions, Job.run and the job modules) can be run,
+timed and profiled offline without GitHub, clones or builds.
+
+Record: run ci_auto.py with CI_RECORD=<scenario.json> set. The pull
+requests, labels and branches read from GitHub, the results of delta
+discovery searches and the returncode, output and log files of every
+command are saved to the scenario.
+
+Replay:
+  python replay.py scenario.json [more.json ...] [--repeat N] [--profile]
+Each scenario is replayed in a scratch directory: GitHub is answered
+from the recording, commands are not run and their recorded log files
+are written where the job modules expect them. Each command gets the
+recorded result of the same command in the same directory. The module
+environment snapshots, queue depth and usage queries the job modules
+make on their own are skipped while replaying. Comments that would have
+been posted are printed.
+"""
+
+import argparse
+import cProfile
+import fnmatch
+import json
+import logging
+import os
+import pstats
+import re
+import sys
+import tempfile
+import threading
+import time
+
+# Files produced by commands that the job modules read afterwards
+RECORD_PATTERNS = ['*.out', '*.log', 'log.*', '*.xml', 'Externals.cfg',
+                   'rt.sh', '*.conf', '*.x']
+# Larger files (and executables) are replayed as empty placeholders
+MAX_FILE_SIZE = 5 * 1024 * 1024
+stamp_re = re.compile(r'\d{14}')
+# the cursor of a delta search differs between record and replay
+updated_re = re.compile(r'\s*updated:>=\S+')
+repo_re = re.compile(r'repo:(\S+)')
+
+
+def pr_to_dict(pr):
+    ''' The parts of a PyGithub PullRequest used by the job modules '''
+    labels = [label.name for label in pr.labels]
+    # changed files are only needed for PRs that can start a job
+    files = []
+    if any(label.startswith('ci-') for label in labels):
+        files = [f.filename for f in pr.get_files()]
+    return {
+        'id': pr.id,
+        'number': pr.number,
+        'base': {'ref': pr.base.ref},
+        'head': {
+            'ref': pr.head.ref,
+            'sha': pr.head.sha,
+            'repo': {'name': pr.head.repo.name,
+                     'full_name': pr.head.repo.full_name},
+            'user': {'login': pr.head.user.login},
+        },
+        'labels': labels,
+        'files': files,
+    }
+
+
+class RecordingRepo:
+    ''' Wraps a PyGithub Repository and records what is read from it '''
+
+    def __init__(self, repo, record):
+        self._repo = repo
+        self._record = record
+
+    def __getattr__(self, name):
+        return getattr(self._repo, name)
+
+    def get_pulls(self, **kwargs):
+        pulls = list(self._repo.get_pulls(**kwargs))
+        self._record['pulls'][kwargs.get('base', '')] = \
+            [pr_to_dict(pr) for pr in pulls]
+        return pulls
+
+    def get_branches(self):
+        branches = list(self._repo.get_branches())
+        self._record['branches'] = [branch.name for branch in branches]
+        return branches
+
+
+def search_key(query):
+    return updated_re.sub('', query)
+
+
+class RecordingClient:
+    ''' Wraps a PyGithub client so repos and searches can be recorded '''
+
+    def __init__(self, client, github, searches):
+        self._client = client
+        self._github = github
+        self._searches = searches
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def get_repo(self, address):
+        record = self._github.setdefault(address,
+                                         {'pulls': {}, 'branches': []})
+        return RecordingRepo(self._client.get_repo(address), record)
+
+    def search_issues(self, query):
+        issues = list(self._client.search_issues(query))
+        self._searches[search_key(query)] = \
+            [pr_to_dict(issue.as_pull_request()) for issue in issues]
+        return issues
+
+
+class Recorder:
+    ''' Records a live ci_auto.py run into a scenario '''
+
+    def __init__(self, machine_dict, repos, actions):
+        self.scenario = {'machine_dict': dict(machine_dict),
+                         'repos': repos, 'actions': actions,
+                         'github': {}, 'searches': {}, 'commands': []}
+        self.workdir = machine_dict['workdir']
+
+    def wrap_client(self, client):
+        return RecordingClient(client, self.scenario['github'],
+                               self.scenario['searches'])
+
+    def changed_files(self, in_cwd, start):
+        ''' Files under the job directory written since start '''
+        files = {}
+        match = stamp_re.search(in_cwd)
+        if not in_cwd.startswith(self.workdir) or not match:
+            return files
+        top = in_cwd[:match.end()]
+        for root, dirs, names in os.walk(top):
+            dirs[:] = [d for d in dirs if d != '.git']
+            for name in names:
+                if not any(fnmatch.fnmatch(name, pattern)
+                           for pattern in RECORD_PATTERNS):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    if os.path.getmtime(path) < start:
+                        continue
+                    content = None
+                    if os.path.getsize(path) <= MAX_FILE_SIZE and \
+                       not name.endswith('.x'):
+                        with open(path, errors='replace') as fname:
+                            content = fname.read()
+                except OSError:
+                    continue
+                files[os.path.relpath(path, self.workdir)] = content
+        return files
+
+    def run_command(self, job_obj, logger, command, in_cwd):
+        start = time.time()
+        returncode, out = job_obj.run_subprocess(logger, command, in_cwd)
+        self.scenario['commands'].append({
+            'command': command,
+            'cwd': in_cwd,
+            'returncode': returncode,
+            'out': out,
+            'seconds': round(time.time() - start, 3),
+            'files': self.changed_files(in_cwd, start),
+        })
+        return returncode, out
+
+    def save(self, file_name):
+        with open(file_name, 'w') as fname:
+            json.dump(self.scenario, fname, indent=1)
+
+
+class FakeObject:
+    ''' Attribute access over a recorded dict '''
+
+    def __init__(self, values):
+        for key, value in values.items():
+            if isinstance(value, dict):
+                value = FakeObject(value)
+            setattr(self, key, value)
+
+
+class FakeLabel:
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return f'Label(name="{self.name}")'
+
+
+class FakePullRequest(FakeObject):
+
+    def __init__(self, values, replayer):
+        super().__init__({k: v for k, v in values.items()
+                          if k not in ['labels', 'files']})
+        self.labels = [FakeLabel(name) for name in values['labels']]
+        self.files = [FakeObject({'filename': name})
+                      for name in values.get('files', [])]
+        self._replayer = replayer
+
+    def get_labels(self):
+        return list(self.labels)
+
+    def get_files(self):
+        return list(self.files)
+
+    def remove_from_labels(self, label):
+        # PyGithub takes a Label or its name
+        name = getattr(label, 'name', label)
+        self.labels = [lab for lab in self.labels if lab.name != name]
+
+    def create_issue_comment(self, body):
+        return self._replayer.add_comment(self, body)
+
+    def get_issue_comment(self, id):
+        return self._replayer.comments[id - 1]
+
+
+class FakeIssue:
+    ''' A search result, which is an issue that is a pull request '''
+
+    def __init__(self, pr):
+        self.number = pr.number
+        self.labels = pr.get_labels()
+        self._pr = pr
+
+    def as_pull_request(self):
+        return self._pr
+
+
+class FakeComment:
+
+    def __init__(self, id, pr, body):
+        self.id = id
+        self.pr = pr
+        self.body = body
+
+    def edit(self, body):
+        self.body = body
+
+
+class FakeRepo:
+
+    def __init__(self, address, record, replayer):
+        self.address = address
+        self.pulls = {base: [FakePullRequest(pr, replayer) for pr in prs]
+                      for base, prs in record['pulls'].items()}
+        self.branches = [FakeObject({'name': name})
+                         for name in record['branches']]
+
+    def get_pulls(self, state='open', sort='created', base=''):
+        return list(self.pulls.get(base, []))
+
+    def get_pull(self, number):
+        return next(pr for prs in self.pulls.values() for pr in prs
+                    if pr.number == number)
+
+    def get_branches(self):
+        return list(self.branches)
+
+
+class FakeClient:
+
+    def __init__(self, scenario, replayer):
+        self.repos = {address: FakeRepo(address, record, replayer)
+                      for address, record in scenario['github'].items()}
+        self._replayer = replayer
+        # jobs fetch their pull request with get_pull, so the ones only
+        # found by a search are added to their repo
+        self.searches = {}
+        for key, prs in scenario.get('searches', {}).items():
+            address = repo_re.search(key).group(1)
+            repo = self.repos.setdefault(address, FakeRepo(
+                address, {'pulls': {}, 'branches': []}, replayer))
+            self.searches[key] = [self.pull(repo, pr) for pr in prs]
+
+    def pull(self, repo, values):
+        for pr in repo.pulls.get(None, []):
+            if pr.number == values['number']:
+                return pr
+        pr = FakePullRequest(values, self._replayer)
+        repo.pulls.setdefault(None, []).append(pr)
+        return pr
+
+    def get_repo(self, address):
+        return self.repos[address]
+
+    def search_issues(self, query):
+        logger = logging.getLogger('REPLAY/SEARCH_ISSUES')
+        if search_key(query) not in self.searches:
+            logger.info(f'No recorded result for search `{query}`')
+            self._replayer.mismatches = self._replayer.mismatches + 1
+            return []
+        return [FakeIssue(pr) for pr in self.searches[search_key(query)]]
+
+
+class FakeGHInterface:
+
+    def __init__(self, client):
+        self.client = client
+
+
+class Replayer:
+    ''' Replays a recorded scenario through ci_auto.py '''
+
+    def __init__(self, scenario, workdir):
+        self.scenario = scenario
+        self.workdir = workdir
+        self.commands = list(scenario['commands'])
+        self.comments = []
+        self.stamps = {}
+        self.mismatches = 0
+        self.lock = threading.Lock()
+
+    def add_comment(self, pr, body):
+        comment = FakeComment(len(self.comments) + 1, pr, body)
+        self.comments.append(comment)
+        return comment
+
+    def local_path(self, path):
+        ''' Map a recorded workdir-relative path to this replay '''
+        for recorded, replayed in self.stamps.items():
+            path = path.replace(recorded, replayed)
+        return os.path.join(self.workdir, path)
+
+    def normalize(self, command, in_cwd, workdir):
+        ''' A command and its directory without the workdir and the
+            timestamps, which differ between record and replay '''
+        return tuple(stamp_re.sub('', text or '').replace(workdir, '')
+                     for text in (command, in_cwd))
+
+    def next_entry(self, logger, command, in_cwd):
+        ''' The first recorded entry of the same command in the same
+            directory. Threads of matrix and sharded jobs record in no
+            fixed order, so entries are matched rather than taken in
+            turn; with no match the next entry is used '''
+        wanted = self.normalize(command, in_cwd, self.workdir)
+        recorded_workdir = self.scenario['machine_dict']['workdir']
+        with self.lock:
+            for index, entry in enumerate(self.commands):
+                if self.normalize(entry['command'], entry.get('cwd'),
+                                  recorded_workdir) == wanted:
+                    return self.commands.pop(index)
+            if not self.commands:
+                return None
+            logger.info(f'Replayed command differs from '
+                        f'`{self.commands[0]["command"]}`')
+            self.mismatches = self.mismatches + 1
+            return self.commands.pop(0)
+
+    def run_command(self, job_obj, logger, command, in_cwd):
+        entry = self.next_entry(logger, command, in_cwd)
+        if entry is None:
+            logger.info(f'No recorded result for `{command}`')
+            self.mismatches = self.mismatches + 1
+            return 0, []
+        # timestamps in directory names differ between record and replay
+        for recorded, replayed in zip(stamp_re.findall(entry['command']),
+                                      stamp_re.findall(command)):
+            self.stamps[recorded] = replayed
+        os.makedirs(in_cwd, exist_ok=True)
+        for path, content in entry['files'].items():
+            local = self.local_path(path)
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+            with open(local, 'w') as fname:
+                fname.write(content or '')
+        out = entry['out']
+        if entry['returncode'] != 0:
+            job_obj.job_failed(logger, f'Command {command}',
+                               exception=Exception('Nonzero returncode: '
+                                                   f'{entry["returncode"]}'),
+                               STDOUT=True, out=out, err=[])
+        return entry['returncode'], out
+
+
+def replay_scenario(file_name, ci_auto):
+    ''' Replay one scenario file, returns (seconds, replayer) '''
+    with open(file_name) as fname:
+        scenario = json.load(fname)
+    start_dir = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='ci_replay_') as scratch:
+        workdir = os.path.join(scratch, 'workdir')
+        os.makedirs(workdir)
+        machine_dict = dict(scenario['machine_dict'], workdir=workdir)
+        replayer = Replayer(scenario, workdir)
+        ghinterface_obj = FakeGHInterface(FakeClient(scenario, replayer))
+        ci_auto.harness = replayer
+        # state files such as Longjob.cfg are written in the current dir
+        os.chdir(scratch)
+        try:
+            start = time.perf_counter()
+            specs = ci_auto.get_preqs_with_actions(scenario['repos'],
+                                                   machine_dict,
+                                                   ghinterface_obj,
+                                                   scenario['actions'])
+            [spec.to_job(ghinterface_obj).run() for spec in specs]
+            seconds = time.perf_counter() - start
+        finally:
+            os.chdir(start_dir)
+            ci_auto.harness = None
+    return seconds, replayer
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay recorded CI cycles')
+    parser.add_argument('scenarios', nargs='+')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--profile', action='store_true',
+                        help='print the top cProfile entries')
+    parser.add_argument('--quiet', action='store_true',
+                        help='do not print comments')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import ci_auto
+
+    # waits for workflows to progress are not needed when replaying
+    time.sleep = lambda seconds: None
+
+    profiler = cProfile.Profile() if args.profile else None
+    for file_name in args.scenarios:
+        timings = []
+        for _ in range(args.repeat):
+            if profiler:
+                profiler.enable()
+            seconds, replayer = replay_scenario(file_name, ci_auto)
+            if profiler:
+                profiler.disable()
+            timings.append(seconds)
+        print(f'{file_name}: {len(replayer.scenario["commands"])} commands, '
+              f'{len(replayer.comments)} comments, '
+              f'{replayer.mismatches} mismatches, '
+              f'best {min(timings) * 1000:.1f} ms of {len(timings)}')
+        if not args.quiet:
+            for comment in replayer.comments:
+                print(f'--- PR #{comment.pr.number} comment {comment.id}')
+                print(comment.body)
+    if profiler:
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
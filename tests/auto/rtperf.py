@@ -0,0 +1,173 @@
+"""
+Name: rtperf.py
+Keeps the per-test wall time and maximum memory that rt.sh writes to
+RegressionTests_<machine>.<compiler>.log, and flags tests in a PR run
+that are slower or bigger than recent develop (baseline) runs.
+
+History is kept in Perfhist.cfg, one section per
+test|machine|compiler|commit.
+"""
+
+import datetime
+import logging
+import os
+import re
+import statistics
+import threading
+from configparser import ConfigParser as config_parser
+
+HIST_FILE = 'Perfhist.cfg'
+# Number of develop runs per test to compare against and to keep
+HIST_KEEP = 10
+# Fewer develop runs than this and a test is not checked
+MIN_SAMPLES = 3
+# A value is flagged when above mean + STDEV_MULT * stdev of develop runs
+# and also at least MIN_GROWTH above the mean
+STDEV_MULT = 3.0
+MIN_GROWTH = 0.10
+
+# matrix jobs check the logs of several compilers at once
+_lock = threading.Lock()
+
+# Checking test 001 control results (rt.sh -r) /
+# Moving baseline 001 control files (rt.sh -c)
+checking_re = re.compile(
+    r'(?:Checking test|Moving baseline)\s+\d+\s+(\S+)\s+(?:results|files)')
+wall_re = re.compile(r'The total amount of wall time\s*=\s*([\d.]+)')
+rss_re = re.compile(r'The maximum resident set size \(KB\)\s*=\s*(\d+)')
+result_re = re.compile(r'^\s*Test\s+\d+\s+(\S+)\s+(PASS|FAIL)')
+
+
+def parse_logfile(logfile):
+    ''' Return {test name: {'wall': seconds, 'rss': KB}} for every test
+        in a RegressionTests log that reported its wall time '''
+    tests = {}
+    test = None
+    current = {}
+    if not os.path.exists(logfile):
+        return tests
+    with open(logfile) as f:
+        for line in f:
+            match = checking_re.search(line)
+            if match:
+                test = match.group(1)
+                current = {}
+                continue
+            match = wall_re.search(line)
+            if match and test:
+                current['wall'] = float(match.group(1))
+                continue
+            match = rss_re.search(line)
+            if match and test:
+                current['rss'] = float(match.group(1))
+                continue
+            match = result_re.search(line)
+            if match:
+                name = match.group(1)
+                if name == test and 'wall' in current:
+                    tests[name] = current
+                test = None
+                current = {}
+    return tests
+
+
+def read_history(file_name=HIST_FILE):
+    config = config_parser()
+    if os.path.exists(file_name):
+        config.read(file_name)
+    return config
+
+
+def write_history(config, file_name=HIST_FILE):
+    tmp_file = f'{file_name}.{os.getpid()}'
+    with open(tmp_file, 'w') as fname:
+        config.write(fname)
+    os.replace(tmp_file, file_name)
+
+
+def record(config, tests, machine, compiler, commit, kind):
+    ''' Add one run to the history. kind is "develop" for baseline runs
+        and "pr" for PR regression test runs '''
+    today = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    for name, values in tests.items():
+        section = f'{name}|{machine}|{compiler}|{commit}'
+        config[section] = {}
+        config[section]['kind'] = kind
+        config[section]['date'] = today
+        for key, value in values.items():
+            config[section][key] = str(value)
+
+
+def prune(config, keep=HIST_KEEP):
+    ''' Keep only the newest runs per test, machine, compiler and kind '''
+    groups = {}
+    for section in config.sections():
+        name, machine, compiler, _ = section.split('|', 3)
+        key = (name, machine, compiler, config[section]['kind'])
+        groups.setdefault(key, []).append(section)
+    for sections in groups.values():
+        sections.sort(key=lambda s: config[s]['date'], reverse=True)
+        for section in sections[keep:]:
+            config.remove_section(section)
+
+
+def develop_values(config, name, machine, compiler, key, exclude=None):
+    sections = [s for s in config.sections()
+                if s.startswith(f'{name}|{machine}|{compiler}|')
+                and s != exclude
+                and config[s]['kind'] == 'develop'
+                and config.has_option(s, key)]
+    sections.sort(key=lambda s: config[s]['date'], reverse=True)
+    return [config.getfloat(s, key) for s in sections[:HIST_KEEP]]
+
+
+def find_regressions(config, tests, machine, compiler, commit):
+    ''' Return a list of comment lines for tests that grew '''
+    labels = {'wall': ('wall time', 's'), 'rss': ('max memory', 'KB')}
+    found = []
+    for name in sorted(tests):
+        section = f'{name}|{machine}|{compiler}|{commit}'
+        for key, (label, unit) in labels.items():
+            if key not in tests[name]:
+                continue
+            history = develop_values(config, name, machine, compiler, key,
+                                     exclude=section)
+            if len(history) < MIN_SAMPLES:
+                continue
+            mean = statistics.mean(history)
+            limit = max(mean + STDEV_MULT * statistics.stdev(history),
+                        mean * (1 + MIN_GROWTH))
+            value = tests[name][key]
+            if value > limit:
+                growth = 100 * (value - mean) / mean if mean else 0
+                found.append(f'{name}: {label} {value:.0f}{unit} is '
+                             f'{growth:.0f}% over develop mean '
+                             f'{mean:.0f}{unit} ({len(history)} runs)')
+    return found
+
+
+def check_logfile(job_obj, logfile, kind='pr'):
+    ''' Record the per-test figures of a RegressionTests log and add
+        any runtime or memory regressions to the job comment '''
+    logger = logging.getLogger('RTPERF/CHECK_LOGFILE')
+    tests = parse_logfile(logfile)
+    logger.info(f'Found timings for {len(tests)} tests')
+    if not tests:
+        return []
+    commit = job_obj.tested_sha()
+    with _lock:
+        config = read_history()
+        record(config, tests, job_obj.machine, job_obj.compiler, commit,
+               kind)
+        found = []
+        if kind == 'pr':
+            found = find_regressions(config, tests, job_obj.machine,
+                                     job_obj.compiler, commit)
+        prune(config)
+        write_history(config)
+    if found:
+        logger.info(f'Performance regressions: {len(found)}')
+        job_obj.comment_append('Performance regressions compared with '
+                               'recent develop runs:')
+        [job_obj.comment_append(line) for line in found]
+    return found
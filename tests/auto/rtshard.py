@@ -0,0 +1,164 @@
+"""
+Name: rtshard.py
+Splits an rt.conf into balanced shards and runs one rt.sh per shard at
+the same time, then merges the shard logs into the single
+RegressionTests_<machine>.<compiler>.log that post-processing reads.
+
+Tests are packed longest first onto the least loaded shard, using the
+wall times kept by rtperf.py in Perfhist.cfg. A test and the tests that
+depend on it (restart tests) stay in the same shard. rt.sh locks its
+tests directory, so every shard after the first runs in a local copy of
+the checked out clone.
+
+Option from CImachine.cfg:
+  rt_shards  number of rt.sh runs for an RT job (default 1, no sharding)
+"""
+
+import logging
+import os
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+import flaky
+import rtperf
+
+SHARD_CONF = 'rt_shard.conf'
+# Used for tests with no recorded wall time and no other history
+DEFAULT_SECONDS = 600.0
+SUCCESS_STRING = 'SUCCESSFUL'
+
+
+def durations(machine, compiler):
+    ''' Mean recorded wall time per rt.conf test name for this machine
+        and compiler '''
+    config = rtperf.read_history()
+    walls = {}
+    for section in config.sections():
+        name, sec_machine, sec_compiler, _ = section.split('|', 3)
+        if (sec_machine, sec_compiler) == (machine, compiler) and \
+           config.has_option(section, 'wall'):
+            # logs name tests <test>_<compiler>, rt.conf does not
+            walls.setdefault(flaky.rt_name(name, compiler), []).append(
+                config.getfloat(section, 'wall'))
+    return {name: statistics.mean(values) for name, values in walls.items()}
+
+
+def read_units(conf_file):
+    ''' Returns the rt.conf lines and a list of units. A unit is a dict
+        with the COMPILE line index, the RUN line indexes of a test and
+        its dependents, and the test names '''
+    with open(conf_file) as fname:
+        lines = fname.readlines()
+    units = []
+    unit_of = {}
+    compile_index = None
+    for index, line in enumerate(lines):
+        fields = [f.strip() for f in line.split('|')]
+        if fields[0] == 'COMPILE':
+            compile_index = index
+        elif fields[0] == 'RUN' and len(fields) > 1:
+            depends = fields[4] if len(fields) > 4 else ''
+            if depends in unit_of:
+                unit = unit_of[depends]
+            else:
+                unit = {'compile': compile_index, 'runs': [], 'tests': []}
+                units.append(unit)
+            unit['runs'].append(index)
+            unit['tests'].append(fields[1])
+            unit_of[fields[1]] = unit
+    return lines, units
+
+
+def plan(units, num_shards, seconds):
+    ''' Longest processing time first: each unit goes to the shard with
+        the least work so far. Returns a list of (total seconds, units) '''
+    known = list(seconds.values())
+    default = statistics.median(known) if known else DEFAULT_SECONDS
+    for unit in units:
+        unit['seconds'] = sum(seconds.get(test, default)
+                              for test in unit['tests'])
+    shards = [[0.0, []] for _ in range(min(num_shards, len(units)))]
+    for unit in sorted(units, key=lambda u: u['seconds'], reverse=True):
+        shard = min(shards, key=lambda s: s[0])
+        shard[0] = shard[0] + unit['seconds']
+        shard[1].append(unit)
+    return shards
+
+
+def write_shard_conf(lines, units, conf_file):
+    ''' Write the lines of a shard in rt.conf order, each RUN group
+        after the COMPILE line it needs '''
+    keep = set()
+    for unit in units:
+        keep.update(unit['runs'])
+        if unit['compile'] is not None:
+            keep.add(unit['compile'])
+    with open(conf_file, 'w') as fname:
+        fname.writelines(lines[index] for index in sorted(keep))
+
+
+def merge_logs(shard_logs, merged_log):
+    ''' One log with every shard's results; it is only successful if
+        every shard was '''
+    successful = True
+    merged = []
+    for shard_log in shard_logs:
+        if not os.path.exists(shard_log):
+            successful = False
+            merged.append(f'Shard log {shard_log} not found\n')
+            continue
+        with open(shard_log) as fname:
+            lines = fname.readlines()
+        if not any(SUCCESS_STRING in line for line in lines):
+            successful = False
+        merged.extend(line for line in lines if SUCCESS_STRING not in line)
+    merged.append('REGRESSION TEST WAS SUCCESSFUL\n' if successful
+                  else 'REGRESSION TEST FAILED\n')
+    with open(merged_log, 'w') as fname:
+        fname.writelines(merged)
+    return successful
+
+
+def run_sharded(job_obj, pr_repo_loc, conf, rt_flags, shell):
+    ''' Run rt.sh for conf in rt_shards concurrent shards '''
+    logger = logging.getLogger('RTSHARD/RUN_SHARDED')
+    num_shards = int(job_obj.machine_dict.get('rt_shards') or 1)
+    lines, units = read_units(f'{pr_repo_loc}/tests/{conf}')
+    shards = plan(units, num_shards,
+                  durations(job_obj.machine, job_obj.compiler))
+    repo_locs = [pr_repo_loc] + [f'{pr_repo_loc}_shard{i}'
+                                 for i in range(1, len(shards))]
+    # a retry or rerun finds the copies of the earlier run, which cp -a
+    # would copy into rather than refresh
+    copy_commands = [[f'rm -rf {repo_loc} && cp -a {pr_repo_loc} {repo_loc}',
+                      os.path.dirname(pr_repo_loc)]
+                     for repo_loc in repo_locs[1:]]
+    job_obj.run_commands(logger, copy_commands)
+    for repo_loc, (seconds, shard_units) in zip(repo_locs, shards):
+        write_shard_conf(lines, shard_units,
+                         f'{repo_loc}/tests/{SHARD_CONF}')
+        logger.info(f'{repo_loc}: {sum(len(u["tests"]) for u in shard_units)}'
+                    f' tests, about {seconds / 60:.0f} min')
+    job_obj.comment_append(f'Regression tests run in {len(shards)} shards')
+
+    def run_shard(repo_loc):
+        rt_command = [[f'export RT_COMPILER="{job_obj.compiler}" && '
+                       f'cd tests && {shell} ./rt.sh {rt_flags} '
+                       f'-l {SHARD_CONF} >& {job_obj.compiler}_out',
+                       repo_loc]]
+        job_obj.run_commands(logger, rt_command)
+
+    with ThreadPoolExecutor(max_workers=len(repo_locs)) as executor:
+        list(executor.map(run_shard, repo_locs))
+
+    rt_log = f'tests/RegressionTests_{job_obj.machine}.{job_obj.compiler}.log'
+    shard_logs = [f'{repo_loc}/{rt_log}' for repo_loc in repo_locs]
+    # read shard 0's log before it is replaced by the merged one
+    merged_log = f'{pr_repo_loc}/{rt_log}'
+    shard_logs[0] = f'{merged_log}.shard0'
+    if os.path.exists(merged_log):
+        os.replace(merged_log, shard_logs[0])
+    successful = merge_logs(shard_logs, merged_log)
+    logger.info(f'Merged {len(shard_logs)} shard logs, '
+                f'successful: {successful}')
+    return successful
@@ -0,0 +1,141 @@
+"""
+Name: runlock.py
+Exclusive lock so that only one ci_auto.py works on a workdir at a time.
+
+The lock is a file created with O_EXCL holding the host, pid and start
+time of its owner. A background thread touches it every HEARTBEAT
+seconds. A lock whose heartbeat is older than STALE seconds, or whose
+owner is a dead process on this host, is stale and is taken over. The
+takeover renames the lock aside and checks that it moved the same file it
+found stale; if another process had just made a new lock, that lock
+is put back.
+"""
+
+import datetime
+import logging
+import os
+import socket
+import threading
+
+LOCK_NAME = '.ci_auto.lock'
+HEARTBEAT = 60
+STALE = 10 * HEARTBEAT
+
+
+class RunLock:
+    '''
+    Lock file with a heartbeat
+    ...
+
+    Attributes
+    ----------
+    path : str
+      Location of the lock file
+    owned : bool
+      True while this process holds the lock
+    '''
+
+    def __init__(self, workdir, name=LOCK_NAME, heartbeat=HEARTBEAT,
+                 stale=STALE):
+        self.logger = logging.getLogger('RUNLOCK')
+        self.path = os.path.join(workdir, name)
+        self.heartbeat = heartbeat
+        self.stale = stale
+        self.owned = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _create(self):
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                         0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as fname:
+            fname.write(f'{socket.gethostname()} {os.getpid()} '
+                        f'{datetime.datetime.now().isoformat()}\n')
+        return True
+
+    def _identity(self, path):
+        ''' (inode, owner line) of a lock file; inodes are reused once a
+            file is removed, the owner line tells two locks apart '''
+        with open(path) as fname:
+            return os.fstat(fname.fileno()).st_ino, fname.readline()
+
+    def _stale_identity(self):
+        ''' The identity of the lock file if it is stale, else None '''
+        try:
+            identity = self._identity(self.path)
+            host, pid = identity[1].split()[:2]
+            mtime = os.path.getmtime(self.path)
+        except (OSError, ValueError):
+            # vanished or half written, let the next attempt decide
+            return None
+        age = datetime.datetime.now().timestamp() - mtime
+        if age > self.stale:
+            self.logger.info(f'Lock heartbeat is {age:.0f}s old')
+            return identity
+        if host == socket.gethostname():
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                self.logger.info(f'Lock owner pid {pid} is gone')
+                return identity
+            except (PermissionError, ValueError):
+                pass
+        return None
+
+    def acquire(self):
+        ''' Take the lock, taking over a stale one. Returns True if held '''
+        if self._create():
+            self._start_heartbeat()
+            return True
+        stale_identity = self._stale_identity()
+        if stale_identity is None:
+            return False
+        # only one process can win the rename of a stale lock
+        stale_path = f'{self.path}.stale.{os.getpid()}'
+        try:
+            os.rename(self.path, stale_path)
+        except OSError:
+            return False
+        if self._identity(stale_path) != stale_identity:
+            # another process took the stale lock over first and this
+            # is its new lock: put it back unless yet another is there
+            self.logger.info('Lock was replaced while checking it')
+            try:
+                os.link(stale_path, self.path)
+            except OSError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        self.logger.info('Removed stale lock')
+        if self._create():
+            self._start_heartbeat()
+            return True
+        return False
+
+    def _start_heartbeat(self):
+        self.owned = True
+        self._thread = threading.Thread(target=self._beat, daemon=True)
+        self._thread.start()
+
+    def _beat(self):
+        while not self._stop.wait(self.heartbeat):
+            try:
+                os.utime(self.path)
+            except OSError as e:
+                self.logger.critical(f'Lost lock {self.path}: {e}')
+                return
+
+    def release(self):
+        if not self.owned:
+            return
+        self._stop.set()
+        self._thread.join()
+        self.owned = False
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
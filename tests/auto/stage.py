@@ -0,0 +1,146 @@
+"""
+Name: stage.py
+Node-local staging of the clone and build of a job. With stage_dir set
+in CImachine.cfg, the clone, externals checkout and build of an SRW
+build job run under a node-local or tmpfs directory instead of on the
+shared file system under workdir, where their many small file creates
+and stats are slow. Once built, the tree is copied to where it would
+have been under workdir (several copies at once), leaving out the CMake
+build directories that nothing reads after the install. The WE2E setup
+and the comment read the copy.
+
+The staging directory of a job is removed when the job's staged part
+ends, whether it succeeded or failed. Directories left by a process
+that was killed are removed by the next run.
+
+GSI builds are not staged: ctest runs from the configured build tree,
+which names its own location. Weather model builds are compiled by
+rt.sh in batch jobs on other nodes.
+
+A staged job is resumed from the start of the staged part, since the
+staging directory does not outlive the run. Once copied back, the
+synced phase records where.
+
+Options from CImachine.cfg:
+  stage_dir      node-local directory, such as /tmp or /dev/shm; empty
+                 for building under workdir (default)
+  stage_workers  copies run at once back to workdir (default 8)
+"""
+
+import fnmatch
+import glob
+import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import jobstate
+
+STAGE_PREFIX = 'ci_stage'
+# Top level directories of the app that are only build intermediates
+SKIP_DIRS = ['build', 'build_*']
+# Phases run inside the staging directory
+STAGED_PHASES = ['cloned', 'externals', 'built']
+
+
+def enabled(job_obj):
+    return bool(job_obj.machine_dict.get('stage_dir'))
+
+
+def remove_stale(stage_dir):
+    ''' Staging directories of processes that are no longer running '''
+    logger = logging.getLogger('STAGE/REMOVE_STALE')
+    for path in glob.glob(os.path.join(stage_dir, f'{STAGE_PREFIX}_*')):
+        pid = os.path.basename(path).split('_')[2]
+        try:
+            os.kill(int(pid), 0)
+        except (ValueError, ProcessLookupError):
+            logger.info(f'Removing stale {path}')
+            shutil.rmtree(path, ignore_errors=True)
+        except PermissionError:
+            pass
+
+
+def skipped(name):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in SKIP_DIRS)
+
+
+def sync_units(src, dest):
+    ''' (source, destination) pairs to copy: the files of src and the
+        entries of its directories, without the build directories '''
+    units = []
+    for name in os.listdir(src):
+        path = os.path.join(src, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            os.makedirs(os.path.join(dest, name), exist_ok=True)
+            units += [(os.path.join(path, sub), os.path.join(dest, name))
+                      for sub in os.listdir(path)
+                      if not (skipped(sub) and
+                              os.path.isdir(os.path.join(path, sub)))]
+        else:
+            units.append((path, dest))
+    return units
+
+
+def sync_back(job_obj, src, dest):
+    ''' Copy the staged run directory src to dest under workdir '''
+    logger = logging.getLogger('STAGE/SYNC_BACK')
+    workers = int(job_obj.machine_dict.get('stage_workers') or 8)
+    os.makedirs(dest, exist_ok=True)
+    units = sync_units(src, dest)
+    logger.info(f'Copying {len(units)} entries of {src} to {dest}')
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(job_obj.run_commands, logger,
+                                   [[f'cp -a "{path}" "{to_dir}"', src]])
+                   for path, to_dir in units]
+    for future in futures:
+        future.result()
+
+
+def moved(result, stage_root, workdir):
+    ''' result with the staging paths changed to the workdir ones '''
+    if isinstance(result, str):
+        return result.replace(stage_root, workdir, 1)
+    if isinstance(result, (list, tuple)):
+        return type(result)(moved(item, stage_root, workdir)
+                            for item in result)
+    return result
+
+
+def run_staged(job_obj, func, *args):
+    ''' func(workdir, *args) must return (pr_repo_loc, repo_dir_str) '''
+    logger = logging.getLogger('STAGE/RUN_STAGED')
+    stage_dir = job_obj.machine_dict['stage_dir']
+    remove_stale(stage_dir)
+    # the staging directory of an interrupted run is gone
+    for name in STAGED_PHASES:
+        (job_obj.resumed or {}).pop(name, None)
+    job_obj.stage_root = os.path.join(
+        stage_dir,
+        f'{STAGE_PREFIX}_{os.getpid()}_{job_obj.preq_dict["preq"].id}')
+    os.makedirs(job_obj.stage_root)
+    logger.info(f'Staging in {job_obj.stage_root}')
+    try:
+        result = func(job_obj.stage_root, *args)
+        repo_dir_str = result[1]
+        sync_back(job_obj, repo_dir_str,
+                  moved(repo_dir_str, job_obj.stage_root, job_obj.workdir))
+        job_obj.comment_text = job_obj.comment_text.replace(
+            job_obj.stage_root, job_obj.workdir)
+        job_obj.comment_append(f'Built in node-local {stage_dir}, copied '
+                               f'back without the build directories')
+        return moved(result, job_obj.stage_root, job_obj.workdir)
+    finally:
+        shutil.rmtree(job_obj.stage_root, ignore_errors=True)
+        logger.info(f'Removed {job_obj.stage_root}')
+        job_obj.stage_root = None
+
+
+def staged(job_obj, func, *args):
+    ''' Run func(workdir, *args), which clones and builds, in the
+        staging directory if staging is on. Returns its
+        (pr_repo_loc, repo_dir_str) under workdir '''
+    if not enabled(job_obj) or job_obj.harness_active():
+        return func(job_obj.workdir, *args)
+    return jobstate.phase(job_obj, 'synced', run_staged, job_obj, func,
+                          *args)
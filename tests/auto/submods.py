@@ -0,0 +1,47 @@
+"""
+Name: submods.py
+Builds the command that checks out the submodules of a freshly cloned
+weather model repo. Submodules are fetched in parallel, and by default
+without file contents (blob-less) or history (shallow) beyond the
+commits recorded in the superproject. Missing blobs are fetched on
+demand by git. If the fast fetch fails, for example because a pinned
+commit is not reachable from a shallow fetch or git is too old for
+--filter, the submodules are unshallowed and fetched in full.
+
+Options from CImachine.cfg:
+  submodule_jobs   number of submodules fetched at once (default 8)
+  submodule_fetch  blobless, shallow or full (default blobless)
+"""
+
+import logging
+
+FETCH_OPTIONS = {
+    'blobless': '--filter=blob:none',
+    'shallow': '--depth 1 --recommend-shallow',
+    'full': '',
+}
+
+
+def update_command(jobs, fetch='blobless'):
+    ''' Shell command for `git submodule update` with a fallback '''
+    logger = logging.getLogger('SUBMODS/UPDATE_COMMAND')
+    if fetch not in FETCH_OPTIONS:
+        logger.info(f'Unknown submodule_fetch {fetch}, using full')
+        fetch = 'full'
+    full_update = f'git submodule update --init --recursive --jobs {jobs}'
+    if fetch == 'full':
+        return full_update
+    fast_update = f'{full_update} {FETCH_OPTIONS[fetch]}'
+    fallback = ('echo "Fast submodule fetch failed, fetching in full" && '
+                'git submodule foreach --recursive '
+                '"git fetch --unshallow || true" && '
+                f'{full_update}')
+    return f'{fast_update} || ({fallback})'
+
+
+def hydrate_commands(job_obj, pr_repo_loc):
+    ''' Commands for job_obj.run_commands that check out all submodules '''
+    jobs = job_obj.machine_dict.get('submodule_jobs', '8')
+    fetch = job_obj.machine_dict.get('submodule_fetch', 'blobless')
+    return [[f'git config submodule.fetchJobs {jobs}', pr_repo_loc],
+            [update_command(jobs, fetch), pr_repo_loc]]
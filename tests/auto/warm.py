@@ -0,0 +1,162 @@
+"""
+Name: warm.py
+Reads the baselines an RT job will compare against while rt.sh is still
+compiling, so the comparisons at the end of each test find them already
+read. The baseline of the PR's BL_DATE is under
+{workdir}/RT/NEMSfv3gfs/gsl-develop-<BL_DATE>/<COMPILER>, one directory
+per CNTL_DIR of the selected tests (the whole tree for the full suite).
+
+Files are read whole, several at once, in large sequential reads with
+posix_fadvise hints, in path order. The comparisons run in batch jobs
+on compute nodes, so what this warms is the file system's server side
+cache, not the page cache of the node that compares. The number of
+files and bytes read is logged and added to the comment.
+
+Option from CImachine.cfg:
+  warm_workers  files read at once, 0 for no warming (default)
+"""
+
+import datetime
+import glob
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK = 16 * 1024 * 1024
+
+bl_date_re = re.compile(r'^\s*BL_DATE=(\d{8})\s*$')
+cntl_dir_re = re.compile(r'CNTL_DIR\s*=\s*["\']?([\w.-]+)')
+
+
+def read_bl_date(pr_repo_loc):
+    try:
+        with open(f'{pr_repo_loc}/tests/rt.sh') as fname:
+            for line in fname:
+                match = bl_date_re.match(line)
+                if match:
+                    return match.group(1)
+    except OSError:
+        pass
+    return None
+
+
+def cntl_dir(pr_repo_loc, test):
+    ''' The baseline directory a test compares against, from its
+        tests/tests file '''
+    try:
+        with open(f'{pr_repo_loc}/tests/tests/{test}') as fname:
+            match = cntl_dir_re.search(fname.read())
+    except OSError:
+        return test
+    return match.group(1) if match else test
+
+
+def baseline_dirs(job_obj, pr_repo_loc, tests):
+    bldate = read_bl_date(pr_repo_loc)
+    if bldate is None:
+        return []
+    bldir = f'{job_obj.workdir}/RT/NEMSfv3gfs/gsl-develop-{bldate}/' \
+            f'{job_obj.compiler.upper()}'
+    if not tests:
+        return [bldir] if os.path.isdir(bldir) else []
+    dirs = set()
+    for test in tests:
+        name = cntl_dir(pr_repo_loc, test)
+        # newer rt.sh adds the compiler to the directory name
+        for path in [f'{bldir}/{name}', f'{bldir}/{name}_{job_obj.compiler}']:
+            if os.path.isdir(path):
+                dirs.add(path)
+    return sorted(dirs)
+
+
+def warm_file(path, stop):
+    ''' Read path through once, returns (whole file read, bytes read) '''
+    total = 0
+    size = None
+    buf = bytearray(CHUNK)
+    try:
+        with open(path, 'rb', buffering=0) as fname:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fname.fileno(), 0, 0,
+                                 os.POSIX_FADV_SEQUENTIAL)
+                os.posix_fadvise(fname.fileno(), 0, 0,
+                                 os.POSIX_FADV_WILLNEED)
+            while not stop.is_set():
+                size = fname.readinto(buf)
+                if not size:
+                    break
+                total = total + size
+    except OSError:
+        return False, total
+    return size == 0, total
+
+
+class Warmer(threading.Thread):
+    '''
+    Reads baseline directories in the background
+    ...
+
+    Attributes
+    ----------
+    files : int
+      Files read whole
+    bytes : int
+      Bytes read
+    seconds : float
+      Time the reads took
+    '''
+
+    def __init__(self, dirs, workers):
+        super().__init__(daemon=True)
+        self.dirs = dirs
+        self.workers = workers
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.stop_event = threading.Event()
+
+    def run(self):
+        start = datetime.datetime.now()
+        paths = sorted(path for bl_dir in self.dirs
+                       for path in glob.glob(f'{bl_dir}/**', recursive=True)
+                       if os.path.isfile(path))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for whole, size in executor.map(
+                    lambda path: warm_file(path, self.stop_event), paths):
+                self.files = self.files + int(whole)
+                self.bytes = self.bytes + size
+        self.seconds = (datetime.datetime.now() - start).total_seconds()
+
+
+def start(job_obj, pr_repo_loc, tests=None):
+    ''' Start warming the baselines of tests, None if off or there is
+        no baseline for this BL_DATE '''
+    logger = logging.getLogger('WARM/START')
+    workers = int(job_obj.machine_dict.get('warm_workers') or 0)
+    if workers < 1 or job_obj.harness_active():
+        return None
+    dirs = baseline_dirs(job_obj, pr_repo_loc, tests)
+    if not dirs:
+        logger.info('No baseline directories to warm')
+        return None
+    logger.info(f'Warming {len(dirs)} baseline directories')
+    warmer = Warmer(dirs, workers)
+    warmer.start()
+    return warmer
+
+
+def finish(job_obj, warmer):
+    ''' Stop warming if it has not finished and report what was read '''
+    logger = logging.getLogger('WARM/FINISH')
+    if warmer is None:
+        return
+    warmer.stop_event.set()
+    warmer.join()
+    logger.info(f'Warmed {warmer.files} files, {warmer.bytes} bytes '
+                f'in {warmer.seconds:.0f}s')
+    job_obj.comment_append(f'Baseline warmed before comparison: '
+                           f'{warmer.files} files, '
+                           f'{warmer.bytes / 1e9:.1f} GB in '
+                           f'{warmer.seconds:.0f}s')